@@ -21,6 +21,7 @@ from django.test.utils import get_runner
 from django.utils.html import escape
 
 from upaas.storage.exceptions import FileNotFound
+from upaas.checksum import calculate_file_sha256
 from upaas.distro import distro_name, distro_version, distro_arch
 from upaas.utils import load_handler
 
@@ -33,6 +34,17 @@ from upaas_admin.apps.scheduler.models import (ApplicationRunPlan,
                                                BackendRunPlanSettings)
 
 
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', default=False,
+                     help='run tests marked as benchmark')
+
+
+def pytest_runtest_setup(item):
+    if 'benchmark' in item.keywords and \
+            not item.config.getoption('--benchmark'):
+        pytest.skip('benchmark tests are only run with --benchmark')
+
+
 def is_configured():
     if settings is None:
         return False
@@ -59,6 +71,27 @@ def _django_runner(request):
     return runner
 
 
+@pytest.fixture(autouse=True, scope="function")
+def package_cache(request):
+    """
+    Every test gets its own package archive cache, so that archives cached
+    by one test (or previous test runs) are never used by other tests.
+    """
+    if not is_configured():
+        return
+
+    directory = tempfile.mkdtemp(prefix="upaas_package_cache_")
+    mpatch = monkeypatch()
+    mpatch.setattr(settings.UPAAS_CONFIG.storage.cache, 'path', directory)
+
+    def cleanup():
+        mpatch.undo()
+        shutil.rmtree(directory, ignore_errors=True)
+    request.addfinalizer(cleanup)
+
+    return directory
+
+
 @pytest.fixture(scope="function")
 def empty_dir(request):
     directory = tempfile.mkdtemp(prefix="upaas_testdir_")
@@ -96,6 +129,7 @@ def create_pkg_file(request):
 
     request.instance.storage = storage
     request.instance.pkg_file_path = remote_path
+    request.instance.pkg_file_checksum = calculate_file_sha256(local_path)
 
 
 @pytest.fixture(scope="function")
@@ -272,7 +306,8 @@ def create_buildable_app_with_pkg(request):
                   interpreter_name=request.instance.app.interpreter_name,
                   interpreter_version=request.instance.app.interpreter_version,
                   filename=request.instance.pkg_file_path, bytes=1024,
-                  checksum='abcdefg', builder='fake builder',
+                  checksum=request.instance.pkg_file_checksum,
+                  builder='fake builder',
                   distro_name=distro_name(), distro_version=distro_version(),
                   distro_arch=distro_arch())
     pkg.save()
@@ -278,6 +278,7 @@ class AdminTest(MongoEngineTestCase):
         self.assertEqual(backend.ip.strNormal(), '8.8.8.8')
         self.assertEqual(backend.cpu_cores, 2)
         self.assertEqual(backend.memory_mb, 512)
+        backend.update(set__used_ports=[2001, 2002])
 
         url = reverse('admin_backend_edit', args=[backend.name])
         resp = self.client.post(url, {'is_enabled': True, 'name': 'backend2',
@@ -290,6 +291,7 @@ class AdminTest(MongoEngineTestCase):
         self.assertEqual(backend.ip.strNormal(), '7.7.7.7')
         self.assertEqual(backend.cpu_cores, 8)
         self.assertEqual(backend.memory_mb, 128)
+        self.assertEqual(backend.used_ports, [2001, 2002])
 
         backend.delete()
         self.assertEqual(BackendServer.objects().first(), None)
@@ -457,3 +457,50 @@ class ApiTest(MongoEngineTestCase, ResourceTestCase):
                                    **self.get_apikey_auth(self.user))
         self.assertValidJSONResponse(resp)
         self.assertEqual(len(self.deserialize(resp)['objects']), 1)
+
+    @pytest.mark.usefixtures("create_user", "create_run_plan")
+    def test_run_plan_simulate_get(self):
+        resp = self.api_client.get(
+            '/api/v1/run_plan/%s/simulate/?workers_min=2&workers_max=8' %
+            self.run_plan.safe_id, format='json',
+            **self.get_apikey_auth(self.user))
+        self.assertValidJSONResponse(resp)
+        data = self.deserialize(resp)
+        self.assertEqual(data['placed'], True)
+        self.assertEqual(data['workers_max'], 8)
+        self.assertEqual(data['backends'][0]['name'], self.backend.name)
+        self.assertEqual(data['backends'][0]['workers_max'], 8)
+        self.run_plan.reload()
+        self.assertEqual(self.run_plan.workers_max, 4)
+        self.assertEqual(self.run_plan.backends[0].workers_max, 4)
+
+    @pytest.mark.usefixtures("create_user", "create_run_plan")
+    def test_run_plan_simulate_invalid(self):
+        self.assertHttpBadRequest(self.api_client.get(
+            '/api/v1/run_plan/%s/simulate/?workers_min=4&workers_max=2' %
+            self.run_plan.safe_id, format='json',
+            **self.get_apikey_auth(self.user)))
+        self.assertHttpNotFound(self.api_client.get(
+            '/api/v1/run_plan/12345/simulate/', format='json',
+            **self.get_apikey_auth(self.user)))
+
+    @pytest.mark.usefixtures("create_user", "create_run_plan")
+    def test_run_plan_simulate_limits(self):
+        from upaas_admin.apps.scheduler.models import UserLimits
+        limits = UserLimits(user=self.user, workers=8)
+        limits.save()
+        try:
+            self.assertHttpBadRequest(self.api_client.get(
+                '/api/v1/run_plan/%s/simulate/?workers_max=9' %
+                self.run_plan.safe_id, format='json',
+                **self.get_apikey_auth(self.user)))
+            resp = self.api_client.get(
+                '/api/v1/run_plan/%s/simulate/?workers_max=8' %
+                self.run_plan.safe_id, format='json',
+                **self.get_apikey_auth(self.user))
+            self.assertValidJSONResponse(resp)
+            for backend in self.deserialize(resp)['backends']:
+                self.assertTrue(backend['workers_max'] > 0)
+                self.assertFalse('cpu_load' in backend)
+        finally:
+            limits.delete()
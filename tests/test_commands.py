@@ -9,6 +9,8 @@ from __future__ import unicode_literals
 
 import os
 import shutil
+import tempfile
+from datetime import datetime, timedelta
 
 import pytest
 
@@ -121,6 +123,45 @@ class CommandTest(MongoEngineTestCase):
         call_command('mule_backend', task_limit=1, ping_disabled=True)
         self.check_task_is_successful(self.app.tasks.first())
 
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_mule_backend_cmd_stop_concurrent(self):
+        self.app.stop_application()
+        self.assertNotEqual(len(self.app.flags), 0)
+        call_command('mule_backend', task_limit=1, ping_disabled=True,
+                     concurrency=4)
+        self.check_task_is_successful(self.app.tasks.first())
+
+    @pytest.mark.usefixtures("create_app", "create_backend")
+    def test_task_log_router(self):
+        import logging
+        from threading import Thread
+        from upaas_admin.apps.tasks.models import Task, TaskLogRouter
+        logger = logging.getLogger('upaas_test_router')
+        router = TaskLogRouter(logger=logger)
+        tasks = []
+
+        def run_task(idx):
+            task = Task(backend=self.backend, pid=os.getpid(),
+                        title='task %d' % idx, application=self.app)
+            task.save()
+            tasks.append(task)
+            router.add_task(task)
+            logger.warning('message from task %d', idx)
+            router.remove_task()
+
+        threads = [Thread(target=run_task, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(logger.handlers, [])
+        for task in tasks:
+            task.reload()
+            self.assertEqual(len(task.messages), 1)
+            self.assertTrue(task.messages[0].message.startswith(
+                'message from task'))
+            task.delete()
+
     @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan",
                              "setup_monkeypatch")
     def test_mule_backend_cmd_restart(self):
@@ -153,6 +194,431 @@ class CommandTest(MongoEngineTestCase):
         self.assertEqual(self.app.run_plan.workers_max, 8)
         self.assertEqual(self.app.run_plan.backends[0].workers_max, 8)
 
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_backend_reconciler(self):
+        from upaas_admin.apps.applications.constants import (
+            IsStartingFlag, NeedsReschedulingFlag)
+        from upaas_admin.apps.tasks.reconcile import BackendReconciler
+        reconciler = BackendReconciler(self.backend)
+        reconciler.prefetch()
+        self.assertEqual(len(reconciler.run_plans), 1)
+        flags = reconciler.check()
+        self.assertEqual(flags[IsStartingFlag.name], [self.app])
+        self.assertEqual(reconciler.set_flags(flags), 1)
+        flag = self.app.flags.first()
+        self.assertEqual(flag.name, IsStartingFlag.name)
+        self.assertEqual(flag.pending_backends, [self.backend])
+        # applications with flags are skipped
+        self.assertEqual(reconciler.reconcile(), 0)
+        self.app.flags.delete()
+
+        self.run_plan.update(set__workers_max=8)
+        reconciler = BackendReconciler(self.backend,
+                                       is_running=lambda app: True)
+        self.assertEqual(reconciler.reconcile(application_ids=[]), 0)
+        self.assertEqual(reconciler.package_applications([self.pkg.safe_id]),
+                         set([self.app.id]))
+        self.assertEqual(reconciler.reconcile(
+            application_ids=[self.app.safe_id]), 1)
+        self.assertEqual(self.app.flags.first().name,
+                         NeedsReschedulingFlag.name)
+        self.app.flags.delete()
+
+    def test_vassal_watcher(self):
+        from time import sleep
+        from upaas_admin.apps.tasks.watcher import VassalWatcher
+        root = tempfile.mkdtemp(prefix='upaas_')
+        vassals = os.path.join(root, 'vassals')
+        apps = os.path.join(root, 'apps')
+        os.makedirs(vassals)
+        os.makedirs(os.path.join(apps, 'pkg'))
+        open(os.path.join(vassals, 'app.ini'), 'w').close()
+        watcher = VassalWatcher(vassals, apps, poll_interval=0.2)
+        watcher.start()
+        sleep(0.5)
+        self.assertFalse(watcher.pending)
+        os.remove(os.path.join(vassals, 'app.ini'))
+        shutil.rmtree(os.path.join(apps, 'pkg'))
+        sleep(1)
+        self.assertTrue(watcher.pending)
+        self.assertEqual(watcher.changes(), (set(['app']), set(['pkg']),
+                                             False))
+        self.assertFalse(watcher.pending)
+        watcher.stop()
+        shutil.rmtree(root)
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_reschedule_cmd(self):
+        self.run_plan.update(set__workers_max=8)
+        call_command('reschedule')
+        self.run_plan.reload()
+        self.assertEqual(len(self.run_plan.backends), 1)
+        self.assertEqual(self.run_plan.backends[0].workers_max, 8)
+        self.assertEqual(self.run_plan.backends[0].socket, 8080)
+        flag = self.app.flags.first()
+        self.assertNotEqual(flag, None)
+        self.assertEqual(flag.name, 'NEEDS_RESTART')
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_check_ports_cmd(self):
+        self.backend.update(set__used_ports=[])
+        call_command('check_ports')
+        self.backend.reload()
+        self.assertEqual(self.backend.allocated_ports, [])
+        call_command('check_ports', fix=True)
+        self.backend.reload()
+        self.assertEqual(sorted(self.backend.allocated_ports), [8080, 9090])
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_simulate_scheduler_cmd(self):
+        path = os.path.join(tempfile.mkdtemp(prefix='upaas_'), 'snap.json')
+        call_command('simulate_scheduler', record=path)
+        self.assertTrue(os.path.isfile(path))
+        call_command('simulate_scheduler', snapshot=path)
+        call_command('simulate_scheduler', snapshot=path,
+                     scorers=['dominant'])
+        shutil.rmtree(os.path.dirname(path))
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_what_if_cmd(self):
+        call_command('what_if', self.app.name, workers_max=16)
+        self.run_plan.reload()
+        self.assertEqual(self.run_plan.workers_max, 4)
+
+    @pytest.mark.usefixtures("create_app")
+    def test_mule_flag_listener(self):
+        from upaas_admin.apps.tasks.mule import MuleFlagListener
+        from upaas_admin.apps.applications.constants import (
+            NeedsBuildingFlag, NeedsStoppingFlag)
+        listener = MuleFlagListener([NeedsBuildingFlag.name])
+        listener.open()
+        self.assertFalse(listener.wait(1))
+        self.app.build_package()
+        self.assertTrue(listener.wait(5))
+        self.assertFalse(listener.wait(1))
+        other = MuleFlagListener([NeedsStoppingFlag.name])
+        other.open()
+        self.app.build_package()
+        self.assertFalse(other.wait(1))
+
+    @pytest.mark.usefixtures("create_app", "create_backend")
+    def test_mule_flag_lock(self):
+        from upaas_admin.apps.applications.constants import NeedsBuildingFlag
+        from upaas_admin.apps.applications.models import ApplicationFlag
+        from upaas_admin.apps.tasks.mule import MuleFlagListener
+        from upaas_admin.apps.tasks.management.commands.mule_builder import \
+            Command
+        self.app.build_package()
+        mule = Command()
+        flag = mule.find_flag()
+        self.assertNotEqual(flag, None)
+        self.assertEqual(len(flag.locks), 1)
+        self.assertEqual(flag.pending, False)
+        self.assertEqual(mule.find_flag(), None)
+        ApplicationFlag.objects(id=flag.id).update_one(
+            set__locks__0__expires=datetime.now() - timedelta(seconds=1))
+        claimed = mule.find_flag()
+        self.assertNotEqual(claimed, None)
+        self.assertEqual(claimed.id, flag.id)
+        self.assertEqual(len(claimed.locks), 1)
+        listener = MuleFlagListener([NeedsBuildingFlag.name])
+        listener.open()
+        mule.unlock_flag(claimed)
+        self.assertTrue(listener.wait(5))
+        claimed.reload()
+        self.assertEqual(claimed.locks, [])
+        self.assertEqual(mule.find_flag(), None)
+        self.app.flags.delete()
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_mule_rolling_restart(self):
+        from upaas_admin.apps.applications.models import ApplicationFlag
+        from upaas_admin.apps.tasks.management.commands.mule_backend import \
+            Command
+        self.run_plan.update(set__max_unavailable=1)
+        self.app.reload()
+        self.app.restart_application()
+        flag = self.app.flags.first()
+        self.assertEqual(flag.free_slots, 1)
+        mule = Command()
+        claimed = mule.find_flag()
+        self.assertNotEqual(claimed, None)
+        self.assertEqual(claimed.free_slots, 0)
+        # lock in flight is still using the only slot
+        self.app.restart_application()
+        flag.reload()
+        self.assertEqual(flag.free_slots, 0)
+        mule.unlock_flag(claimed)
+        flag.reload()
+        self.assertEqual(flag.free_slots, 1)
+        self.assertEqual(flag.locks, [])
+        ApplicationFlag.objects(id=flag.id).update_one(set__free_slots=0)
+        self.assertEqual(mule.find_flag(), None)
+        self.run_plan.update(unset__max_unavailable=True)
+        self.app.reload()
+        self.app.restart_application()
+        flag.reload()
+        self.assertEqual(flag.free_slots, None)
+        self.assertNotEqual(mule.find_flag(), None)
+        self.app.flags.delete()
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_mule_flag_lock_serializes_application(self):
+        from upaas_admin.apps.applications.constants import NeedsUpgradeFlag
+        from upaas_admin.apps.applications.models import ApplicationFlag
+        from upaas_admin.apps.tasks.management.commands.mule_backend import \
+            Command
+        self.app.restart_application()
+        mule = Command()
+        claimed = mule.find_flag()
+        self.assertNotEqual(claimed, None)
+        upgrade = ApplicationFlag(application=self.app,
+                                  name=NeedsUpgradeFlag.name,
+                                  pending_backends=[mule.backend])
+        upgrade.save()
+        # other mule process on the same backend must wait until restart
+        # is done
+        other = Command()
+        self.assertEqual(other.find_flag(), None)
+        mule.unlock_flag(claimed)
+        self.assertEqual(other.find_flag().id, upgrade.id)
+        self.app.flags.delete()
+
+    def create_unpacked_package(self, filename):
+        from upaas_admin.apps.applications.models import Package
+        pkg = Package(metadata=self.pkg.metadata, application=self.app,
+                      interpreter_name=self.pkg.interpreter_name,
+                      interpreter_version=self.pkg.interpreter_version,
+                      filename=filename, bytes=1024, checksum='abcdefg',
+                      builder='fake builder',
+                      distro_name=self.pkg.distro_name,
+                      distro_version=self.pkg.distro_version,
+                      distro_arch=self.pkg.distro_arch)
+        pkg.save()
+        # pretend package is already unpacked
+        os.makedirs(pkg.package_path)
+        return pkg
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_mule_backend_cmd_stage_package(self):
+        pkg = self.create_unpacked_package('pkg2')
+        try:
+            self.app.stage_package(pkg)
+            self.app.reload()
+            self.assertEqual(self.app.current_package.id, self.pkg.id)
+            self.assertEqual(self.app.staged_package_id, pkg.id)
+            call_command('mule_backend', task_limit=1, ping_disabled=True)
+            self.app.reload()
+            self.assertEqual(self.app.current_package.id, pkg.id)
+            self.assertEqual(self.app.staged_package_id, None)
+            self.assertNotEqual(
+                self.app.flags.filter(name='NEEDS_UPGRADE').first(), None)
+        finally:
+            shutil.rmtree(pkg.package_path)
+            self.app.flags.delete()
+            pkg.delete()
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_mule_backend_superseded_staging(self):
+        from upaas_admin.apps.tasks.management.commands.mule_backend import \
+            Command
+        old = self.create_unpacked_package('pkg2')
+        new = self.create_unpacked_package('pkg3')
+        try:
+            self.app.stage_package(old)
+            mule = Command()
+            flag = mule.find_flag()
+            self.assertEqual(flag.options['package'], old.safe_id)
+            # newer build replaces staging while old package is unpacked
+            self.app.stage_package(new)
+            mule.process_flag(flag)
+            self.app.reload()
+            self.assertEqual(self.app.current_package.id, self.pkg.id)
+            flag = self.app.flags.filter(name='NEEDS_STAGING').first()
+            self.assertNotEqual(flag, None)
+            self.assertEqual(flag.options['package'], new.safe_id)
+            self.assertEqual(flag.pending_backends, [self.backend])
+            call_command('mule_backend', task_limit=1, ping_disabled=True)
+            self.app.reload()
+            self.assertEqual(self.app.current_package.id, new.id)
+        finally:
+            for pkg in [old, new]:
+                shutil.rmtree(pkg.package_path)
+                pkg.delete()
+            self.app.flags.delete()
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_mule_backend_completes_flag_before_unlock(self):
+        from upaas_admin.apps.tasks.management.commands.mule_backend import \
+            Command
+        pkg = self.create_unpacked_package('pkg2')
+        try:
+            self.app.stage_package(pkg)
+            mule = Command()
+            flag = mule.find_flag()
+            unlock_flag = mule.unlock_flag
+            pending = []
+
+            def check_unlock(locked):
+                pending.append(self.app.flags.filter(
+                    name='NEEDS_STAGING',
+                    pending_backends=self.backend).count())
+                unlock_flag(locked)
+
+            mule.unlock_flag = check_unlock
+            mule.process_flag(flag)
+            self.assertEqual(pending, [0])
+        finally:
+            shutil.rmtree(pkg.package_path)
+            self.app.flags.delete()
+            pkg.delete()
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "create_run_plan")
+    def test_cleanup_stale_staging(self):
+        from bson import ObjectId
+        from upaas_admin.apps.tasks.mule import MuleTaskHelper
+        pkg = self.create_unpacked_package('pkg2')
+        try:
+            self.app.stage_package(pkg)
+            # backend that is not in run plan anymore
+            self.app.flags.filter(name='NEEDS_STAGING').update_one(
+                set__pending_backends=[ObjectId()])
+            self.assertEqual(MuleTaskHelper('Test').clean_stale_staging(), 1)
+            self.app.reload()
+            self.assertEqual(self.app.current_package.id, pkg.id)
+            self.assertEqual(
+                self.app.flags.filter(name='NEEDS_STAGING').first(), None)
+        finally:
+            shutil.rmtree(pkg.package_path)
+            pkg.delete()
+            self.app.flags.delete()
+
+    @pytest.mark.usefixtures("create_backend")
+    def test_cleanup_remote_tasks_index(self):
+        from upaas_admin.apps.servers.models import BackendServer
+        from upaas_admin.apps.tasks.mule import MuleTaskHelper
+        self.assertEqual(
+            MuleTaskHelper('Test').clean_failed_remote_tasks(self.backend), 0)
+        indexes = BackendServer._get_collection().index_information()
+        self.assertTrue([('worker_ping.Test', 1)] in
+                        [index['key'] for index in indexes.values()])
+
+    @pytest.mark.usefixtures("create_app", "create_backend")
+    def test_cleanup_cmd(self):
+        from upaas_admin.apps.applications.constants import NeedsBuildingFlag
+        from upaas_admin.apps.applications.models import FlagLock
+        from upaas_admin.apps.tasks.mule import MuleFlagListener
+        from upaas_admin.apps.tasks.models import Task
+        from upaas_admin.apps.tasks.constants import TaskStatus
+        self.app.build_package()
+        flag = self.app.flags.first()
+        # pid that is not running
+        pid = 2 ** 22 + 1
+        flag.update(set__pending=False, push__locks=FlagLock(
+            backend=self.backend, pid=pid,
+            expires=datetime.now() + timedelta(seconds=600)))
+        task = Task(backend=self.backend, pid=pid, title='crashed',
+                    application=self.app)
+        task.save()
+        listener = MuleFlagListener([NeedsBuildingFlag.name])
+        listener.open()
+        call_command('cleanup')
+        # mules are notified about flags that can be claimed again
+        self.assertTrue(listener.wait(5))
+        task.reload()
+        self.assertEqual(task.status, TaskStatus.failed)
+        flag.reload()
+        self.assertEqual(flag.pending, True)
+        self.assertEqual(flag.locks, [])
+        task.delete()
+        self.app.flags.delete()
+
+    @pytest.mark.usefixtures("create_backend")
+    def test_mule_leader_election(self):
+        from upaas_admin.apps.tasks.models import MuleLeader
+        from upaas_admin.apps.tasks.mule import MuleLeaderElection
+        first = MuleLeaderElection('Test', self.backend, 1)
+        second = MuleLeaderElection('Test', self.backend, 2)
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        self.assertTrue(first.acquire())
+        MuleLeader.objects(name='Test').update_one(
+            set__expires=datetime.now() - timedelta(seconds=1))
+        self.assertTrue(second.acquire())
+        self.assertFalse(first.acquire())
+        second.release()
+        self.assertEqual(MuleLeader.objects(name='Test').count(), 0)
+        self.assertTrue(first.acquire())
+        first.release()
+
+    @pytest.mark.usefixtures("setup_monkeypatch", "create_backend")
+    def test_mule_backend_rebalance_leader_only(self):
+        from upaas_admin.apps.tasks.management.commands.mule_backend import \
+            Command
+        calls = []
+
+        class FakeRebalancer(object):
+            def rebalance(self):
+                calls.append(True)
+                return []
+
+        self.monkeypatch.setattr('upaas_admin.apps.tasks.management.commands.'
+                                 'mule_backend.Rebalancer', FakeRebalancer)
+        mule = Command()
+        mule.rebalance_interval = 60
+        mule.rebalance()
+        self.assertEqual(calls, [])
+        self.assertTrue(mule.leader_election.acquire())
+        mule.rebalance()
+        self.assertEqual(calls, [True])
+        mule.leader_election.release()
+
+    @pytest.mark.usefixtures("create_backend")
+    def test_shared_heartbeat(self):
+        from upaas_admin.apps.servers.models import BackendServer
+        from upaas_admin.apps.tasks.heartbeat import Heartbeat
+        now = [1000.0]
+
+        def clock():
+            return now[0]
+
+        first = Heartbeat(self.backend, interval=60, clock=clock)
+        first.add('First')
+        second = Heartbeat(self.backend, interval=60, clock=clock)
+        second.add('Second')
+        try:
+            self.assertTrue(first.open())
+            self.assertTrue(second.open())
+            self.assertTrue(first.is_writer)
+            self.assertFalse(second.is_writer)
+            # accept connection, then read registration and write pings
+            first.tick()
+            first.tick()
+            self.assertTrue(second.tick())
+            self.assertNotEqual(second.last_write, None)
+            self.backend.reload()
+            self.assertEqual(sorted(self.backend.worker_ping.keys()),
+                             ['First', 'Second'])
+            self.assertTrue(self.backend.is_healthy)
+            self.assertEqual(BackendServer.stale().count(), 0)
+            # next write is only done after interval
+            last_write = first.last_write
+            first.tick()
+            self.assertEqual(first.last_write, last_write)
+            now[0] += 67
+            first.tick()
+            self.assertNotEqual(first.last_write, last_write)
+            # writer is gone, second mule takes over
+            first.close()
+            self.assertTrue(second.tick())
+            self.assertFalse(second.tick(timeout=1))
+            second.close()
+            self.assertTrue(second.open())
+            self.assertTrue(second.is_writer)
+        finally:
+            first.close()
+            second.close()
+
     def test_create_user_cmd(self):
         from upaas_admin.apps.users.models import User
         self.assertEqual(call_command('create_user', login='mylogin',
@@ -8,9 +8,15 @@
 from __future__ import unicode_literals
 
 import os
+import io
+import shutil
+import tarfile
+import hashlib
+import tempfile
 
 import pytest
 
+from django.conf import settings
 from django.core.urlresolvers import reverse
 
 from upaas_admin.common.tests import MongoEngineTestCase
@@ -129,6 +135,18 @@ class PackageTest(MongoEngineTestCase):
     def test_pkg_metadata_config_method(self):
         self.assertNotEqual(self.pkg.metadata_config, {})
 
+    @pytest.mark.usefixtures("create_pkg")
+    def test_pkg_metadata_config_cached(self):
+        from upaas_admin.apps.applications.models import Package
+        config = self.pkg.metadata_config
+        self.assertTrue(self.pkg.metadata_config is config)
+        # other instances share parsed metadata
+        pkg = Package.objects(id=self.pkg.id).first()
+        self.assertTrue(pkg.metadata_config is config)
+        self.pkg.metadata += '\n# changed\n'
+        self.assertFalse(self.pkg.metadata_config is config)
+        self.assertEqual(self.pkg.metadata_config.env, config.env)
+
     @pytest.mark.usefixtures("create_pkg")
     def test_pkg_package_path_method(self):
         self.assertEqual(self.pkg.package_path, '/tmp/%s' % self.pkg.safe_id)
@@ -161,6 +179,44 @@ class PackageTest(MongoEngineTestCase):
         self.assertTrue('cron = -1 -1 -1 -1 -1 pong' in config)
         self.assertTrue('env = UPAAS_STORAGE_MOUNTPOINT=/storage' in config)
 
+    @pytest.mark.usefixtures("create_pkg", "create_backend", "create_router")
+    def test_generate_uwsgi_config_cached(self):
+        from upaas_admin.apps.applications.vassal import renderer
+        self.login_as_user()
+        url = reverse('app_start', args=[self.app.safe_id])
+        resp = self.client.post(url, {'workers_min': 1, 'workers_max': 4})
+        self.assertEqual(resp.status_code, 302)
+        self.app.reload()
+        backend_conf = self.app.run_plan.backends[0]
+        config = self.pkg.generate_uwsgi_config(backend_conf)
+        hits = renderer.rendered.hits
+        self.assertEqual(self.pkg.generate_uwsgi_config(backend_conf),
+                         config)
+        self.assertEqual(renderer.rendered.hits, hits + 1)
+        backend_conf.workers_max += 1
+        config = self.pkg.generate_uwsgi_config(backend_conf)
+        self.assertEqual(renderer.rendered.hits, hits + 1)
+        self.assertTrue('var_max_workers = %d' % backend_conf.workers_max in
+                        config)
+
+    @pytest.mark.usefixtures("create_pkg", "create_backend", "create_router",
+                             "setup_monkeypatch")
+    def test_generate_uwsgi_config_cache_config_change(self):
+        from upaas_admin.apps.applications.vassal import renderer
+        self.login_as_user()
+        url = reverse('app_start', args=[self.app.safe_id])
+        resp = self.client.post(url, {'workers_min': 1, 'workers_max': 4})
+        self.assertEqual(resp.status_code, 302)
+        self.app.reload()
+        backend_conf = self.app.run_plan.backends[0]
+        self.pkg.generate_uwsgi_config(backend_conf)
+        hits = renderer.rendered.hits
+        self.monkeypatch.setattr(settings.UPAAS_CONFIG.apps, 'home',
+                                 '/changed/home')
+        config = self.pkg.generate_uwsgi_config(backend_conf)
+        self.assertEqual(renderer.rendered.hits, hits)
+        self.assertTrue('var_chdir = /changed/home' in config)
+
     @pytest.mark.usefixtures("create_pkg", "create_backend", "create_router")
     def test_save_vassal_config_method(self):
         self.login_as_user()
@@ -184,6 +240,77 @@ class PackageTest(MongoEngineTestCase):
         with pytest.raises(UnpackError):
             self.pkg.unpack()
 
+    @pytest.mark.usefixtures("create_pkg", "setup_monkeypatch")
+    def test_pkg_unpack_checksum_mismatch(self):
+        class FakeStorage(object):
+            def get(self, name, path):
+                with tarfile.open(path, mode='w:gz') as archive:
+                    info = tarfile.TarInfo('evil')
+                    info.size = 2
+                    archive.addfile(info, io.BytesIO(b'ok'))
+
+        self.monkeypatch.setattr(
+            'upaas_admin.apps.applications.models.load_handler',
+            lambda *args: FakeStorage())
+        with pytest.raises(UnpackError):
+            self.pkg.unpack()
+        self.assertFalse(os.path.exists(self.pkg.package_path))
+
+    def test_unpack_tar_sha256(self):
+        from upaas_admin.apps.applications.unpack import unpack_tar_sha256
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'pkg.tar.gz')
+            with tarfile.open(path, mode='w:gz') as archive:
+                info = tarfile.TarInfo('home/file')
+                info.size = 2
+                archive.addfile(info, io.BytesIO(b'ok'))
+            workdir = os.path.join(directory, 'system')
+            os.mkdir(workdir)
+            with open(path, 'rb') as archive:
+                checksum = hashlib.sha256(archive.read()).hexdigest()
+            self.assertEqual(unpack_tar_sha256(path, workdir), checksum)
+            self.assertTrue(os.path.isfile(os.path.join(workdir, 'home',
+                                                        'file')))
+            with open(path, 'wb') as archive:
+                archive.write(b'not an archive')
+            self.assertEqual(unpack_tar_sha256(path, workdir), None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_package_cache(self):
+        from upaas_admin.apps.applications.package_cache import PackageCache
+        directory = tempfile.mkdtemp()
+        fetched = []
+
+        def _fetch(path):
+            fetched.append(path)
+            with open(path, 'wb') as archive:
+                archive.write(b'x' * 10)
+
+        try:
+            cache = PackageCache(directory, 25)
+            first = cache.fetch('a', _fetch)
+            self.assertEqual(cache.fetch('a', _fetch), first)
+            self.assertEqual(len(fetched), 1)
+            os.utime(first, (1, 1))
+            cache.fetch('b', _fetch)
+            self.assertTrue(os.path.isfile(first))
+            # cache is full, least recently used archive is evicted
+            cache.fetch('c', _fetch)
+            self.assertFalse(os.path.isfile(first))
+            self.assertEqual(len(cache.entries()), 2)
+            cache.remove('b')
+            self.assertEqual(len(cache.entries()), 1)
+            # linked archive stays after it was evicted from cache
+            linked = os.path.join(directory, 'linked')
+            cache.link('c', _fetch, linked)
+            cache.remove('c')
+            self.assertTrue(os.path.isfile(linked))
+            self.assertEqual(len(fetched), 3)
+        finally:
+            shutil.rmtree(directory)
+
     @pytest.mark.usefixtures("create_pkg")
     def test_pkg_delete_package_file_missing_method(self):
         self.pkg.delete_package_file()
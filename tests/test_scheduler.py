@@ -7,12 +7,28 @@
 
 from __future__ import unicode_literals
 
+from datetime import datetime, timedelta
+
 import pytest
 
+from bson import ObjectId
+
 from upaas_admin.common.tests import MongoEngineTestCase
-from upaas_admin.apps.scheduler.models import ApplicationRunPlan
-from upaas_admin.apps.scheduler.base import Scheduler
-from upaas_admin.apps.servers.models import BackendServer
+from upaas_admin.apps.scheduler.models import (ApplicationRunPlan,
+                                               BackendRunPlanSettings,
+                                               BackendLoadStats, LoadSample)
+from upaas_admin.apps.scheduler.base import Scheduler, DomainCounts
+from upaas_admin.apps.scheduler.ledger import AllocationLedger, ledger
+from upaas_admin.apps.scheduler.scoring import (WeightedScorer,
+                                                DominantResourceScorer,
+                                                get_scorer)
+from upaas_admin.apps.scheduler.simulation import ClusterSnapshot, simulate
+from upaas_admin.apps.scheduler.stats import StatsCollector
+from upaas_admin.apps.scheduler.rebalance import Rebalancer
+from upaas_admin.apps.applications.constants import (IsStartingFlag,
+                                                     NeedsStoppingFlag)
+from upaas_admin.apps.servers.models import (BackendServer, PortAllocator,
+                                             PortReservation)
 
 
 class SchedulerTest(MongoEngineTestCase):
@@ -97,3 +113,317 @@ class SchedulerTest(MongoEngineTestCase):
         self.create_backend(1, 2, 2048)
         self.create_backend(2, 1, 1024)
         self.backends_count_check(2, 32, [(1, 11), (1, 21)])
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "delete_backends")
+    def test_scheduler_live_load(self):
+        hot = self.create_backend(1, 2, 2048)
+        cold = self.create_backend(2, 2, 2048)
+        now = datetime.now()
+        BackendLoadStats.add_sample(hot, LoadSample(
+            timestamp=now - timedelta(seconds=3600), rss=128, requests=1,
+            busy=0))
+        for rss, requests in [(1500, 300), (1700, 500)]:
+            BackendLoadStats.add_sample(hot, LoadSample(
+                timestamp=now, rss=rss, requests=requests, busy=2))
+        self.assertEqual(BackendLoadStats.observed_load([hot, cold]),
+                         {hot.safe_id: (1600, 400)})
+
+        run_plan = self.create_run_plan(1, 1)
+        backends = Scheduler(live_load=False).find_backends(run_plan)
+        self.assertEqual(backends[0].backend.id, hot.id)
+        backends = Scheduler(live_load=True).find_backends(run_plan)
+        self.assertEqual(backends[0].backend.id, cold.id)
+        BackendLoadStats.objects.delete()
+
+    @pytest.mark.usefixtures("create_app", "create_pkg", "delete_backends")
+    def test_rebalance(self):
+        overloaded = self.create_backend(1, 1, 512)
+        idle = self.create_backend(2, 4, 4096)
+        run_plan = self.create_run_plan(4, 4)
+        run_plan.backends = [BackendRunPlanSettings(
+            backend=overloaded, package=self.pkg, socket=8080, stats=9090,
+            workers_min=4, workers_max=4)]
+        run_plan.save()
+        self.app.update(set__run_plan=run_plan)
+        self.app.reload()
+
+        moves = Rebalancer(max_moves=1).plan()
+        self.assertEqual(len(moves), 1)
+        self.assertEqual(moves[0].source.id, overloaded.id)
+        self.assertEqual(moves[0].target.id, idle.id)
+
+        self.assertEqual(len(Rebalancer(max_moves=1).rebalance()), 1)
+        run_plan.reload()
+        self.assertEqual(len(run_plan.backends), 2)
+        self.assertTrue(run_plan.backend_settings(overloaded).draining)
+        self.assertFalse(run_plan.backend_settings(idle).draining)
+        self.assertTrue(run_plan.is_valid())
+        flag = self.app.flags.filter(name=IsStartingFlag.name).first()
+        self.assertEqual(flag.pending_backends, [idle])
+
+        # move in progress counts towards the limit
+        self.assertEqual(Rebalancer(max_moves=1).plan(), [])
+
+        self.app.reload()
+        self.app.stop_draining_backends()
+        flag = self.app.flags.filter(name=NeedsStoppingFlag.name).first()
+        self.assertEqual(flag.pending_backends, [overloaded])
+        self.app.flags.delete()
+        run_plan.delete()
+
+    def test_stats_collector_request_rate(self):
+        collector = StatsCollector(None)
+        now = datetime.now()
+        self.assertEqual(collector.request_rate('app', now, 100), 0)
+        self.assertEqual(collector.request_rate(
+            'app', now + timedelta(seconds=10), 150), 5)
+        # counter reset after restart
+        self.assertEqual(collector.request_rate(
+            'app', now + timedelta(seconds=20), 10), 0)
+
+    def test_allocation_ledger_rows(self):
+        allocations = AllocationLedger()
+        self.assertTrue(allocations.is_stale)
+        allocations.load_rows([('plan1', 'app1', 'backend1', 2, 256),
+                               ('plan1', 'app1', 'backend2', 1, 128),
+                               ('plan2', 'app2', 'backend1', 4, 1024)])
+        self.assertFalse(allocations.is_stale)
+        self.assertEqual(allocations.allocations(),
+                         {'backend1': (6, 1280), 'backend2': (1, 128)})
+        self.assertEqual(
+            allocations.allocations(exclude_applications=['app1']),
+            {'backend1': (4, 1024), 'backend2': (0, 0)})
+        allocations.release('plan2', 'backend1')
+        self.assertEqual(allocations.allocations(),
+                         {'backend1': (2, 256), 'backend2': (1, 128)})
+        allocations.charge('plan1', 'backend2', 3, 384)
+        self.assertEqual(allocations.allocations(),
+                         {'backend1': (2, 256), 'backend2': (3, 384)})
+
+    @pytest.mark.usefixtures("create_run_plan")
+    def test_allocation_ledger_incremental(self):
+        ledger.invalidate()
+        scheduler = Scheduler()
+        scheduler.calculate_scores()
+        self.assertEqual(scheduler.allocated_cpu[self.backend.safe_id], 4)
+        self.assertEqual(scheduler.allocated_mem[self.backend.safe_id], 512)
+        scheduler.calculate_scores(exclude_applications=[self.app])
+        self.assertEqual(scheduler.allocated_cpu[self.backend.safe_id], 0)
+
+        self.run_plan.remove_backend_settings(self.backend)
+        self.assertFalse(ledger.is_stale)
+        self.assertEqual(ledger.allocations().get(self.backend.safe_id),
+                         (0, 0))
+
+        self.run_plan.append_backend_settings(BackendRunPlanSettings(
+            backend=self.backend, package=self.pkg, socket=8080, stats=9090,
+            workers_min=1, workers_max=2))
+        self.assertEqual(ledger.allocations().get(self.backend.safe_id),
+                         (2, 256))
+
+    @pytest.mark.usefixtures("create_run_plan")
+    def test_allocation_ledger_reload(self):
+        scheduler = Scheduler()
+        scheduler.calculate_scores()
+        self.assertEqual(scheduler.allocated_cpu[self.backend.safe_id], 4)
+        self.assertFalse(ledger.is_stale)
+        # run plan modified by other process, ledger isn't updated
+        ApplicationRunPlan._get_collection().update(
+            {'_id': self.run_plan.id}, {'$set': {'backends.0.workers_max': 2}})
+        self.assertEqual(ledger.allocations().get(self.backend.safe_id)[0], 4)
+        scheduler = Scheduler()
+        scheduler.calculate_scores()
+        self.assertEqual(scheduler.allocated_cpu[self.backend.safe_id], 2)
+        self.assertEqual(scheduler.allocated_mem[self.backend.safe_id], 256)
+
+    @pytest.mark.usefixtures("create_run_plan")
+    def test_port_allocator(self):
+        allocator = PortAllocator(self.backend)
+        allocator.load()
+        self.assertTrue(allocator.is_used(8080))
+        self.assertTrue(allocator.is_used(9090))
+        self.assertEqual(allocator.used, 2)
+
+        ports = allocator.allocate(10)
+        self.assertEqual(len(set(ports)), 10)
+        for port in ports:
+            self.assertTrue(self.backend.port_min <= port <=
+                            self.backend.port_max)
+            self.assertFalse(port in [8080, 9090])
+        self.assertEqual(sorted(PortReservation.reserved_ports(self.backend)),
+                         sorted(ports))
+
+        # reservation is visible to other allocators
+        other = PortAllocator(self.backend)
+        other.load()
+        self.assertEqual(other.used, 12)
+        self.assertTrue(other.is_used(ports[0]))
+        other.mark_used([p for p in range(other.port_min, other.port_max + 1)
+                         if p not in ports[:2]])
+        self.assertEqual(other.allocate(1), None)
+
+        allocator.release(ports)
+        self.assertEqual(PortReservation.reserved_ports(self.backend), [])
+        self.assertEqual(allocator.used, 2)
+
+    @pytest.mark.usefixtures("setup_monkeypatch", "create_run_plan")
+    def test_schedule_many_releases_failed_placement(self):
+        # no ports can be allocated, so run plan can't be placed anywhere
+        self.monkeypatch.setattr(PortAllocator, 'allocate',
+                                 lambda allocator, count: None)
+        self.run_plan.update(set__backends=[])
+        self.run_plan.reload()
+        initial = Scheduler()
+        initial.calculate_scores(exclude_applications=[self.app])
+        scheduler = Scheduler()
+        results = scheduler.schedule_many([self.run_plan])
+        self.assertEqual(results, [(self.run_plan, [])])
+        self.assertEqual(scheduler.allocated_cpu, initial.allocated_cpu)
+        self.assertEqual(scheduler.allocated_mem, initial.allocated_mem)
+        self.assertEqual(scheduler.allocated_ports, initial.allocated_ports)
+
+    @pytest.mark.usefixtures("create_backend")
+    def test_scheduler_release_ports(self):
+        scheduler = Scheduler()
+        scheduler.calculate_scores()
+        allocator = scheduler.port_allocator(self.backend)
+        used = allocator.used
+        ports = allocator.allocate(2)
+        self.assertEqual(allocator.used, used + 2)
+        scheduler.release_ports(BackendRunPlanSettings(
+            backend=self.backend, socket=ports[0], stats=ports[1]))
+        self.assertEqual(allocator.used, used)
+        self.assertEqual(PortReservation.reserved_ports(self.backend), [])
+
+    @pytest.mark.usefixtures("create_run_plan")
+    def test_used_ports_summary(self):
+        self.backend.reload()
+        self.assertEqual(sorted(self.backend.allocated_ports), [8080, 9090])
+        self.assertEqual(self.backend.ports_available,
+                         self.backend.maximum_ports - 2)
+
+        backend_conf = self.run_plan.backend_settings(self.backend)
+        self.run_plan.replace_backend_settings(self.backend, backend_conf,
+                                               socket=8081, stats=9091)
+        self.backend.reload()
+        self.assertEqual(sorted(self.backend.allocated_ports), [8081, 9091])
+
+        self.backend.update(set__used_ports=[1234])
+        self.backend.reload()
+        self.assertEqual(self.backend.rebuild_used_ports(),
+                         ([8081, 9091], [1234]))
+        self.assertEqual(sorted(self.backend.allocated_ports), [8081, 9091])
+
+        self.run_plan.remove_backend_settings(self.backend)
+        self.backend.reload()
+        self.assertEqual(self.backend.allocated_ports, [])
+
+    @pytest.mark.usefixtures("create_run_plan")
+    def test_used_ports_summary_save(self):
+        backend_conf = self.run_plan.backend_settings(self.backend)
+        backend_conf.socket = 8081
+        backend_conf.stats = 9091
+        self.run_plan.save()
+        self.backend.reload()
+        self.assertEqual(sorted(self.backend.used_ports), [8081, 9091])
+
+        self.run_plan.backends = []
+        self.run_plan.save()
+        self.backend.reload()
+        self.assertEqual(self.backend.used_ports, [])
+
+
+class SchedulerScoringTest(MongoEngineTestCase):
+
+    def create_snapshot(self):
+        backends = [
+            {'id': str(ObjectId()), 'name': 'cpu-saturated', 'cpu_cores': 2,
+             'memory_mb': 16384, 'used_ports': [2001, 2002]},
+            {'id': str(ObjectId()), 'name': 'memory-loaded', 'cpu_cores': 8,
+             'memory_mb': 8192, 'used_ports': [2001, 2002]},
+            {'id': str(ObjectId()), 'name': 'empty', 'cpu_cores': 4,
+             'memory_mb': 4096, 'used_ports': []},
+        ]
+        allocations = [
+            ['plan1', 'app1', backends[0]['id'], 8, 1024],
+            ['plan2', 'app2', backends[1]['id'], 2, 4096],
+        ]
+        run_plans = [
+            {'application': 'app3', 'workers_min': 1, 'workers_max': 4,
+             'memory_per_worker': 128},
+            {'application': 'app4', 'workers_min': 2, 'workers_max': 2,
+             'memory_per_worker': 256},
+        ]
+        return ClusterSnapshot(backends=backends, allocations=allocations,
+                               run_plans=run_plans)
+
+    def test_scorers(self):
+        scorer = WeightedScorer(cpu=1, memory=1, ports=0)
+        self.assertEqual(scorer.score(1.0, 0.0, 0.5), 0.5)
+        self.assertEqual(WeightedScorer(cpu=0, memory=0, ports=0).score(
+            1.0, 1.0, 1.0), 0)
+        scorer = DominantResourceScorer(cpu=1, memory=1, ports=1)
+        self.assertEqual(scorer.score(0.2, 0.7, 0.1), 0.7)
+        self.assertEqual(get_scorer().name, 'weighted')
+        self.assertEqual(get_scorer('dominant').name, 'dominant')
+        self.assertRaises(ValueError, get_scorer, 'missing')
+
+    def test_cpu_saturated_backend_is_avoided(self):
+        snapshot = self.create_snapshot()
+        snapshot.backends = snapshot.backends[:2]
+        for scorer in [get_scorer('weighted'), get_scorer('dominant')]:
+            scheduler = snapshot.create_scheduler(scorer)
+            scheduler.calculate_scores()
+            plan_min, plan_max = scheduler.plan_workers(1, 1, 128)
+            self.assertEqual(list(plan_max.keys()),
+                             [snapshot.backends[1]['id']])
+
+    def test_spread_by_rack(self):
+        backends = []
+        allocations = []
+        for idx, rack in enumerate(['r1', 'r1', 'r1', 'r2', 'r2', 'r3']):
+            backends.append({'id': str(ObjectId()), 'name': 'b%d' % idx,
+                             'cpu_cores': 4, 'memory_mb': 4096,
+                             'used_ports': [], 'rack': rack})
+            if rack != 'r1':
+                allocations.append(['plan%d' % idx, 'app%d' % idx,
+                                    backends[-1]['id'], 1, 128])
+        snapshot = ClusterSnapshot(backends=backends, allocations=allocations)
+        racks = dict((b['id'], b['rack']) for b in backends)
+
+        scheduler = snapshot.create_scheduler(get_scorer())
+        scheduler.calculate_scores()
+        plan_min, plan_max = scheduler.plan_workers(9, 9, 128)
+        self.assertEqual([racks[bid] for bid in plan_max], ['r1'] * 3)
+
+        scheduler = snapshot.create_scheduler(get_scorer())
+        scheduler.calculate_scores()
+        plan_min, plan_max = scheduler.plan_workers(9, 9, 128,
+                                                    spread_by='rack')
+        self.assertEqual(sorted([racks[bid] for bid in plan_max]),
+                         ['r1', 'r2', 'r3'])
+
+    def test_domain_counts(self):
+        counts = DomainCounts('rack', {'a': 'r1', 'b': 'r1', 'c': 'r2',
+                                       'd': 'backend:d'})
+        self.assertEqual(counts.crowded_backends(), set())
+        counts.add('a')
+        self.assertEqual(counts.crowded_backends(), set(['b']))
+        counts.add('c')
+        counts.add('c')
+        self.assertEqual(counts.crowded_backends(), set(['b']))
+        counts.add('d')
+        self.assertEqual(counts.crowded_backends(), set())
+        self.assertEqual(counts.used, {'r1': 1, 'r2': 1, 'backend:d': 1})
+
+    def test_simulation(self):
+        snapshot = self.create_snapshot()
+        for scorer in [get_scorer('weighted'), get_scorer('dominant')]:
+            result = simulate(snapshot, scorer)
+            summary = result.summary()
+            self.assertEqual(summary['placed'], 2)
+            self.assertEqual(summary['failed'], 0)
+            self.assertEqual(sum(result.placements['app3'].values()), 4)
+            self.assertEqual(sum(result.placements['app4'].values()), 2)
+            self.assertEqual(sum(result.scheduler.allocated_cpu.values()),
+                             8 + 2 + 4 + 2)
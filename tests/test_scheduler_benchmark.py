@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import random
+from operator import itemgetter
+from timeit import default_timer
+
+import pytest
+
+from bson import ObjectId
+
+from upaas_admin.common.tests import MongoEngineTestCase
+from upaas_admin.apps.scheduler.base import Scheduler
+from upaas_admin.apps.scheduler.ledger import AllocationLedger
+from upaas_admin.apps.servers.models import BackendServer
+
+
+def select_best_backend_sorted(scheduler, plan, min_backends, max_backends):
+    """
+    Reference implementation sorting all scores on every call.
+    """
+    for bid, __ in sorted(scheduler.scores.items(), key=itemgetter(1, 0)):
+        if bid in plan and len(plan.keys()) < min_backends:
+            continue
+        elif bid not in plan and len(plan.keys()) >= max_backends:
+            continue
+        return bid
+
+
+class SchedulerBenchmarkTest(MongoEngineTestCase):
+
+    backends_count = 1000
+    workers = 128
+    memory_per_worker = 128
+
+    def create_scheduler(self):
+        rand = random.Random(1)
+        backends = []
+        rows = []
+        for idx in range(0, self.backends_count):
+            backend = BackendServer(id=ObjectId(), name='backend%d' % idx,
+                                    ip='10.0.%d.%d' % (idx / 256, idx % 256),
+                                    cpu_cores=rand.choice([4, 8, 16]),
+                                    memory_mb=rand.choice([8192, 16384]))
+            backends.append(backend)
+            rows.append(('plan%d' % idx, 'app%d' % idx, backend.safe_id,
+                         rand.randint(0, 16),
+                         rand.randint(0, 16) * self.memory_per_worker))
+        allocations = AllocationLedger(max_age=None)
+        allocations.load_rows(rows)
+        scheduler = Scheduler(allocations=allocations, backends=backends)
+        scheduler.calculate_scores()
+        return scheduler
+
+    def place(self, scheduler, select):
+        plan = {}
+        placements = []
+        min_backends, max_backends = scheduler.backends_range(self.workers)
+        started = default_timer()
+        for __ in range(0, self.workers):
+            bid = select(plan, min_backends, max_backends)
+            plan[bid] = plan.get(bid, 0) + 1
+            scheduler.charge(bid, self.memory_per_worker)
+            placements.append(bid)
+        return placements, default_timer() - started
+
+    def test_select_best_backend_matches_sorted(self):
+        scheduler = self.create_scheduler()
+        heap_placements, __ = self.place(scheduler,
+                                         scheduler.select_best_backend)
+
+        scheduler = self.create_scheduler()
+        sorted_placements, __ = self.place(
+            scheduler, lambda *args: select_best_backend_sorted(scheduler,
+                                                                *args))
+
+        self.assertEqual(heap_placements, sorted_placements)
+
+    @pytest.mark.benchmark
+    def test_select_best_backend_benchmark(self):
+        scheduler = self.create_scheduler()
+        __, heap_time = self.place(scheduler, scheduler.select_best_backend)
+
+        scheduler = self.create_scheduler()
+        __, sorted_time = self.place(
+            scheduler, lambda *args: select_best_backend_sorted(scheduler,
+                                                                *args))
+
+        self.assertLess(heap_time, sorted_time,
+                        "select_best_backend() for %d backends x %d workers: "
+                        "heap=%.4fs sorted=%.4fs" % (
+                            self.backends_count, self.workers, heap_time,
+                            sorted_time))
@@ -15,3 +15,31 @@ class UWSGITest(MongoEngineTestCase):
     def test_uwsgi_stats_invalid(self):
         from upaas_admin.common.uwsgi import fetch_json_stats
         self.assertEqual(fetch_json_stats('127.0.0.1', 65000), None)
+
+    def test_uwsgi_stats_generation(self):
+        from upaas_admin.common.uwsgi import (stats_generation,
+                                              generation_changed)
+        self.assertEqual(stats_generation(None), None)
+        self.assertEqual(stats_generation(True), None)
+        stats = {'pid': 100, 'workers': [{'pid': 101, 'last_spawn': 10},
+                                         {'pid': 0, 'status': 'cheap'}]}
+        old = stats_generation(stats)
+        self.assertEqual(old, (100, frozenset([101])))
+        # cheaper subsystem spawned worker in the same second
+        stats['workers'][1] = {'pid': 102, 'last_spawn': 10}
+        self.assertFalse(generation_changed(old, stats_generation(stats)))
+        # workers reloaded in the same second
+        stats['workers'] = [{'pid': 103, 'last_spawn': 10},
+                            {'pid': 104, 'last_spawn': 10}]
+        self.assertTrue(generation_changed(old, stats_generation(stats)))
+        stats = {'pid': 200, 'workers': [{'pid': 101}]}
+        self.assertTrue(generation_changed(old, stats_generation(stats)))
+
+    def test_uwsgi_stats_ready(self):
+        from upaas_admin.common.uwsgi import stats_ready
+        self.assertFalse(stats_ready(None))
+        self.assertTrue(stats_ready(True))
+        self.assertFalse(stats_ready({'pid': 1, 'workers': [
+            {'status': 'cheap'}]}))
+        self.assertTrue(stats_ready({'pid': 1, 'workers': [
+            {'status': 'cheap'}, {'status': 'idle'}]}))
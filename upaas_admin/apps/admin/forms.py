@@ -61,5 +61,5 @@ class AdminBackendForm(MongoForm):
 
     class Meta:
         document = BackendServer
-        exclude = ('date_created', 'worker_ping')
+        exclude = ('date_created', 'worker_ping', 'last_ping', 'used_ports')
         formfield_generator = ContribFormFieldGenerator
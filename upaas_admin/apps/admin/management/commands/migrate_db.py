@@ -17,7 +17,8 @@ from mongoengine import (Document, EmbeddedDocument, QuerySetManager,
 from django.core.management.base import BaseCommand
 
 from upaas_admin.common.fields import IPv4Field
-from upaas_admin.apps.applications.models import Application, ApplicationDomain
+from upaas_admin.apps.applications.models import (
+    Application, ApplicationDomain, ApplicationFlag)
 from upaas_admin.apps.scheduler.models import ApplicationRunPlan
 from upaas_admin.apps.servers.models import RouterServer, BackendServer
 
@@ -97,9 +98,20 @@ class Command(BaseCommand):
     def migrate_backends(self):
         for backend in BackendServer.objects():
             backend.update(unset__worker_ping=True)
+            missing, unexpected = backend.rebuild_used_ports()
+            if missing or unexpected:
+                log.info("Rebuilt used ports summary for %s" % backend.name)
+
+    def migrate_flag_locks(self):
+        # flag locks are now stored in ApplicationFlag documents
+        db = ApplicationFlag._get_db()
+        if 'flag_lock' in db.collection_names():
+            log.info("Dropping old flag lock collection")
+            db.drop_collection('flag_lock')
 
     def handle(self, *args, **options):
         self.migrate_domains()
         self.migrate_run_plans()
         self.migrate_routers()
         self.migrate_backends()
+        self.migrate_flag_locks()
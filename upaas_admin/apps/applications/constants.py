@@ -29,6 +29,11 @@ class NeedsUpgradeFlag:
     title = _('Upgrading application instance')
 
 
+class NeedsStagingFlag:
+    name = 'NEEDS_STAGING'
+    title = _('Staging application package')
+
+
 class NeedsStoppingFlag:
     name = 'NEEDS_STOPPING'
     title = _('Stopping application instance')
@@ -48,6 +53,7 @@ FLAGS_BY_NAME = {
     NeedsBuildingFlag.name: NeedsBuildingFlag,
     IsStartingFlag.name: IsStartingFlag,
     NeedsUpgradeFlag.name: NeedsUpgradeFlag,
+    NeedsStagingFlag.name: NeedsStagingFlag,
     NeedsStoppingFlag.name: NeedsStoppingFlag,
     NeedsRestartFlag.name: NeedsRestartFlag,
     NeedsReschedulingFlag.name: NeedsReschedulingFlag,
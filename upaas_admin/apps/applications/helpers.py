@@ -13,14 +13,52 @@ from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
 from upaas.utils import load_handler
+from upaas.checksum import calculate_string_sha256
 from upaas.config.base import ConfigurationError
+from upaas.config.metadata import MetadataConfig
 
 from upaas_admin.apps.applications import constants as flags
+from upaas_admin.common.cache import LRUCache
 
 
 log = logging.getLogger(__name__)
 
 
+# sha256 of metadata -> parsed metadata, shared by all documents
+metadata_cache = LRUCache()
+
+
+def parse_metadata(metadata):
+    """
+    Parse metadata string, parsed configs are cached in process wide cache
+    (if enabled), they are shared and must not be modified.
+    """
+    size = settings.UPAAS_CONFIG.apps.metadata_cache
+    if not size:
+        return MetadataConfig.from_string(metadata)
+    metadata_cache.max_size = size
+    key = calculate_string_sha256(metadata)
+    config = metadata_cache.get(key)
+    if config is None:
+        config = MetadataConfig.from_string(metadata)
+        metadata_cache.set(key, config)
+    return config
+
+
+def document_metadata_config(document):
+    """
+    Returns parsed metadata of application or package, it's memoized on
+    document and parsed again only after metadata was changed.
+    """
+    if not document.metadata:
+        return {}
+    cached = getattr(document, '_metadata_config', None)
+    if cached is None or cached[0] != document.metadata:
+        cached = (document.metadata, parse_metadata(document.metadata))
+        document._metadata_config = cached
+    return cached[1]
+
+
 class ApplicationStateHelper(object):
 
     def __init__(self, application):
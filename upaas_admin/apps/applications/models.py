@@ -10,24 +10,23 @@ import os
 import datetime
 import logging
 import tempfile
-import shutil
 import time
-import re
-from copy import deepcopy
 
-from mongoengine import (Document, DateTimeField, StringField, LongField,
-                         ReferenceField, ListField, DictField, QuerySetManager,
-                         BooleanField, IntField, NULLIFY, signals)
+from bson import ObjectId
+
+from mongoengine import (Document, EmbeddedDocument, DateTimeField,
+                         StringField, LongField, ReferenceField, ListField,
+                         DictField, QuerySetManager, BooleanField, IntField,
+                         EmbeddedDocumentField, NULLIFY, NotUniqueError,
+                         Q, signals)
+from mongoengine.queryset import QuerySet
 
 from django.utils.translation import ugettext as _
 from django.core.urlresolvers import reverse
 from django.conf import settings
 
 from upaas import utils
-from upaas import tar
 from upaas.checksum import calculate_file_sha256, calculate_string_sha256
-from upaas.config.base import UPAAS_CONFIG_DIRS
-from upaas.config.metadata import MetadataConfig
 from upaas.storage.exceptions import StorageError
 from upaas import processes
 from upaas.utils import load_handler
@@ -36,13 +35,18 @@ from upaas_admin.apps.servers.models import RouterServer, BackendServer
 from upaas_admin.apps.scheduler.models import ApplicationRunPlan
 from upaas_admin.apps.applications.exceptions import UnpackError
 from upaas_admin.apps.scheduler.base import Scheduler
+from upaas_admin.apps.scheduler.ledger import ledger
 from upaas_admin.apps.tasks.constants import TaskStatus
 from upaas_admin.apps.tasks.models import Task
 from upaas_admin.apps.applications.constants import (
     NeedsBuildingFlag, NeedsStoppingFlag, NeedsRestartFlag, IsStartingFlag,
-    NeedsUpgradeFlag, FLAGS_BY_NAME)
+    NeedsUpgradeFlag, NeedsStagingFlag, FLAGS_BY_NAME)
 from upaas_admin.apps.applications.helpers import (
-    ApplicationStateHelper, ApplicationFeatureHelper)
+    ApplicationStateHelper, ApplicationFeatureHelper,
+    document_metadata_config)
+from upaas_admin.apps.applications.vassal import renderer as vassal_renderer
+from upaas_admin.apps.applications.package_cache import PackageCache
+from upaas_admin.apps.applications.unpack import unpack_tar_sha256
 
 
 log = logging.getLogger(__name__)
@@ -97,9 +101,7 @@ class Package(Document):
 
     @property
     def metadata_config(self):
-        if self.metadata:
-            return MetadataConfig.from_string(self.metadata)
-        return {}
+        return document_metadata_config(self)
 
     @property
     def upaas_config(self):
@@ -144,17 +146,17 @@ class Package(Document):
             del self.filename
             self.save()
 
-    def uwsgi_options_from_metadata(self):
+    def uwsgi_options_from_metadata(self, metadata=None):
         """
         Parse uWSGI options in metadata (if any) and return only allowed.
         """
         options = []
-        compiled = []
-
-        for regexp in self.upaas_config.apps.uwsgi.safe_options:
-            compiled.append(re.compile(regexp))
+        compiled = vassal_renderer.safe_option_filters(
+            self.upaas_config.apps.uwsgi.safe_options)
+        if metadata is None:
+            metadata = self.metadata_config
 
-        for opt in self.metadata_config.uwsgi.settings:
+        for opt in metadata.uwsgi.settings:
             if '=' in opt:
                 for regexp in compiled:
                     opt_name = opt.split('=')[0].rstrip(' ')
@@ -166,26 +168,11 @@ class Package(Document):
 
         return options
 
-    def generate_uwsgi_config(self, backend_conf):
+    def uwsgi_templates(self):
         """
-        :param backend_conf: BackendRunPlanSettings instance for which we
-                             generate config
+        Returns paths of base and interpreter uWSGI templates.
         """
-
-        def _load_template(path):
-            log.debug("Loading uWSGI template from: %s" % path)
-            for search_path in UPAAS_CONFIG_DIRS:
-                template_path = os.path.join(search_path, path)
-                if os.path.exists(template_path):
-                    f = open(template_path)
-                    ret = f.read().splitlines()
-                    f.close()
-                    return ret
-            return []
-
-        # so it won't change while generating configuration
-        config = deepcopy(self.upaas_config)
-
+        config = self.upaas_config
         base_template = config.interpreters['uwsgi']['template']
 
         template = None
@@ -206,6 +193,40 @@ class Package(Document):
             if template_version:
                 template = template_version
 
+        return base_template, template
+
+    def generate_uwsgi_config(self, backend_conf, routers=None,
+                              custom_domains=None):
+        """
+        Returns list of vassal config lines, configs are cached and only
+        rendered if any input has changed.
+
+        :param backend_conf: BackendRunPlanSettings instance for which we
+                             generate config
+        :param routers: list of enabled routers, fetched if not passed
+        :param custom_domains: list of application custom domains, fetched
+                               if not passed
+        """
+        if routers is None:
+            routers = RouterServer.objects(is_enabled=True)
+        if custom_domains is None:
+            custom_domains = self.application.custom_domains
+        return vassal_renderer.render(self, backend_conf, list(routers),
+                                      list(custom_domains))
+
+    def render_uwsgi_config(self, backend_conf, routers, custom_domains,
+                            templates):
+        """
+        Render vassal config, use generate_uwsgi_config() which caches
+        rendered configs.
+
+        :param templates: base and interpreter template paths
+        """
+        config = self.upaas_config
+        metadata = self.metadata_config
+        features = self.application.feature_helper.load_enabled_features()
+        base_template, template = templates
+
         max_memory = backend_conf.workers_max
         max_memory *= self.application.run_plan.memory_per_worker
         max_memory *= 1024 * 1024
@@ -265,8 +286,7 @@ class Package(Document):
             pass
         # interpreter settings from metadata
         try:
-            for key, val in list(
-                    self.metadata_config.interpreter.settings.items()):
+            for key, val in list(metadata.interpreter.settings.items()):
                 var_name = "meta_%s_%s" % (self.interpreter_name, key)
                 variables[var_name] = val
         except KeyError:
@@ -283,7 +303,7 @@ class Package(Document):
                 self.interpreter_version]['env'])
         except (AttributeError, KeyError):
             pass
-        envs.update(self.metadata_config.env)
+        envs.update(metadata.env)
 
         plugin = None
         try:
@@ -303,7 +323,7 @@ class Package(Document):
         for key, value in list(variables.items()):
             options.append('var_%s = %s' % (key, value))
 
-        for feature in self.application.feature_helper.load_enabled_features():
+        for feature in features:
             envs = feature.update_env(self.application, envs)
 
         options.append('\n# starting ENV variables list')
@@ -311,12 +331,12 @@ class Package(Document):
             options.append('env = %s=%s' % (key, value))
         options.append(
             'env = UPAAS_SYSTEM_DOMAIN=%s' % self.application.system_domain)
-        if self.application.custom_domains:
+        if custom_domains:
             options.append('env = UPAAS_CUSTOM_DOMAINS=%s' % ','.join(
-                [d.name for d in self.application.custom_domains]))
+                [d.name for d in custom_domains]))
 
         options.append('\n# starting options from app metadata')
-        for opt in self.uwsgi_options_from_metadata():
+        for opt in self.uwsgi_options_from_metadata(metadata):
             options.append(opt)
 
         # enable cheaper mode if we have multiple workers
@@ -325,7 +345,7 @@ class Package(Document):
             options.append('cheaper = %d' % backend_conf.workers_min)
 
         options.append('\n# starting base template')
-        options.extend(_load_template(base_template))
+        options.extend(vassal_renderer.templates.load(base_template))
 
         if config.apps.graphite.carbon:
             options.append('\n# starting carbon servers block')
@@ -337,21 +357,21 @@ class Package(Document):
             options.append('plugin = %s' % plugin)
 
         options.append('\n# starting interpreter template')
-        options.extend(_load_template(template))
+        options.extend(vassal_renderer.templates.load(template))
 
         options.append('\n# starting subscriptions block')
-        for router in RouterServer.objects(is_enabled=True):
+        for router in routers:
             options.append('subscribe2 = server=%s:%d,key=%s' % (
                 router.subscription_ip, router.subscription_port,
                 self.application.system_domain))
-            for domain in self.application.custom_domains:
+            for domain in custom_domains:
                 options.append('subscribe2 = server=%s:%d,key=%s' % (
                     router.subscription_ip, router.subscription_port,
                     domain.name))
 
         options.append('\n')
 
-        for feature in self.application.feature_helper.load_enabled_features():
+        for feature in features:
             options = feature.update_vassal(self.application, options)
 
         options.append('\n')
@@ -371,55 +391,90 @@ class Package(Document):
         return False
 
     def save_vassal_config(self, backend):
+        """
+        Write vassal config file, returns False if config is already up to
+        date and it wasn't rewritten.
+        """
         log.info(_("Generating uWSGI vassal configuration"))
         options = "\n".join(self.generate_uwsgi_config(backend))
 
         if self.check_vassal_config(options):
             log.info("Vassal is present and valid, skipping rewrite")
-            return
+            return False
 
         log.info(_("Saving vassal configuration to {path}").format(
             path=self.application.vassal_path))
         with open(self.application.vassal_path, 'w') as vassal:
             vassal.write(options)
         log.info(_("Vassal saved"))
+        return True
 
     def unpack(self):
-        # directory is encoded into string to prevent unicode errors
-        directory = tempfile.mkdtemp(dir=self.upaas_config.paths.workdir,
-                                     prefix="upaas_package_").encode("utf-8")
-
         storage = load_handler(self.upaas_config.storage.handler,
                                self.upaas_config.storage.settings)
         if not storage:
             log.error("Storage handler '%s' not "
                       "found" % self.upaas_config.storage.handler)
 
-        workdir = os.path.join(directory, "system")
-        pkg_path = os.path.join(directory, self.filename)
-
         if os.path.exists(self.package_path):
             log.error(_("Package directory already exists: {path}").format(
                 path=self.package_path))
             raise UnpackError(_("Package directory already exists"))
 
-        log.info("Fetching package '%s'" % self.filename)
+        # staging directory is created next to package directory, so that
+        # unpacked package can be atomically renamed into final destination,
+        # it's encoded into string to prevent unicode errors
+        directory = tempfile.mkdtemp(dir=self.upaas_config.paths.apps,
+                                     prefix=".upaas_unpack_").encode("utf-8")
+        workdir = os.path.join(directory, "system")
+        pkg_path = os.path.join(directory, self.filename)
+
+        def _fetch(path):
+            log.info("Fetching package '%s'" % self.filename)
+            storage.get(self.filename, path)
+
+        cache = PackageCache.from_config(self.upaas_config)
         try:
-            storage.get(self.filename, pkg_path)
+            if cache:
+                # cached archive can be evicted by other process at any
+                # time, so we work on our own link to it
+                cache.link(self.checksum, _fetch, pkg_path)
+            else:
+                _fetch(pkg_path)
         except StorageError:
             log.error(_("Storage error while fetching package {name}").format(
                 name=self.filename))
             utils.rmdirs(directory)
             raise UnpackError(_("Storage error while fetching package "
                                 "{name}").format(name=self.filename))
+        except (IOError, OSError) as e:
+            log.error(_("Can't fetch package {name}: {e}").format(
+                name=self.filename, e=e))
+            utils.rmdirs(directory)
+            raise UnpackError(_("Can't fetch package {name}").format(
+                name=self.filename))
 
+        # archive is hashed while it's being extracted, extracted files stay
+        # in the staging directory until checksum is verified
         log.info("Unpacking package")
         os.mkdir(workdir, 0o755)
-        if not tar.unpack_tar(pkg_path, workdir):
+        checksum = unpack_tar_sha256(pkg_path, workdir)
+        # archive is no longer needed, free space before running features
+        os.remove(pkg_path)
+        if checksum is None:
             log.error(_("Error while unpacking package to '{workdir}'").format(
                 workdir=workdir))
             utils.rmdirs(directory)
             raise UnpackError(_("Error during package unpack"))
+        if checksum != self.checksum:
+            log.error(_("Package checksum mismatch, expected {expected}, got "
+                        "{checksum}").format(expected=self.checksum,
+                                             checksum=checksum))
+            utils.rmdirs(directory)
+            if cache:
+                # cached archive is corrupted, fetch it next time
+                cache.remove(self.checksum)
+            raise UnpackError(_("Package checksum mismatch"))
 
         with open(os.path.join(workdir, self.ack_filename), 'w') as ack:
             ack.write(_('Unpacked: {now}').format(now=datetime.datetime.now()))
@@ -430,11 +485,11 @@ class Package(Document):
         log.info(_("Package unpacked, moving into '{path}'").format(
             path=self.package_path))
         try:
-            shutil.move(workdir, self.package_path)
-        except shutil.Error as e:
+            os.rename(workdir, self.package_path)
+        except OSError as e:
             log.error(_("Error while moving unpacked package to final "
-                        "destination: e").format(e=e))
-            utils.rmdirs(directory, self.package_path)
+                        "destination: {e}").format(e=e))
+            utils.rmdirs(directory)
             raise UnpackError(_("Can't move to final directory: "
                                 "{path}").format(path=self.package_path))
         log.info(_("Package moved"))
@@ -456,20 +511,59 @@ class ApplicationDomain(Document):
         return str(self.id)
 
 
-class FlagLock(Document):
+class FlagLock(EmbeddedDocument):
+    """
+    Lease taken by mule that is handling flag, lease is valid until it
+    expires, mules must renew it while flag is being handled.
+    """
     date_created = DateTimeField(required=True, default=datetime.datetime.now)
-    application = ReferenceField('Application', dbref=False, required=True)
-    flag = StringField(required=True)
-    backend = ReferenceField(BackendServer, reverse_delete_rule=NULLIFY)
+    backend = ReferenceField(BackendServer, required=True)
     pid = IntField(required=True)
+    expires = DateTimeField(required=True)
+
+
+class FlagNotification(Document):
+    """
+    Capped collection with notifications about flags that were set, mules
+    are waiting for new notifications using tailable cursor.
+    """
+    date_created = DateTimeField(required=True, default=datetime.datetime.now)
+    name = StringField()
 
     meta = {
-        'indexes': [
-            {'fields': ['application', 'flag', 'backend'], 'unique': True},
-        ],
-        'ordering': ['-date_created'],
+        'max_documents': 1000,
+        'max_size': 1024 * 1024,
     }
 
+    @classmethod
+    def notify(cls, name):
+        try:
+            cls(name=name).save()
+        except Exception as e:
+            # mules will still pick up flag when polling
+            log.error(_("Failed to send flag notification: {e}").format(e=e))
+
+
+class FlagQuerySet(QuerySet):
+    """
+    Sends FlagNotification every time flag is set or it gets new pending
+    backends.
+    """
+
+    notify_on = ['set__pending', 'unset__pending', 'set__pending_backends',
+                 'add_to_set__pending_backends', 'push__pending_backends']
+
+    def update(self, *args, **kwargs):
+        ret = super(FlagQuerySet, self).update(*args, **kwargs)
+        if ret and (kwargs.get('upsert') or
+                    [key for key in kwargs if key in self.notify_on]):
+            name = self._query.get('name')
+            if isinstance(name, dict):
+                # flag name is not known, notify all mules
+                name = None
+            FlagNotification.notify(name)
+        return ret
+
 
 class ApplicationFlag(Document):
     date_created = DateTimeField(required=True, default=datetime.datetime.now)
@@ -478,20 +572,35 @@ class ApplicationFlag(Document):
     options = DictField()
     pending = BooleanField(default=True)
     pending_backends = ListField(ReferenceField(BackendServer))
+    locks = ListField(EmbeddedDocumentField(FlagLock))
+    # number of backends that can still start handling this flag, every lock
+    # taken decrements it and every released lock increments it, no limit
+    # if not set
+    free_slots = IntField()
 
     meta = {
         'indexes': [
             {'fields': ['name', 'application'], 'unique': True},
             {'fields': ['name']},
             {'fields': ['pending']},
+            {'fields': ['locks.backend']},
         ],
         'ordering': ['-date_created'],
+        'queryset_class': FlagQuerySet,
     }
 
     @property
     def title(self):
         return FLAGS_BY_NAME.get(self.name).title
 
+    def update(self, **kwargs):
+        """
+        Document.update() doesn't use FlagQuerySet, route it through the
+        queryset so that notifications are sent.
+        """
+        return self.__class__.objects(id=self.id,
+                                      name=self.name).update_one(**kwargs)
+
 
 class Application(Document):
     date_created = DateTimeField(required=True, default=datetime.datetime.now)
@@ -527,9 +636,7 @@ class Application(Document):
 
     @property
     def metadata_config(self):
-        if self.metadata:
-            return MetadataConfig.from_string(self.metadata)
-        return {}
+        return document_metadata_config(self)
 
     @property
     def upaas_config(self):
@@ -673,7 +780,7 @@ class Application(Document):
                 self.run_plan.delete()
                 return
 
-            self.run_plan.update(set__backends=backends)
+            self.run_plan.set_backend_settings(backends)
             ApplicationFlag.objects(
                 application=self, name=IsStartingFlag.name).update_one(
                     set__pending_backends=[b.backend for b in backends],
@@ -697,24 +804,89 @@ class Application(Document):
         self.flags.filter(
             name__in=[IsStartingFlag.name, NeedsRestartFlag.name]).delete()
 
+    def set_rolling_flag(self, name):
+        """
+        Set flag pending on all backends from run plan. If run plan limits
+        number of unavailable backends only that many backends are allowed
+        to handle this flag at once, others will wait for free slot.
+        """
+        backends = [b.backend for b in self.run_plan.backends]
+        max_unavailable = self.run_plan.max_unavailable
+        if not max_unavailable:
+            ApplicationFlag.objects(application=self, name=name).update_one(
+                set__pending_backends=backends, unset__free_slots=True,
+                upsert=True)
+            return
+        # free slots depend on the number of locks in flight, flag is only
+        # updated if no lock was taken or released since locks were counted
+        while True:
+            now = datetime.datetime.now()
+            flag = ApplicationFlag.objects(application=self,
+                                           name=name).first()
+            locks = []
+            if flag:
+                locks = flag.locks
+            in_flight = len([lock for lock in locks if lock.expires > now])
+            query = Q(locks__size=len(locks))
+            if not locks:
+                # flag might have been created without locks field
+                query = query | Q(locks__exists=False)
+            try:
+                ApplicationFlag.objects(
+                    query, application=self, name=name).update_one(
+                        set__pending_backends=backends,
+                        set__free_slots=max(max_unavailable - in_flight, 0),
+                        upsert=True)
+            except NotUniqueError:
+                # flag was created or locks were changed, count them again
+                continue
+            return
+
     def restart_application(self):
         if self.current_package:
             if not self.run_plan:
                 return
-        ApplicationFlag.objects(
-            application=self, name=NeedsRestartFlag.name).update_one(
-                set__pending_backends=[
-                    b.backend for b in self.run_plan.backends], upsert=True)
+        self.set_rolling_flag(NeedsRestartFlag.name)
 
     def upgrade_application(self):
         if self.current_package:
             if not self.run_plan:
                 return
+        self.set_rolling_flag(NeedsUpgradeFlag.name)
+
+    def stage_package(self, package):
+        """
+        Ask all backends running this application to fetch and unpack new
+        package in the background, application is upgraded to it only after
+        every backend has it unpacked. Package is activated right away if
+        application is not running.
+        """
+        if not self.run_plan or not self.run_plan.backends:
+            self.activate_package(package)
+            return
         ApplicationFlag.objects(
-            application=self, name=NeedsUpgradeFlag.name).update_one(
+            application=self, name=NeedsStagingFlag.name).update_one(
+                set__options={'package': package.safe_id},
                 set__pending_backends=[
                     b.backend for b in self.run_plan.backends], upsert=True)
 
+    def activate_package(self, package):
+        """
+        Make package current and upgrade all running instances.
+        """
+        self.update(set__current_package=package)
+        self.reload()
+        self.upgrade_application()
+
+    @property
+    def staged_package_id(self):
+        """
+        Returns id of package being staged, None if there's none.
+        """
+        flag = self.flags.filter(name=NeedsStagingFlag.name).first()
+        if flag and flag.options.get('package'):
+            return ObjectId(flag.options['package'])
+
     def update_application(self):
         if self.run_plan:
 
@@ -726,45 +898,81 @@ class Application(Document):
                             "available").format(name=self.name))
                 return
 
-            updated_backends = []
             for backend_conf in new_backends:
                 if backend_conf.backend in current_backends:
                     # replace backend settings with updated version
-                    self.run_plan.update(
-                        pull__backends__backend=backend_conf.backend)
-                    self.run_plan.update(push__backends=backend_conf)
-                    updated_backends.append(backend_conf.backend)
+                    self.run_plan.remove_backend_settings(
+                        backend_conf.backend)
+                    self.run_plan.append_backend_settings(backend_conf)
                 else:
                     # add backend to run plan if not already there
-                    ApplicationRunPlan.objects(
-                        id=self.run_plan.id,
-                        backends__backend__nin=[
-                            backend_conf.backend]).update_one(
-                        push__backends=backend_conf)
-                    log.info(_("Starting {name} on backend {backend}").format(
-                        name=self.name, backend=backend_conf.backend.name))
-                    ApplicationFlag.objects(
-                        pending_backends__ne=backend_conf.backend,
-                        application=self,
-                        name=IsStartingFlag.name).update_one(
-                            add_to_set__pending_backends=backend_conf.backend,
-                            upsert=True)
-
-            if updated_backends:
+                    if ApplicationRunPlan.objects(
+                            id=self.run_plan.id,
+                            backends__backend__nin=[
+                                backend_conf.backend]).update_one(
+                            push__backends=backend_conf):
+                        ledger.add_backend(self.run_plan, backend_conf)
+                        ApplicationRunPlan.update_port_usage(
+                            added=[backend_conf])
+                    else:
+                        # backend was added by someone else, ports allocated
+                        # for it won't be used
+                        scheduler.release_ports(backend_conf)
+
+            self.reschedule_flags(current_backends,
+                                  [bc.backend for bc in new_backends])
+
+    def reschedule_flags(self, current_backends, new_backends):
+        """
+        Set flags needed to move application instances from current list of
+        backends to new one.
+        """
+        updated_backends = []
+        for backend in new_backends:
+            if backend in current_backends:
+                updated_backends.append(backend)
+            else:
+                log.info(_("Starting {name} on backend {backend}").format(
+                    name=self.name, backend=backend.name))
                 ApplicationFlag.objects(
-                    application=self, name=NeedsRestartFlag.name).update_one(
-                        set__pending_backends=updated_backends, upsert=True)
-
-            for backend in current_backends:
-                if backend not in [bc.backend for bc in new_backends]:
-                    log.info(_("Stopping {name} on old backend "
-                               "{backend}").format(name=self.name,
-                                                   backend=backend.name))
-                    ApplicationFlag.objects(
-                        pending_backends__ne=backend,
-                        application=self,
-                        name=NeedsStoppingFlag.name).update_one(
-                            add_to_set__pending_backends=backend, upsert=True)
+                    pending_backends__ne=backend, application=self,
+                    name=IsStartingFlag.name).update_one(
+                        add_to_set__pending_backends=backend, upsert=True)
+
+        if updated_backends:
+            ApplicationFlag.objects(
+                application=self, name=NeedsRestartFlag.name).update_one(
+                    set__pending_backends=updated_backends, upsert=True)
+
+        for backend in current_backends:
+            if backend not in new_backends:
+                log.info(_("Stopping {name} on old backend "
+                           "{backend}").format(name=self.name,
+                                               backend=backend.name))
+                ApplicationFlag.objects(
+                    pending_backends__ne=backend,
+                    application=self,
+                    name=NeedsStoppingFlag.name).update_one(
+                        add_to_set__pending_backends=backend, upsert=True)
+
+    def stop_draining_backends(self):
+        """
+        Stop instances that were moved to other backends, should be called
+        after application is started on new backend so that capacity is
+        moved without stopping any instance first.
+        """
+        if not self.run_plan:
+            return
+        for backend_conf in self.run_plan.draining_backends:
+            log.info(_("Stopping {name} on drained backend "
+                       "{backend}").format(name=self.name,
+                                           backend=backend_conf.backend.name))
+            ApplicationFlag.objects(
+                pending_backends__ne=backend_conf.backend,
+                application=self,
+                name=NeedsStoppingFlag.name).update_one(
+                    add_to_set__pending_backends=backend_conf.backend,
+                    upsert=True)
 
     def trim_package_files(self):
         """
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import errno
+import shutil
+import logging
+import tempfile
+
+from django.utils.translation import ugettext as _
+
+
+log = logging.getLogger(__name__)
+
+
+class PackageCache(object):
+    """
+    Local on disk cache of package archives fetched from storage. Archives
+    are stored under their sha256 checksum, least recently used archives are
+    removed once cache grows above size limit.
+    """
+
+    suffix = '.pkg'
+
+    def __init__(self, path, max_size):
+        """
+        :param path: cache directory
+        :param max_size: cache size limit in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns cache configured in uPaaS config, None if cache is disabled.
+        """
+        if not config.storage.cache.path or not config.storage.cache.max_size:
+            return None
+        return cls(config.storage.cache.path,
+                   config.storage.cache.max_size * 1024 * 1024)
+
+    def entry_path(self, checksum):
+        return os.path.join(self.path, '%s%s' % (checksum, self.suffix))
+
+    def fetch(self, checksum, fetch_func):
+        """
+        Returns path to cached archive with given checksum, archive is
+        fetched using fetch_func(path) if it's not cached yet.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+        path = self.entry_path(checksum)
+        if os.path.isfile(path):
+            log.info(_("Using cached package archive {path}").format(
+                path=path))
+            # mtime is used to track least recently used archives
+            os.utime(path, None)
+            return path
+        tmp_dir = tempfile.mkdtemp(dir=self.path, prefix='.fetch_')
+        try:
+            tmp_path = os.path.join(tmp_dir, 'package')
+            fetch_func(tmp_path)
+            # other processes will see complete archive or none at all
+            os.rename(tmp_path, path)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict(keep=path)
+        return path
+
+    def link(self, checksum, fetch_func, path):
+        """
+        Fetch archive into the cache (if needed) and make it available under
+        given path, removing archive from cache later on won't affect it.
+        Archive is copied if path is on another filesystem.
+        """
+        cached_path = self.fetch(checksum, fetch_func)
+        try:
+            os.link(cached_path, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(cached_path, path)
+
+    def remove(self, checksum):
+        path = self.entry_path(checksum)
+        if os.path.exists(path):
+            log.info(_("Removing cached package archive {path}").format(
+                path=path))
+            os.remove(path)
+
+    def entries(self):
+        """
+        Returns list of (mtime, size, path) for all cached archives, least
+        recently used first.
+        """
+        ret = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            ret.append((stat.st_mtime, stat.st_size, path))
+        return sorted(ret)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used archives until cache fits in size limit,
+        returns number of removed archives.
+
+        :param keep: path of archive that must not be removed
+        """
+        entries = self.entries()
+        size = sum([entry[1] for entry in entries])
+        removed = 0
+        for __, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            log.info(_("Evicting cached package archive {path}").format(
+                path=path))
+            try:
+                os.remove(path)
+            except OSError as e:
+                log.warning(_("Can't remove cached package archive {path}: "
+                              "{e}").format(path=path, e=e))
+                continue
+            size -= entry_size
+            removed += 1
+        return removed
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import subprocess
+
+from django.utils.translation import ugettext as _
+
+
+log = logging.getLogger(__name__)
+
+
+def unpack_tar_sha256(path, workdir, chunk_size=1024 * 1024):
+    """
+    Extract gzipped tar archive into workdir using system tar, archive is
+    read only once and sha256 checksum of its content is calculated while
+    it's being piped to tar. Returns checksum (hex string) or None if tar
+    failed, extracted files must not be used before checksum is verified.
+    """
+    sha256 = hashlib.sha256()
+    proc = subprocess.Popen(['tar', '-xzpf', '-', '-C', workdir],
+                            stdin=subprocess.PIPE)
+    failed = False
+    try:
+        with open(path, 'rb') as archive:
+            while True:
+                chunk = archive.read(chunk_size)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                proc.stdin.write(chunk)
+    except (IOError, OSError) as e:
+        # tar exited before reading whole archive
+        log.error(_("Error while piping archive to tar: {e}").format(e=e))
+        failed = True
+    finally:
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            failed = True
+        ret = proc.wait()
+    if failed or ret != 0:
+        log.error(_("tar exited with code {ret}").format(ret=ret))
+        return None
+    return sha256.hexdigest()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import re
+import json
+import logging
+
+from django.conf import settings
+
+from upaas.checksum import calculate_string_sha256
+from upaas.config.base import UPAAS_CONFIG_DIRS
+
+from upaas_admin.common.cache import LRUCache
+
+
+log = logging.getLogger(__name__)
+
+
+class TemplateCache(object):
+    """
+    uWSGI templates cached by path and modification time, so that modified
+    templates are reloaded.
+    """
+
+    def __init__(self):
+        self.cache = LRUCache(max_size=64)
+
+    def stamp(self, path):
+        """
+        Returns (template path, mtime) tuple or None if there is no such
+        template in any config directory.
+        """
+        if not path:
+            return None
+        for search_path in UPAAS_CONFIG_DIRS:
+            template_path = os.path.join(search_path, path)
+            try:
+                return template_path, os.path.getmtime(template_path)
+            except OSError:
+                continue
+
+    def load(self, path):
+        stamp = self.stamp(path)
+        if stamp is None:
+            return []
+        lines = self.cache.get(stamp)
+        if lines is None:
+            log.debug("Loading uWSGI template from: %s" % stamp[0])
+            with open(stamp[0]) as template:
+                lines = template.read().splitlines()
+            self.cache.set(stamp, lines)
+        return list(lines)
+
+
+class VassalRenderer(object):
+    """
+    Generates uWSGI vassal configs, rendered configs are cached using hash of
+    all inputs as the key, so unchanged applications only cost single lookup.
+    Relevant uPaaS config sections are part of the key, so reloaded or
+    modified config invalidates cached entries, templates are checked for
+    modifications.
+    """
+
+    #: uPaaS config sections used when rendering vassal configs
+    config_sections = ['apps', 'interpreters']
+
+    def __init__(self, max_size=1024):
+        self.templates = TemplateCache()
+        # tuple of regexps -> list of compiled regexps
+        self.option_filters = {}
+        self.rendered = LRUCache(max_size=max_size)
+
+    def safe_option_filters(self, patterns):
+        """
+        Returns list of compiled regexps for safe uWSGI options.
+        """
+        key = tuple(patterns)
+        compiled = self.option_filters.get(key)
+        if compiled is None:
+            compiled = [re.compile(regexp) for regexp in key]
+            self.option_filters[key] = compiled
+        return compiled
+
+    def config_digest(self):
+        """
+        Returns sha256 of uPaaS config sections used for rendering.
+        """
+        dump = settings.UPAAS_CONFIG.dump()
+        sections = dict([(name, dump.get(name)) for name in
+                         self.config_sections])
+        return calculate_string_sha256(json.dumps(sections, sort_keys=True,
+                                                  default=str))
+
+    def cache_key(self, package, backend_conf, routers, custom_domains,
+                  templates):
+        application = package.application
+        run_plan = application.run_plan
+        parts = [self.config_digest(), package.safe_id,
+                 package.interpreter_name, package.interpreter_version,
+                 package.metadata or '', application.safe_id,
+                 application.name, application.metadata or '',
+                 application.system_domain, run_plan.memory_per_worker,
+                 run_plan.max_log_size, backend_conf.backend.ip,
+                 backend_conf.socket, backend_conf.stats,
+                 backend_conf.workers_min, backend_conf.workers_max]
+        parts.append([(router.subscription_ip, router.subscription_port)
+                      for router in routers])
+        parts.append([domain.name for domain in custom_domains])
+        parts.append([self.templates.stamp(path) for path in templates])
+        return calculate_string_sha256(repr(parts))
+
+    def render(self, package, backend_conf, routers, custom_domains):
+        """
+        Returns list of vassal config lines.
+        """
+        templates = package.uwsgi_templates()
+        key = self.cache_key(package, backend_conf, routers, custom_domains,
+                             templates)
+        options = self.rendered.get(key)
+        if options is None:
+            options = package.render_uwsgi_config(backend_conf, routers,
+                                                  custom_domains, templates)
+            self.rendered.set(key, options)
+        return list(options)
+
+    def clear(self):
+        self.templates.cache.clear()
+        self.option_filters = {}
+        self.rendered.clear()
+
+
+renderer = VassalRenderer()
@@ -12,6 +12,8 @@ import logging
 import mongoengine
 
 from django.core import exceptions
+from django.http import HttpResponseNotFound, HttpResponseBadRequest
+from django.conf.urls import url
 from django.utils.translation import ugettext as _
 
 from tastypie_mongoengine.resources import MongoEngineResource
@@ -20,10 +22,16 @@ from tastypie_mongoengine.fields import ReferenceField
 from tastypie.resources import ALL
 from tastypie.authorization import Authorization
 from tastypie.exceptions import Unauthorized
+from tastypie.utils import trailing_slash
+
+from mongoengine.errors import ValidationError
 
 from upaas_admin.apps.applications.models import Application
 from upaas_admin.apps.scheduler.models import ApplicationRunPlan
 from upaas_admin.apps.scheduler.forms import ApplicationRunPlanForm
+from upaas_admin.apps.scheduler.constants import SPREAD_CHOICES
+from upaas_admin.apps.scheduler.scoring import SCORERS, get_scorer
+from upaas_admin.apps.scheduler.simulation import what_if
 from upaas_admin.common.apiauth import UpaasApiKeyAuthentication
 from upaas_admin.common.api_validation import MongoCleanedDataFormValidation
 
@@ -119,3 +127,68 @@ class RunPlanResource(MongoEngineResource):
             'memory_per_worker']
         bundle.obj.max_log_size = bundle.request.user.limits['max_log_size']
         return super(RunPlanResource, self).obj_update(bundle, **kwargs)
+
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/(?P<id>\w[\w/-]*)/simulate%s$" %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('simulate'), name="simulate"),
+        ]
+
+    def simulate(self, request, **kwargs):
+        """
+        Show where workers would be placed if run plan was changed, nothing
+        is modified. Accepts workers_min, workers_max, spread_by and scorer
+        query parameters, current run plan values are used by default.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        try:
+            run_plan = ApplicationRunPlan.objects(
+                application__in=request.user.applications,
+                **self.remove_api_resource_names(kwargs)).first()
+        except ValidationError:
+            run_plan = None
+        if not run_plan:
+            return HttpResponseNotFound(_("No such run plan"))
+
+        try:
+            workers_min = int(request.GET.get('workers_min',
+                                              run_plan.workers_min))
+            workers_max = int(request.GET.get('workers_max',
+                                              run_plan.workers_max))
+        except ValueError:
+            return HttpResponseBadRequest(_("Invalid number of workers"))
+        if workers_min < 1 or workers_min > workers_max:
+            return HttpResponseBadRequest(_("Invalid number of workers"))
+
+        # same limits as ApplicationRunPlanForm enforces
+        workers_limit = request.user.limits['workers']
+        if workers_limit:
+            workers_available = max(
+                workers_limit - request.user.limits_usage['workers'] +
+                run_plan.workers_max, 0)
+            if workers_max > workers_available:
+                return HttpResponseBadRequest(_(
+                    "Only {available} workers available").format(
+                    available=workers_available))
+
+        spread_by = request.GET.get('spread_by', run_plan.spread_by) or None
+        if spread_by and spread_by not in SPREAD_CHOICES:
+            return HttpResponseBadRequest(_("Invalid spread_by value"))
+
+        scorer = request.GET.get('scorer')
+        if scorer and scorer not in SCORERS:
+            return HttpResponseBadRequest(_("Unknown scorer"))
+
+        result = what_if(run_plan.application.safe_id, workers_min,
+                         workers_max, run_plan.memory_per_worker,
+                         spread_by=spread_by, scorer=get_scorer(scorer))
+        if not request.user.is_superuser:
+            # load of other backends is only visible to admins
+            result['backends'] = [
+                {'id': b['id'], 'name': b['name'],
+                 'workers_min': b['workers_min'],
+                 'workers_max': b['workers_max']}
+                for b in result['backends'] if b['workers_max']]
+        return self.create_response(request, result)
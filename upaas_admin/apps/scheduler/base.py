@@ -6,80 +6,308 @@
 
 
 from operator import itemgetter
+from heapq import heappush, heappop, heapify
 
 import logging
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
 
-from upaas_admin.apps.servers.models import BackendServer
-from upaas_admin.apps.scheduler.models import BackendRunPlanSettings
+from upaas_admin.apps.servers.models import BackendServer, PortAllocator
+from upaas_admin.apps.scheduler.models import (BackendRunPlanSettings,
+                                               ApplicationRunPlan,
+                                               BackendLoadStats)
+from upaas_admin.apps.scheduler.ledger import ledger, reference_id
+from upaas_admin.apps.scheduler.scoring import get_scorer
 
 
 log = logging.getLogger(__name__)
 
 
-class Scheduler(object):
+class ScoreQueue(object):
+    """
+    Priority queue of backends ordered by (score, backend id). Updating score
+    pushes new heap entry, outdated entries are dropped once they reach the
+    top of the heap.
+    """
 
     def __init__(self):
-        self.backends = BackendServer.objects(is_enabled=True)
+        self.heap = []
+        self.scores = {}
+
+    def __contains__(self, backend_id):
+        return backend_id in self.scores
+
+    def __len__(self):
+        return len(self.scores)
+
+    def update(self, backend_id, score):
+        self.scores[backend_id] = score
+        heappush(self.heap, (score, backend_id))
+        if len(self.heap) > 2 * len(self.scores) + 64:
+            # too many outdated entries, rebuild heap
+            self.heap = [(s, bid) for bid, s in self.scores.items()]
+            heapify(self.heap)
+
+    def first(self, skip=None):
+        """
+        Returns ID of the backend with lowest score, backends from skip list
+        are ignored. None is returned if there is no such backend.
+        """
+        ret = None
+        skipped = []
+        while self.heap:
+            score, backend_id = self.heap[0]
+            if self.scores.get(backend_id) != score:
+                heappop(self.heap)
+            elif skip and backend_id in skip:
+                skipped.append(heappop(self.heap))
+            else:
+                ret = backend_id
+                break
+        for entry in skipped:
+            heappush(self.heap, entry)
+        return ret
+
+
+class DomainCounts(object):
+    """
+    Number of plan backends in every failure domain, counts are updated as
+    backends are added to the plan and crowded backends are only calculated
+    again after plan was changed.
+    """
+
+    def __init__(self, spread_by, domains):
+        """
+        :param domains: dict mapping backend id to failure domain
+        """
+        self.spread_by = spread_by
+        self.domains = domains
+        self.plan = set()
+        self.used = {}
+        self.free = {}
+        for domain in domains.values():
+            self.used[domain] = 0
+            self.free[domain] = self.free.get(domain, 0) + 1
+        self.crowded = None
+
+    def add(self, backend_id):
+        if backend_id in self.plan:
+            return
+        domain = self.domains[backend_id]
+        self.plan.add(backend_id)
+        self.used[domain] += 1
+        self.free[domain] -= 1
+        self.crowded = None
+
+    def crowded_backends(self):
+        if self.crowded is None:
+            free = [domain for domain, count in self.free.items() if count]
+            self.crowded = set()
+            if free:
+                lowest = min([self.used[domain] for domain in free])
+                crowded_domains = set([domain for domain in free
+                                       if self.used[domain] > lowest])
+                if crowded_domains:
+                    self.crowded = set([
+                        bid for bid, domain in self.domains.items()
+                        if domain in crowded_domains and
+                        bid not in self.plan])
+        return self.crowded
+
+
+class Scheduler(object):
+
+    def __init__(self, allocations=None, backends=None, scorer=None,
+                 live_load=None):
+        """
+        :param allocations: AllocationLedger instance used to get current
+                            allocations, it's reloaded only once stale;
+                            process wide ledger is used by default and it's
+                            reloaded on every scheduler run, since run plans
+                            are also modified by other processes
+        :param backends: list of backends to schedule on, all enabled
+                         backends are used by default
+        :param scorer: BackendScorer instance, scorer selected in config is
+                       used by default
+        :param live_load: if True observed memory usage and request rate
+                          collected from backends is also used for scoring,
+                          default is taken from config
+        """
+        self.ledger = allocations or ledger
+        self.reload_ledger = allocations is None
+        self.scorer = scorer or get_scorer()
+        self.live_load_config = settings.UPAAS_CONFIG.scheduler.live_load
+        if live_load is None:
+            live_load = self.live_load_config.enabled
+        self.live_load = live_load
+        if backends is None:
+            backends = BackendServer.objects(is_enabled=True)
+        self.backends = backends
         self.backend_by_id = dict((b.safe_id, b) for b in self.backends)
         self.backends_count = len(self.backends)
         self.default_worker_memory = \
             settings.UPAAS_CONFIG.defaults.limits.memory_per_worker
         self.allocated_mem = {}
         self.allocated_cpu = {}
+        self.allocated_ports = {}
         self.mem_load = {}
         self.cpu_load = {}
+        self.port_load = {}
+        self.observed_mem = {}
+        self.observed_requests = {}
         self.scores = {}
+        self.queue = ScoreQueue()
+        self.plan_queue = None
+        self.plan_domains = None
+        self.port_allocators = {}
+        self.domains = {}
 
     def calculate_scores(self, exclude_applications=[]):
         self.allocated_mem = {}
         self.allocated_cpu = {}
+        self.allocated_ports = {}
         self.mem_load = {}
         self.cpu_load = {}
+        self.port_load = {}
+        self.observed_mem = {}
+        self.observed_requests = {}
         self.scores = {}
+        self.queue = ScoreQueue()
+        self.plan_queue = None
+        self.plan_domains = None
+        self.port_allocators = {}
+        self.domains = {}
+
+        if self.reload_ledger or self.ledger.is_stale:
+            self.ledger.load(ApplicationRunPlan.objects)
+        allocations = self.ledger.allocations(
+            exclude_applications=[str(app.id) for app in
+                                  exclude_applications])
+
+        observed = {}
+        if self.live_load:
+            observed = BackendLoadStats.observed_load(
+                self.backends, window=self.live_load_config.window)
 
         for backend in self.backends:
-            self.allocated_mem[backend.safe_id] = 0
-            self.allocated_cpu[backend.safe_id] = 0
-            for run_plan in backend.run_plans:
-                if run_plan.application in exclude_applications:
-                    continue
-                bconf = run_plan.backend_settings(backend)
-                self.allocated_mem[backend.safe_id] += \
-                    bconf.workers_max * run_plan.memory_per_worker
-                self.allocated_cpu[backend.safe_id] += bconf.workers_max
+            cpu, mem = allocations.get(backend.safe_id, (0, 0))
+            rss, requests = observed.get(backend.safe_id, (0, 0))
+            self.observed_mem[backend.safe_id] = rss
+            self.observed_requests[backend.safe_id] = requests
+            self.allocated_mem[backend.safe_id] = mem
+            self.allocated_cpu[backend.safe_id] = cpu
+            self.allocated_ports[backend.safe_id] = len(backend.used_ports)
 
         for backend in self.backends:
             self.update_load(backend.safe_id)
             self.update_score(backend.safe_id)
             log.info(_(
-                "Backend {name} current allocations: cpu={cpu} memory={mem}, "
-                "load: cpu={cpuload} mem={memload}, score={score}").format(
+                "Backend {name} current allocations: cpu={cpu} memory={mem} "
+                "ports={ports}, load: cpu={cpuload} mem={memload} "
+                "ports={portload}, score={score}").format(
                     name=backend.name,
                     cpu=self.allocated_cpu[backend.safe_id],
                     mem=self.allocated_mem[backend.safe_id],
+                    ports=self.allocated_ports[backend.safe_id],
                     cpuload=self.cpu_load[backend.safe_id],
                     memload=self.mem_load[backend.safe_id],
+                    portload=self.port_load[backend.safe_id],
                     score=self.scores[backend.safe_id]))
 
     def update_load(self, backend_id):
+        """
+        Calculate load of each resource on backend, if live load is enabled
+        observed usage is used when it's bigger than reserved resources.
+        """
         backend = self.backend_by_id[backend_id]
-        mem_load = self.allocated_mem[backend_id] / float(backend.memory_mb)
-        cpu_load = self.allocated_cpu[backend_id] / float(backend.cpu_cores)
+        mem = max(self.allocated_mem[backend_id],
+                  self.observed_mem[backend_id])
+        mem_load = mem / float(backend.memory_mb)
+        cpu_load = max(
+            self.allocated_cpu[backend_id] / float(backend.cpu_cores),
+            self.observed_requests[backend_id] / float(
+                backend.cpu_cores * self.live_load_config.requests_per_core))
+        port_load = self.allocated_ports[backend_id] / float(
+            max(backend.maximum_ports, 1))
         self.mem_load[backend_id] = mem_load
         self.cpu_load[backend_id] = cpu_load
+        self.port_load[backend_id] = port_load
 
-    def update_score(self, backend_id):
+    def is_overloaded(self, backend_id):
         backend = self.backend_by_id[backend_id]
-        mem_free = backend.memory_mb - self.allocated_mem[backend_id]
-        cpu_load = self.mem_load[backend_id]
-        mem_load = self.mem_load[backend_id]
-        self.scores[backend_id] = cpu_load * mem_load
-        if mem_load > 0.9 or mem_free <= self.default_worker_memory:
+        mem_free = backend.memory_mb - max(self.allocated_mem[backend_id],
+                                           self.observed_mem[backend_id])
+        ports_free = backend.maximum_ports - self.allocated_ports[backend_id]
+        return self.mem_load[backend_id] > 0.9 or \
+            mem_free <= self.default_worker_memory or ports_free < 2
+
+    def update_score(self, backend_id):
+        score = self.scorer.score(self.cpu_load[backend_id],
+                                  self.mem_load[backend_id],
+                                  self.port_load[backend_id])
+        if self.is_overloaded(backend_id):
             # backend is overloaded put it on the bottom of the list
-            self.scores[backend.safe_id] *= 99999
+            score += 99999
+        self.scores[backend_id] = score
+        self.queue.update(backend_id, score)
+        if self.plan_queue is not None and backend_id in self.plan_queue:
+            self.plan_queue.update(backend_id, score)
+
+    def charge(self, backend_id, memory_per_worker, ports=0):
+        """
+        Account single worker scheduled on given backend, ports should be
+        passed if worker needs new ports to be allocated.
+        """
+        self.allocated_cpu[backend_id] += 1
+        self.allocated_mem[backend_id] += memory_per_worker
+        if self.observed_mem[backend_id]:
+            # new worker will also increase observed memory usage
+            self.observed_mem[backend_id] += memory_per_worker
+        self.allocated_ports[backend_id] += ports
+        self.update_load(backend_id)
+        self.update_score(backend_id)
+
+    def release(self, backend_id, memory_per_worker, ports=0):
+        """
+        Reverse of charge(), account single worker removed from backend.
+        """
+        self.allocated_cpu[backend_id] -= 1
+        self.allocated_mem[backend_id] -= memory_per_worker
+        if self.observed_mem[backend_id]:
+            self.observed_mem[backend_id] = max(
+                self.observed_mem[backend_id] - memory_per_worker, 0)
+        self.allocated_ports[backend_id] -= ports
+        self.update_load(backend_id)
+        self.update_score(backend_id)
+
+    def release_workers(self, backend_id, workers, memory_per_worker,
+                        ports=0):
+        """
+        Release all workers charged on backend for run plan that won't use
+        it, ports are released together with the first worker.
+        """
+        for idx in range(0, workers):
+            self.release(backend_id, memory_per_worker,
+                         ports=ports if idx == 0 else 0)
+
+    def port_allocator(self, backend):
+        """
+        Returns PortAllocator for backend, it's loaded only once so that
+        ports allocated for many run plans are tracked in memory.
+        """
+        if backend.safe_id not in self.port_allocators:
+            allocator = PortAllocator(backend)
+            allocator.load()
+            self.port_allocators[backend.safe_id] = allocator
+        return self.port_allocators[backend.safe_id]
+
+    def release_ports(self, backend_conf):
+        """
+        Release ports allocated for backend settings that won't be saved.
+        """
+        self.port_allocator(backend_conf.backend).release(
+            [backend_conf.socket, backend_conf.stats])
 
     def backends_range(self, max_workers):
         """
@@ -99,76 +327,134 @@ class Scheduler(object):
         else:
             return min(5, self.backends_count), max(5, self.backends_count)
 
-    def select_best_backend(self, plan, min_backends, max_backends):
+    def backend_domains(self, spread_by):
+        """
+        Returns dict mapping backend id to failure domain (value of
+        spread_by label), backends without label form their own domains.
+        """
+        if spread_by not in self.domains:
+            self.domains[spread_by] = dict(
+                (bid, getattr(backend, spread_by) or 'backend:%s' % bid)
+                for bid, backend in self.backend_by_id.items())
+        return self.domains[spread_by]
+
+    def crowded_backends(self, plan, spread_by):
+        """
+        Returns set of backends not used in plan that are in failure domains
+        which already have more plan backends than other domains with free
+        backends.
+        """
+        counts = self.plan_domains
+        if counts is None or counts.spread_by != spread_by or \
+                not counts.plan.issubset(plan):
+            counts = DomainCounts(spread_by, self.backend_domains(spread_by))
+            self.plan_domains = counts
+        if len(counts.plan) != len(plan):
+            for bid in plan:
+                counts.add(bid)
+        return counts.crowded_backends()
+
+    def select_best_backend(self, plan, min_backends, max_backends,
+                            spread_by=None):
         """
         Select least loaded backend for application run plan.
         Backend ID is returned (string format).
+
+        :param spread_by: backend label (rack or zone), if set new backends
+                          are only selected from failure domains with the
+                          lowest number of backends already in the plan
         """
-        for bid, __ in sorted(self.scores.items(), key=itemgetter(1, 0)):
-            if bid in plan and len(plan.keys()) < min_backends:
-                # backend is already scheduled and we need more backends
-                # skip it so we can fulfill min_backends requirement
-                continue
-            elif bid not in plan and len(plan.keys()) >= max_backends:
-                # backend is not scheduled but we already got maximum backends
-                # retured, skip it so we can fulfill max_backends requirement
-                continue
-            return bid
+        if len(plan) >= max_backends:
+            # we already got maximum backends returned, only backends that
+            # are already scheduled can be used so we can fulfill
+            # max_backends requirement
+            if self.plan_queue is None or len(self.plan_queue) != len(plan):
+                self.plan_queue = ScoreQueue()
+                for bid in plan:
+                    self.plan_queue.update(bid, self.scores[bid])
+            return self.plan_queue.first()
+        crowded = set()
+        if spread_by:
+            crowded = self.crowded_backends(plan, spread_by)
+        if len(plan) < min_backends:
+            # we need more backends, skip those that are already scheduled so
+            # we can fulfill min_backends requirement
+            return self.queue.first(skip=crowded.union(plan))
+        return self.queue.first(skip=crowded)
 
     def find_backends(self, run_plan):
         self.calculate_scores(exclude_applications=[run_plan.application])
+        return self.place(run_plan)
 
-        plan_max = {}
-        plan_min = {}
-        min_backends, max_backends = self.backends_range(run_plan.workers_max)
-        log.info(_("Will use between {minb} and {maxb} backends").format(
-            minb=min_backends, maxb=max_backends))
+    def schedule_many(self, run_plans):
+        """
+        Schedule list of run plans in a single pass. Cluster state is loaded
+        only once, run plans are placed starting with those having the
+        biggest demand and results are saved using bulk update.
+        Returns list of (run plan, BackendRunPlanSettings list) tuples.
+        """
+        run_plans = sorted(
+            run_plans, key=lambda rp: rp.workers_max * rp.memory_per_worker,
+            reverse=True)
+        self.calculate_scores(
+            exclude_applications=[rp.application for rp in run_plans])
 
-        scheduled_max = 0
-        while scheduled_max < run_plan.workers_max:
-            bid = self.select_best_backend(plan_max, min_backends,
-                                           max_backends)
-            if bid is None:
-                log.error(_("No more backends can be found, got only "
-                            "{l}").format(l=len(plan_max.keys())))
-                if plan_max:
-                    break
-                else:
-                    return []
-            plan_max[bid] = plan_max.get(bid, 0) + 1
-            # allocations must to updated only for max workers
-            self.allocated_cpu[bid] += 1
-            self.allocated_mem[bid] += run_plan.memory_per_worker
-            self.update_load(bid)
-            self.update_score(bid)
-            scheduled_max += 1
+        results = []
+        for run_plan in run_plans:
+            backends = self.place(run_plan)
+            if not backends:
+                log.error(_("Can't schedule '{name}', no backend "
+                            "available").format(
+                    name=run_plan.application.name))
+            results.append((run_plan, backends))
 
-        scheduled_min = 0
-        for bid, workers_max in plan_max.items():
-            if run_plan.workers_min == run_plan.workers_max:
-                plan_min[bid] = plan_max[bid]
-            else:
-                plan_min[bid] = 1
-            scheduled_min += plan_min[bid]
+        self.save_many(results)
+        return results
 
-        log.debug(_("Scheduled min workers: {m}, needed {n}").format(
-            m=scheduled_min, n=run_plan.workers_min))
+    def save_many(self, results):
+        """
+        Save scheduling results using single bulk update. Backends that are
+        no longer used are kept in run plans, they will be removed after
+        application is stopped on those backends.
+        """
+        collection = ApplicationRunPlan._get_collection()
+        bulk = collection.initialize_unordered_bulk_op()
+        updates = []
+        for run_plan, backends in results:
+            if not backends:
+                continue
+            new_backends = [bc.backend for bc in backends]
+            backends = backends + [bc for bc in run_plan.backends
+                                   if bc.backend not in new_backends]
+            bulk.find({'_id': run_plan.id}).update_one(
+                {'$set': {'backends': [bc.to_mongo() for bc in backends]}})
+            updates.append((run_plan, backends))
+        if updates:
+            bulk.execute()
+            for run_plan, backends in updates:
+                self.ledger.set_backends(run_plan, backends)
+                ApplicationRunPlan.update_port_usage(removed=run_plan.backends,
+                                                     added=backends)
+            log.info(_("Saved {count} run plan(s)").format(
+                count=len(updates)))
 
-        missing = run_plan.workers_min - scheduled_min
-        log.debug(_("Missing min workers: {m}").format(m=missing))
-        while missing > 0:
-            log.debug(_("Still missing min workers: {m}").format(m=missing))
-            for bid, __ in sorted(self.scores.items(), key=itemgetter(1)):
-                if bid in plan_max and plan_max[bid] > plan_min[bid]:
-                    backend = self.backend_by_id[bid]
-                    log.debug(_("Adding missing min worker to {name}").format(
-                        name=backend.name))
-                    plan_min[bid] += 1
-                    missing -= 1
-                    if missing <= 0:
-                        break
+    def place(self, run_plan):
+        """
+        Find backends for run plan using current scores, scores are updated
+        with allocations made for this run plan.
+        """
+        current = [reference_id(bc, 'backend') for bc in run_plan.backends]
+        plan_min, plan_max = self.plan_workers(
+            run_plan.workers_min, run_plan.workers_max,
+            run_plan.memory_per_worker, current=current,
+            spread_by=run_plan.spread_by)
+        if not plan_max:
+            return []
 
         backends = []
+        # settings with ports allocated for this run plan, ports are
+        # released if run plan can't be placed
+        allocated = []
 
         for bid, workers_max in sorted(plan_max.items(), key=itemgetter(1, 0)):
             workers_min = plan_min[bid]
@@ -179,13 +465,15 @@ class Scheduler(object):
                 values['socket'] = backend_conf.socket
                 values['stats'] = backend_conf.stats
             else:
-                ports = backend.find_free_ports(2)
-                values['socket'] = ports[0]
-                values['stats'] = ports[1]
+                ports = self.port_allocator(backend).allocate(2)
                 if not ports:
                     log.error(_("No free ports found on backend "
                                 "{name}").format(name=backend.name))
+                    self.release_workers(bid, workers_max,
+                                         run_plan.memory_per_worker, ports=2)
                     continue
+                values['socket'] = ports[0]
+                values['stats'] = ports[1]
             brps = BackendRunPlanSettings(
                 backend=backend,
                 workers_min=workers_min,
@@ -193,6 +481,23 @@ class Scheduler(object):
                 package=run_plan.application.current_package,
                 **values)
             backends.append(brps)
+            if not backend_conf:
+                allocated.append(brps)
+
+        if sum([b.workers_max for b in backends]) < run_plan.workers_min:
+            log.error(_("Only {count} workers of {name} could be placed, "
+                        "{minw} needed").format(
+                count=sum([b.workers_max for b in backends]),
+                name=run_plan.application.name, minw=run_plan.workers_min))
+            for backend_conf in backends:
+                ports = 0
+                if backend_conf in allocated:
+                    self.release_ports(backend_conf)
+                    ports = 2
+                self.release_workers(reference_id(backend_conf, 'backend'),
+                                     backend_conf.workers_max,
+                                     run_plan.memory_per_worker, ports=ports)
+            return []
 
         log.info(_("Got backends for {name}: {servers}").format(
             name=run_plan.application.name, servers=", ".join(
@@ -203,3 +508,72 @@ class Scheduler(object):
             maxw=sum(plan_max.values())))
 
         return backends
+
+    def plan_workers(self, workers_min, workers_max, memory_per_worker,
+                     current=None, spread_by=None):
+        """
+        Distribute workers between backends using current scores, scores are
+        updated with allocations made. No database queries are made.
+        Returns tuple of dicts (backend id -> min workers, backend id -> max
+        workers), both are empty if no backend is available.
+
+        :param current: ids of backends that application already has ports
+                        allocated on
+        :param spread_by: backend label used to spread backends between
+                          failure domains
+        """
+        self.plan_queue = None
+        self.plan_domains = None
+        current = current or []
+        plan_max = {}
+        plan_min = {}
+        min_backends, max_backends = self.backends_range(workers_max)
+        log.info(_("Will use between {minb} and {maxb} backends").format(
+            minb=min_backends, maxb=max_backends))
+
+        scheduled_max = 0
+        while scheduled_max < workers_max:
+            bid = self.select_best_backend(plan_max, min_backends,
+                                           max_backends, spread_by=spread_by)
+            if bid is None:
+                log.error(_("No more backends can be found, got only "
+                            "{l}").format(l=len(plan_max.keys())))
+                if plan_max:
+                    break
+                else:
+                    return {}, {}
+            ports = 0
+            if bid not in plan_max and bid not in current:
+                # socket and stats port will be allocated on this backend
+                ports = 2
+            plan_max[bid] = plan_max.get(bid, 0) + 1
+            # allocations must to updated only for max workers
+            self.charge(bid, memory_per_worker, ports=ports)
+            scheduled_max += 1
+
+        scheduled_min = 0
+        for bid, workers in plan_max.items():
+            if workers_min == workers_max:
+                plan_min[bid] = plan_max[bid]
+            else:
+                plan_min[bid] = 1
+            scheduled_min += plan_min[bid]
+
+        log.debug(_("Scheduled min workers: {m}, needed {n}").format(
+            m=scheduled_min, n=workers_min))
+
+        missing = workers_min - scheduled_min
+        log.debug(_("Missing min workers: {m}").format(m=missing))
+        while missing > 0:
+            log.debug(_("Still missing min workers: {m}").format(m=missing))
+            for bid in sorted(plan_max, key=lambda b: (self.scores[b], b)):
+                if plan_max[bid] > plan_min[bid]:
+                    backend = self.backend_by_id[bid]
+                    log.debug(_("Adding missing min worker to {name}").format(
+                        name=backend.name))
+                    plan_min[bid] += 1
+                    missing -= 1
+                    if missing <= 0:
+                        break
+
+        return plan_min, plan_max
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+
+class SpreadBy:
+    rack = 'rack'
+    zone = 'zone'
+
+
+SPREAD_CHOICES = (SpreadBy.rack, SpreadBy.zone)
@@ -22,7 +22,7 @@ class ApplicationRunPlanForm(CrispyMongoForm):
     form_class = ''
     label_class = ''
     field_class = ''
-    layout = ['workers_min', 'workers_max']
+    layout = ['workers_min', 'workers_max', 'spread_by', 'max_unavailable']
 
     class Meta:
         document = ApplicationRunPlan
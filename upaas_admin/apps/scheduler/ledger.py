@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import logging
+from datetime import datetime, timedelta
+from threading import RLock
+
+from django.utils.translation import ugettext as _
+
+
+log = logging.getLogger(__name__)
+
+
+def reference_id(document, field):
+    """
+    Return id (as string) of document referenced by given field without
+    dereferencing it.
+    """
+    value = document._data.get(field)
+    return str(getattr(value, 'id', value))
+
+
+class AllocationLedger(object):
+    """
+    Process wide cache of cpu and memory reserved on every backend by
+    application run plans. It is loaded using single aggregation query and
+    kept up to date incrementally when run plans are modified, so scheduler
+    doesn't need to walk every run plan for each placement. Only changes made
+    in this process are tracked, Scheduler reloads process wide ledger at
+    the start of every run.
+    """
+
+    pipeline = [
+        {'$unwind': '$backends'},
+        {'$group': {
+            '_id': '$backends.backend',
+            'cpu': {'$sum': '$backends.workers_max'},
+            'mem': {'$sum': {'$multiply': ['$backends.workers_max',
+                                           '$memory_per_worker']}},
+            'plans': {'$push': {
+                'plan': '$_id',
+                'application': '$application',
+                'cpu': '$backends.workers_max',
+                'mem': {'$multiply': ['$backends.workers_max',
+                                      '$memory_per_worker']},
+            }},
+        }},
+    ]
+
+    def __init__(self, max_age=60):
+        """
+        :param max_age: number of seconds after which ledger is considered
+                        stale and will be reloaded, changes made by other
+                        processes are only visible after reload, ledger
+                        never goes stale once loaded if set to None
+        """
+        self.max_age = max_age
+        self.lock = RLock()
+        self.loaded = None
+        self.cpu = {}
+        self.mem = {}
+        self.plans = {}
+        self.applications = {}
+
+    @property
+    def is_stale(self):
+        if self.loaded is None:
+            return True
+        if self.max_age is None:
+            return False
+        return self.loaded < datetime.now() - timedelta(seconds=self.max_age)
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded = None
+
+    def load(self, run_plans):
+        """
+        Rebuild ledger from scratch.
+
+        :param run_plans: ApplicationRunPlan queryset to aggregate
+        """
+        rows = []
+        for row in run_plans.aggregate(*self.pipeline):
+            for entry in row['plans']:
+                rows.append((str(entry['plan']), str(entry['application']),
+                             str(row['_id']), entry['cpu'], entry['mem']))
+        self.load_rows(rows)
+
+    def load_rows(self, rows):
+        """
+        Rebuild ledger from list of (plan id, application id, backend id, cpu,
+        memory) tuples.
+        """
+        with self.lock:
+            self.cpu = {}
+            self.mem = {}
+            self.plans = {}
+            self.applications = {}
+            for plan_id, app_id, backend_id, cpu, mem in rows:
+                self.applications[app_id] = plan_id
+                self.charge(plan_id, backend_id, cpu, mem)
+            self.loaded = datetime.now()
+        log.debug(_("Allocation ledger loaded with {plans} run plan(s) on "
+                    "{backends} backend(s)").format(
+            plans=len(self.plans), backends=len(self.cpu)))
+
+    def charge(self, plan_id, backend_id, cpu, mem):
+        with self.lock:
+            self.release(plan_id, backend_id)
+            self.plans.setdefault(plan_id, {})[backend_id] = (cpu, mem)
+            self.cpu[backend_id] = self.cpu.get(backend_id, 0) + cpu
+            self.mem[backend_id] = self.mem.get(backend_id, 0) + mem
+
+    def release(self, plan_id, backend_id):
+        with self.lock:
+            cpu, mem = self.plans.get(plan_id, {}).pop(backend_id, (0, 0))
+            if cpu or mem:
+                self.cpu[backend_id] -= cpu
+                self.mem[backend_id] -= mem
+
+    def add_backend(self, run_plan, backend_conf):
+        """
+        Account backend settings appended to run plan.
+        """
+        self.applications[reference_id(run_plan, 'application')] = \
+            run_plan.safe_id
+        self.charge(run_plan.safe_id, reference_id(backend_conf, 'backend'),
+                    backend_conf.workers_max,
+                    backend_conf.workers_max * run_plan.memory_per_worker)
+
+    def remove_backend(self, run_plan, backend):
+        """
+        Account backend settings removed from run plan.
+        """
+        self.release(run_plan.safe_id, str(backend.id))
+
+    def set_backends(self, run_plan, backends):
+        """
+        Replace all allocations made by run plan with given list of
+        BackendRunPlanSettings.
+        """
+        with self.lock:
+            self.remove_plan(run_plan)
+            for backend_conf in backends:
+                self.add_backend(run_plan, backend_conf)
+
+    def remove_plan(self, run_plan):
+        with self.lock:
+            for backend_id in list(self.plans.get(run_plan.safe_id, {})):
+                self.release(run_plan.safe_id, backend_id)
+            self.plans.pop(run_plan.safe_id, None)
+            self.applications.pop(reference_id(run_plan, 'application'),
+                                  None)
+
+    def allocations(self, exclude_applications=None):
+        """
+        Returns dict with (cpu, memory) tuple allocated on each backend,
+        allocations made for applications from exclude_applications list
+        (application ids) are not counted.
+        """
+        with self.lock:
+            ret = dict((bid, (cpu, self.mem[bid]))
+                       for bid, cpu in self.cpu.items())
+            for app_id in exclude_applications or []:
+                plan_id = self.applications.get(app_id)
+                for bid, (cpu, mem) in self.plans.get(plan_id, {}).items():
+                    ret[bid] = (ret[bid][0] - cpu, ret[bid][1] - mem)
+        return ret
+
+
+ledger = AllocationLedger()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from upaas_admin.apps.scheduler.rebalance import Rebalancer
+
+
+class Command(BaseCommand):
+
+    help = 'Move application instances away from overloaded backends'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--max-moves', dest='max_moves', type=int, default=None,
+                    help='Maximum number of moves in progress (default is '
+                         'taken from config)'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False, help='Only print planned moves'),
+    )
+
+    def handle(self, *args, **options):
+        rebalancer = Rebalancer(max_moves=options['max_moves'])
+        if options['dry_run']:
+            moves = rebalancer.plan()
+        else:
+            moves = rebalancer.rebalance()
+        for move in moves:
+            self.stdout.write('%s\n' % move)
+        self.stdout.write('%d move(s) %s\n' % (
+            len(moves), 'planned' if options['dry_run'] else 'started'))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import logging
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from upaas_admin.apps.scheduler.models import ApplicationRunPlan
+from upaas_admin.apps.scheduler.base import Scheduler
+
+
+log = logging.getLogger("reschedule")
+
+
+class Command(BaseCommand):
+
+    help = 'Reschedule applications with invalid run plans in a single pass'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Reschedule all running applications'),
+    )
+
+    def handle(self, *args, **options):
+        run_plans = []
+        for run_plan in ApplicationRunPlan.objects():
+            if options['all'] or not run_plan.is_valid():
+                run_plans.append(run_plan)
+
+        if not run_plans:
+            self.stdout.write('Nothing to reschedule\n')
+            return
+
+        current = dict((run_plan.safe_id, [bc.backend for bc in
+                                           run_plan.backends])
+                       for run_plan in run_plans)
+        failed = 0
+        for run_plan, backends in Scheduler().schedule_many(run_plans):
+            if not backends:
+                failed += 1
+                continue
+            run_plan.application.reschedule_flags(
+                current[run_plan.safe_id], [bc.backend for bc in backends])
+
+        self.stdout.write('%d application(s) rescheduled, %d failed\n' % (
+            len(run_plans) - failed, failed))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from upaas_admin.apps.scheduler.scoring import SCORERS, get_scorer
+from upaas_admin.apps.scheduler.simulation import ClusterSnapshot, simulate
+
+
+class Command(BaseCommand):
+
+    help = 'Record cluster snapshot or replay it through backend scorers'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--record', dest='record',
+                    help='Save current cluster state to given file'),
+        make_option('--snapshot', dest='snapshot',
+                    help='Replay snapshot from given file'),
+        make_option('--scorer', dest='scorers', action='append',
+                    help='Scorer to use, can be passed multiple times, all '
+                         'scorers are used by default'),
+    )
+
+    def handle(self, *args, **options):
+        if options['record']:
+            ClusterSnapshot.record().save(options['record'])
+            self.stdout.write('Snapshot saved to %s\n' % options['record'])
+            return
+
+        if not options['snapshot']:
+            raise CommandError('Either --record or --snapshot is required')
+        snapshot = ClusterSnapshot.load(options['snapshot'])
+
+        scorers = options['scorers'] or sorted(SCORERS.keys())
+        for name in scorers:
+            try:
+                scorer = get_scorer(name)
+            except ValueError as e:
+                raise CommandError(e)
+            summary = simulate(snapshot, scorer).summary()
+            self.stdout.write('%s: placed=%d failed=%d\n' % (
+                summary['scorer'], summary['placed'], summary['failed']))
+            for resource in ['cpu', 'memory', 'ports']:
+                self.stdout.write(
+                    '  %-6s max=%.3f mean=%.3f stddev=%.3f\n' % (
+                        resource, summary[resource]['max'],
+                        summary[resource]['mean'],
+                        summary[resource]['stddev']))
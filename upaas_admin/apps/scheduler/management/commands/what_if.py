@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from upaas_admin.apps.applications.models import Application
+from upaas_admin.apps.scheduler.constants import SPREAD_CHOICES
+from upaas_admin.apps.scheduler.scoring import get_scorer
+from upaas_admin.apps.scheduler.simulation import what_if
+
+
+class Command(BaseCommand):
+
+    args = '<application name>'
+    help = 'Show where application workers would be placed if scaled'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers-min', dest='workers_min', type=int,
+                    help='Minimum number of workers (default is current '
+                         'value)'),
+        make_option('--workers-max', dest='workers_max', type=int,
+                    help='Maximum number of workers (default is current '
+                         'value)'),
+        make_option('--memory-per-worker', dest='memory_per_worker',
+                    type=int, help='Memory limit for single worker (default '
+                                   'is current value)'),
+        make_option('--spread-by', dest='spread_by', choices=SPREAD_CHOICES,
+                    help='Spread backends across racks or zones'),
+        make_option('--scorer', dest='scorer',
+                    help='Scorer to use (default is taken from config)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Application name is required')
+        app = Application.objects(name=args[0]).first()
+        if not app:
+            raise CommandError('Application not found: %s' % args[0])
+
+        run_plan = app.run_plan
+        values = {}
+        for name in ['workers_min', 'workers_max', 'memory_per_worker',
+                     'spread_by']:
+            values[name] = options.get(name)
+            if values[name] is None and run_plan:
+                values[name] = getattr(run_plan, name)
+        if not values['memory_per_worker']:
+            values['memory_per_worker'] = app.owner.limits[
+                'memory_per_worker']
+        if not values['workers_min'] or not values['workers_max']:
+            raise CommandError('Application is not running, both '
+                               '--workers-min and --workers-max are required')
+        if values['workers_min'] > values['workers_max']:
+            raise CommandError('Minimum number of workers is bigger than '
+                               'maximum')
+
+        try:
+            scorer = get_scorer(options.get('scorer'))
+        except ValueError as e:
+            raise CommandError(e)
+
+        result = what_if(app.safe_id, values['workers_min'],
+                         values['workers_max'], values['memory_per_worker'],
+                         spread_by=values['spread_by'], scorer=scorer)
+        if not result['placed']:
+            self.stdout.write('No backend available\n')
+        self.stdout.write('Scorer: %s, workers: %d - %d\n' % (
+            result['scorer'], result['workers_min'], result['workers_max']))
+        for backend in result['backends']:
+            self.stdout.write(
+                '%-20s workers=%d-%d cpu=%.3f mem=%.3f ports=%.3f '
+                'score=%.3f -> %.3f%s\n' % (
+                    backend['name'], backend['workers_min'],
+                    backend['workers_max'], backend['cpu_load'],
+                    backend['memory_load'], backend['ports_load'],
+                    backend['current_score'], backend['projected_score'],
+                    ' (overloaded)' if backend['overloaded'] else ''))
@@ -8,14 +8,20 @@
 from __future__ import unicode_literals
 
 import logging
+from datetime import datetime, timedelta
 
 from mongoengine import (Document, EmbeddedDocument, QuerySetManager,
-                         IntField, ReferenceField, EmbeddedDocumentField,
+                         IntField, FloatField, BooleanField, DateTimeField,
+                         StringField, ReferenceField, EmbeddedDocumentField,
                          ListField, signals)
+from mongoengine.base import get_document
 
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
+from upaas_admin.apps.scheduler.ledger import ledger, reference_id
+from upaas_admin.apps.scheduler.constants import SPREAD_CHOICES
+
 
 log = logging.getLogger(__name__)
 
@@ -64,6 +70,9 @@ class BackendRunPlanSettings(EmbeddedDocument):
     stats = IntField(required=True)
     workers_min = IntField(required=True)
     workers_max = IntField(required=True)
+    # instance is being moved to other backend and it will be stopped once
+    # application is started there
+    draining = BooleanField(default=False)
 
 
 class ApplicationRunPlan(Document):
@@ -81,27 +90,120 @@ class ApplicationRunPlan(Document):
                                  verbose_name=_('memory per worker limit'))
     max_log_size = IntField(required=True, min_value=1, default=100,
                             verbose_name=_('log file size limit'))
+    spread_by = StringField(choices=SPREAD_CHOICES,
+                            verbose_name=_('spread workers across'))
+    max_unavailable = IntField(min_value=1, verbose_name=_(
+        'maximum number of backends restarted at once'))
 
     _default_manager = QuerySetManager()
 
+    meta = {
+        'indexes': ['backends.backend'],
+    }
+
     @classmethod
     def pre_delete(cls, sender, document, **kwargs):
         log.debug(_("Pre delete signal on run_plan for {name}").format(
             name=document.application.name))
         document.application.update(unset__run_plan=True)
+        ledger.remove_plan(document)
+        cls.update_port_usage(removed=document.backends)
+
+    @classmethod
+    def pre_save(cls, sender, document, **kwargs):
+        # remember backend settings currently stored, so that post_save can
+        # release ports that are no longer used
+        stored = None
+        if document.id:
+            stored = cls.objects(id=document.id).only('backends').first()
+        document._stored_backends = stored.backends if stored else []
+
+    @classmethod
+    def post_save(cls, sender, document, **kwargs):
+        ledger.set_backends(document, document.backends)
+        stored = getattr(document, '_stored_backends', [])
+        cls.update_port_usage(
+            removed=cls.ports_difference(stored, document.backends),
+            added=cls.ports_difference(document.backends, stored))
+        document._stored_backends = document.backends
+
+    @classmethod
+    def ports_difference(cls, backends, other):
+        """
+        Returns BackendRunPlanSettings from backends with ports that are not
+        used by any BackendRunPlanSettings in other.
+        """
+        def ports(backend_conf):
+            return (reference_id(backend_conf, 'backend'), backend_conf.socket,
+                    backend_conf.stats)
+        other_ports = set([ports(bc) for bc in other])
+        return [bc for bc in backends if ports(bc) not in other_ports]
+
+    @classmethod
+    def update_port_usage(cls, removed=None, added=None):
+        """
+        Update used ports summary stored on backends with ports from removed
+        and added BackendRunPlanSettings.
+        """
+        backend_class = get_document('BackendServer')
+        for backend_conf in removed or []:
+            backend_class.objects(
+                id=reference_id(backend_conf, 'backend')).update_one(
+                    pull_all__used_ports=[backend_conf.socket,
+                                          backend_conf.stats])
+        for backend_conf in added or []:
+            backend_class.objects(
+                id=reference_id(backend_conf, 'backend')).update_one(
+                    add_to_set__used_ports=[backend_conf.socket,
+                                            backend_conf.stats])
+
+    @property
+    def safe_id(self):
+        return str(self.id)
 
     def backend_settings(self, backend):
         for backend_conf in self.backends:
-            if backend_conf.backend == backend:
+            if reference_id(backend_conf, 'backend') == str(backend.id):
                 return backend_conf
 
     def remove_backend_settings(self, backend):
+        backend_conf = self.backend_settings(backend)
         self.__class__.objects(id=self.id).update_one(
             pull__backends__backend=backend)
+        ledger.remove_backend(self, backend)
+        if backend_conf:
+            self.update_port_usage(removed=[backend_conf])
 
     def append_backend_settings(self, backend_conf):
         self.__class__.objects(id=self.id).update_one(
             push__backends=backend_conf)
+        ledger.add_backend(self, backend_conf)
+        self.update_port_usage(added=[backend_conf])
+
+    def set_backend_settings(self, backends):
+        """
+        Replace all backend settings with given list.
+        """
+        self.update_port_usage(removed=self.backends)
+        self.update(set__backends=backends)
+        ledger.set_backends(self, backends)
+        self.update_port_usage(added=backends)
+
+    @property
+    def active_backends(self):
+        """
+        Returns backend settings without instances that are being drained.
+        """
+        return [bc for bc in self.backends if not bc.draining]
+
+    @property
+    def draining_backends(self):
+        return [bc for bc in self.backends if bc.draining]
+
+    def mark_draining(self, backend):
+        self.__class__.objects(
+            id=self.id, backends__backend=backend).update_one(
+                set__backends__S__draining=True)
 
     def replace_backend_settings(self, backend, backend_conf, **kwargs):
         self.remove_backend_settings(backend)
@@ -114,7 +216,7 @@ class ApplicationRunPlan(Document):
     def is_valid(self):
         total_min = 0
         total_max = 0
-        for backend_conf in self.backends:
+        for backend_conf in self.active_backends:
             if not backend_conf.backend.is_enabled:
                 log.warning(_(
                     "Backend {backend} is disable, run plan for {name} is no "
@@ -136,5 +238,73 @@ class ApplicationRunPlan(Document):
         return True
 
 
+class LoadSample(EmbeddedDocument):
+    """
+    Load of all application instances running on backend at given time.
+    Short field names are used to keep buckets compact.
+    """
+    timestamp = DateTimeField(required=True, db_field='t')
+    rss = IntField(required=True, db_field='m',
+                   verbose_name=_('resident memory (MB)'))
+    requests = FloatField(required=True, db_field='r',
+                          verbose_name=_('requests per second'))
+    busy = IntField(required=True, db_field='b',
+                    verbose_name=_('busy workers'))
+
+
+class BackendLoadStats(Document):
+    """
+    Load samples collected on backend, samples are grouped into hourly
+    buckets, so each backend stores single document per hour. Buckets are
+    expired after a week.
+    """
+    backend = ReferenceField('BackendServer', dbref=False, required=True)
+    start = DateTimeField(required=True)
+    samples = ListField(EmbeddedDocumentField(LoadSample))
+
+    _default_manager = QuerySetManager()
+
+    meta = {
+        'indexes': [
+            ('backend', 'start'),
+            {'fields': ['start'], 'expireAfterSeconds': 7 * 24 * 3600},
+        ],
+    }
+
+    @classmethod
+    def bucket_start(cls, timestamp):
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def add_sample(cls, backend, sample):
+        cls.objects(backend=backend,
+                    start=cls.bucket_start(sample.timestamp)).update_one(
+            push__samples=sample, upsert=True)
+
+    @classmethod
+    def observed_load(cls, backends, window=300):
+        """
+        Returns dict with (average rss in MB, average requests per second)
+        tuple for each backend id (as string) that reported samples in last
+        window seconds.
+        """
+        since = datetime.now() - timedelta(seconds=window)
+        ret = {}
+        for row in cls.objects.aggregate(
+                {'$match': {'backend': {'$in': [b.id for b in backends]},
+                            'start': {'$gte': cls.bucket_start(since)}}},
+                {'$unwind': '$samples'},
+                {'$match': {'samples.t': {'$gte': since}}},
+                {'$group': {'_id': '$backend',
+                            'rss': {'$avg': '$samples.m'},
+                            'requests': {'$avg': '$samples.r'}}}):
+            ret[str(row['_id'])] = (row['rss'], row['requests'])
+        return ret
+
+
 signals.pre_delete.connect(ApplicationRunPlan.pre_delete,
                            sender=ApplicationRunPlan)
+signals.pre_save.connect(ApplicationRunPlan.pre_save,
+                         sender=ApplicationRunPlan)
+signals.post_save.connect(ApplicationRunPlan.post_save,
+                          sender=ApplicationRunPlan)
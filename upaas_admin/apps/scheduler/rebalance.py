@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import logging
+
+from django.utils.translation import ugettext as _
+from django.conf import settings
+
+from upaas_admin.apps.scheduler.models import (ApplicationRunPlan,
+                                               BackendRunPlanSettings)
+from upaas_admin.apps.scheduler.ledger import reference_id
+from upaas_admin.apps.scheduler.base import Scheduler
+
+
+log = logging.getLogger(__name__)
+
+
+class Move(object):
+    """
+    Single application instance move between backends.
+    """
+
+    def __init__(self, run_plan, backend_conf, source, target):
+        self.run_plan = run_plan
+        self.backend_conf = backend_conf
+        self.source = source
+        self.target = target
+
+    def __str__(self):
+        return "%s: %s -> %s" % (self.run_plan.application.name,
+                                 self.source.name, self.target.name)
+
+
+class Rebalancer(object):
+    """
+    Moves application instances away from overloaded backends. Instance is
+    first started on the new backend, old instance is only marked as
+    draining and it's stopped once new one is running.
+    """
+
+    def __init__(self, scheduler=None, max_moves=None):
+        """
+        :param max_moves: maximum number of moves in progress at the same
+                          time, default is taken from config
+        """
+        self.scheduler = scheduler or Scheduler()
+        if max_moves is None:
+            max_moves = settings.UPAAS_CONFIG.scheduler.rebalance.max_moves
+        self.max_moves = max_moves
+
+    @property
+    def moves_in_progress(self):
+        return ApplicationRunPlan.objects(backends__draining=True).count()
+
+    def charge(self, backend_id, backend_conf, memory_per_worker, ports=0):
+        for idx in range(0, backend_conf.workers_max):
+            self.scheduler.charge(backend_id, memory_per_worker,
+                                  ports=ports if idx == 0 else 0)
+
+    def release(self, backend_id, backend_conf, memory_per_worker, ports=0):
+        for idx in range(0, backend_conf.workers_max):
+            self.scheduler.release(backend_id, memory_per_worker,
+                                   ports=ports if idx == 0 else 0)
+
+    def instances(self, backend_id):
+        """
+        Returns list of (run plan, backend settings) tuples that can be moved
+        away from given backend, smallest instances are returned first.
+        """
+        ret = []
+        for run_plan in ApplicationRunPlan.objects(
+                backends__backend=self.scheduler.backend_by_id[backend_id]):
+            if run_plan.draining_backends or run_plan.application.flags:
+                # application is already being moved or modified
+                continue
+            backend_conf = run_plan.backend_settings(
+                self.scheduler.backend_by_id[backend_id])
+            ret.append((run_plan, backend_conf))
+        return sorted(ret, key=lambda i: (
+            i[1].workers_max * i[0].memory_per_worker, i[0].safe_id))
+
+    def pick_instance(self, backend_id, instances):
+        """
+        Select smallest instance that is enough to stop backend from being
+        overloaded, or the biggest one if there's no such instance.
+        """
+        for run_plan, backend_conf in instances:
+            self.release(backend_id, backend_conf, run_plan.memory_per_worker)
+            overloaded = self.scheduler.is_overloaded(backend_id)
+            self.charge(backend_id, backend_conf, run_plan.memory_per_worker)
+            if not overloaded:
+                return run_plan, backend_conf
+        return instances[-1]
+
+    def find_target(self, run_plan, backend_conf):
+        """
+        Find backend for instance, it must not be overloaded after instance
+        is moved there. Scores are updated if backend is found.
+        """
+        skip = [reference_id(bc, 'backend') for bc in run_plan.backends]
+        target = self.scheduler.queue.first(skip=skip)
+        if target is None:
+            return
+        self.charge(target, backend_conf, run_plan.memory_per_worker,
+                    ports=2)
+        if self.scheduler.is_overloaded(target):
+            self.release(target, backend_conf, run_plan.memory_per_worker,
+                         ports=2)
+            return
+        return target
+
+    def plan(self):
+        """
+        Calculate list of moves needed to fix overloaded backends, number of
+        moves is limited so that no more than max_moves are in progress.
+        """
+        self.scheduler.calculate_scores()
+        budget = self.max_moves - self.moves_in_progress
+        moves = []
+        overloaded = sorted(
+            [bid for bid in self.scheduler.scores
+             if self.scheduler.is_overloaded(bid)],
+            key=lambda bid: (-self.scheduler.scores[bid], bid))
+        for source in overloaded:
+            instances = self.instances(source)
+            while budget > 0 and instances and \
+                    self.scheduler.is_overloaded(source):
+                run_plan, backend_conf = self.pick_instance(source, instances)
+                instances.remove((run_plan, backend_conf))
+                target = self.find_target(run_plan, backend_conf)
+                if target is None:
+                    continue
+                self.release(source, backend_conf, run_plan.memory_per_worker,
+                             ports=2)
+                moves.append(Move(run_plan, backend_conf,
+                                  self.scheduler.backend_by_id[source],
+                                  self.scheduler.backend_by_id[target]))
+                budget -= 1
+            if self.scheduler.is_overloaded(source):
+                log.warning(_("Backend {name} is still overloaded").format(
+                    name=self.scheduler.backend_by_id[source].name))
+        return moves
+
+    def execute(self, move):
+        """
+        Start instance on the new backend and mark old one as draining.
+        Returns False if move can't be started.
+        """
+        ports = self.scheduler.port_allocator(move.target).allocate(2)
+        if not ports:
+            log.error(_("No free ports found on backend {name}").format(
+                name=move.target.name))
+            return False
+        backend_conf = BackendRunPlanSettings(
+            backend=move.target, package=move.backend_conf.package,
+            socket=ports[0], stats=ports[1],
+            workers_min=move.backend_conf.workers_min,
+            workers_max=move.backend_conf.workers_max)
+        move.run_plan.append_backend_settings(backend_conf)
+        move.run_plan.mark_draining(move.source)
+        log.info(_("Moving {move}").format(move=move))
+        move.run_plan.application.reschedule_flags([], [move.target])
+        return True
+
+    def rebalance(self):
+        """
+        Plan and start moves, returns list of moves started.
+        """
+        return [move for move in self.plan() if self.execute(move)]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.utils.translation import ugettext as _
+
+
+class BackendScorer(object):
+    """
+    Base class for backend scorers. Scorer gets load of each resource on
+    backend (cpu, memory and ports, as a fraction of total capacity) and
+    returns score, backend with lowest score is preferred.
+    """
+
+    name = None
+
+    def __init__(self, cpu=1, memory=1, ports=1):
+        """
+        :param cpu: weight of cpu load
+        :param memory: weight of memory load
+        :param ports: weight of port pool usage
+        """
+        self.weights = {'cpu': cpu, 'memory': memory, 'ports': ports}
+
+    def weighted(self, cpu_load, mem_load, port_load):
+        return [(self.weights['cpu'], cpu_load),
+                (self.weights['memory'], mem_load),
+                (self.weights['ports'], port_load)]
+
+    def score(self, cpu_load, mem_load, port_load):
+        raise NotImplementedError
+
+
+class WeightedScorer(BackendScorer):
+    """
+    Score is weighted average of all resource loads.
+    """
+
+    name = 'weighted'
+
+    def score(self, cpu_load, mem_load, port_load):
+        values = self.weighted(cpu_load, mem_load, port_load)
+        total = sum([weight for weight, __ in values])
+        if not total:
+            return 0
+        return sum([weight * load for weight, load in values]) / float(total)
+
+
+class DominantResourceScorer(BackendScorer):
+    """
+    Score is the load of the most used resource (scaled by its weight), so
+    backends that are saturated on any single resource are avoided.
+    """
+
+    name = 'dominant'
+
+    def score(self, cpu_load, mem_load, port_load):
+        return max([weight * load for weight, load in
+                    self.weighted(cpu_load, mem_load, port_load)])
+
+
+SCORERS = dict((cls.name, cls) for cls in [WeightedScorer,
+                                           DominantResourceScorer])
+
+
+def get_scorer(name=None):
+    """
+    Returns scorer instance with weights from config, scorer selected in
+    config is used if name is not given.
+    """
+    config = settings.UPAAS_CONFIG.scheduler
+    name = name or config.scorer
+    if name not in SCORERS:
+        raise ValueError(_("Unknown scorer: {name}").format(name=name))
+    return SCORERS[name](cpu=config.weights.cpu,
+                         memory=config.weights.memory,
+                         ports=config.weights.ports)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import json
+
+from bson import ObjectId
+
+from upaas_admin.apps.servers.models import BackendServer
+from upaas_admin.apps.scheduler.models import ApplicationRunPlan
+from upaas_admin.apps.scheduler.ledger import AllocationLedger
+from upaas_admin.apps.scheduler.base import Scheduler
+from upaas_admin.apps.scheduler.scoring import get_scorer
+
+
+class ClusterSnapshot(object):
+    """
+    Recorded cluster state - backends, their allocations and run plans.
+    Snapshot can be saved as json file and replayed through scheduler
+    without touching the database.
+    """
+
+    def __init__(self, backends=None, allocations=None, run_plans=None):
+        """
+        :param backends: list of dicts with backend id, name, cpu_cores,
+                         memory_mb, used_ports and optional rack and zone
+        :param allocations: list of (plan id, application id, backend id,
+                            cpu, memory) rows, same as used by
+                            AllocationLedger.load_rows()
+        :param run_plans: list of dicts with application id, workers_min,
+                          workers_max, memory_per_worker and optional
+                          spread_by
+        """
+        self.backends = backends or []
+        self.allocations = allocations or []
+        self.run_plans = run_plans or []
+
+    @classmethod
+    def record(cls):
+        """
+        Record current cluster state.
+        """
+        backends = []
+        for backend in BackendServer.objects(is_enabled=True):
+            backends.append({'id': backend.safe_id, 'name': backend.name,
+                             'cpu_cores': backend.cpu_cores,
+                             'memory_mb': backend.memory_mb,
+                             'used_ports': list(backend.used_ports),
+                             'rack': backend.rack, 'zone': backend.zone})
+        allocations = []
+        for row in ApplicationRunPlan.objects.aggregate(
+                *AllocationLedger.pipeline):
+            for entry in row['plans']:
+                allocations.append([str(entry['plan']),
+                                    str(entry['application']),
+                                    str(row['_id']), entry['cpu'],
+                                    entry['mem']])
+        run_plans = []
+        for row in ApplicationRunPlan._get_collection().find(
+                {}, ['application', 'workers_min', 'workers_max',
+                     'memory_per_worker', 'spread_by']):
+            run_plans.append({'application': str(row['application']),
+                              'workers_min': row['workers_min'],
+                              'workers_max': row['workers_max'],
+                              'memory_per_worker': row['memory_per_worker'],
+                              'spread_by': row.get('spread_by')})
+        return cls(backends=backends, allocations=allocations,
+                   run_plans=run_plans)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as snapshot:
+            return cls(**json.load(snapshot))
+
+    def save(self, path):
+        with open(path, 'w') as snapshot:
+            json.dump({'backends': self.backends,
+                       'allocations': self.allocations,
+                       'run_plans': self.run_plans}, snapshot, indent=2)
+
+    def create_scheduler(self, scorer, exclude_applications=None):
+        """
+        Returns Scheduler using in memory copy of recorded state, allocations
+        of applications from exclude_applications (list of ids) are skipped.
+        """
+        exclude_applications = exclude_applications or []
+        backends = [BackendServer(id=ObjectId(b['id']), name=b['name'],
+                                  cpu_cores=b['cpu_cores'],
+                                  memory_mb=b['memory_mb'],
+                                  used_ports=b['used_ports'],
+                                  rack=b.get('rack'), zone=b.get('zone'))
+                    for b in self.backends]
+        allocations = AllocationLedger(max_age=None)
+        allocations.load_rows([tuple(row) for row in self.allocations
+                               if row[1] not in exclude_applications])
+        return Scheduler(allocations=allocations, backends=backends,
+                         scorer=scorer, live_load=False)
+
+
+class SimulationResult(object):
+    """
+    Placements made during simulation and load of every backend after all
+    run plans were placed.
+    """
+
+    def __init__(self, scorer, scheduler, placements, failed):
+        self.scorer = scorer
+        self.scheduler = scheduler
+        self.placements = placements
+        self.failed = failed
+
+    def load_summary(self, loads):
+        values = list(loads.values()) or [0]
+        mean = sum(values) / float(len(values))
+        stddev = (sum([(v - mean) ** 2 for v in values]) /
+                  float(len(values))) ** 0.5
+        return {'max': max(values), 'mean': mean, 'stddev': stddev}
+
+    def summary(self):
+        return {
+            'scorer': self.scorer.name,
+            'placed': len(self.placements),
+            'failed': self.failed,
+            'cpu': self.load_summary(self.scheduler.cpu_load),
+            'memory': self.load_summary(self.scheduler.mem_load),
+            'ports': self.load_summary(self.scheduler.port_load),
+        }
+
+
+def simulate(snapshot, scorer):
+    """
+    Reschedule all run plans from snapshot using given scorer, run plans are
+    placed in the same order as Scheduler.schedule_many() would place them.
+    Returns SimulationResult.
+    """
+    run_plans = sorted(
+        snapshot.run_plans,
+        key=lambda rp: rp['workers_max'] * rp['memory_per_worker'],
+        reverse=True)
+    current = {}
+    for __, app_id, backend_id, __, __ in snapshot.allocations:
+        current.setdefault(app_id, []).append(backend_id)
+    scheduler = snapshot.create_scheduler(
+        scorer, exclude_applications=[rp['application'] for rp in run_plans])
+    scheduler.calculate_scores()
+    placements = {}
+    failed = 0
+    for run_plan in run_plans:
+        plan_min, plan_max = scheduler.plan_workers(
+            run_plan['workers_min'], run_plan['workers_max'],
+            run_plan['memory_per_worker'],
+            current=current.get(run_plan['application']),
+            spread_by=run_plan.get('spread_by'))
+        if plan_max:
+            placements[run_plan['application']] = plan_max
+        else:
+            failed += 1
+    return SimulationResult(scorer, scheduler, placements, failed)
+
+
+def what_if(application_id, workers_min, workers_max, memory_per_worker,
+            spread_by=None, scorer=None, snapshot=None):
+    """
+    Simulate scheduling of application with given limits without modifying
+    anything. Current cluster state is recorded if snapshot is not passed.
+    Returns dict with placement and projected load and score of every
+    backend.
+
+    :param application_id: id (string) of application, its current
+                           allocations are not counted
+    """
+    if snapshot is None:
+        snapshot = ClusterSnapshot.record()
+    scheduler = snapshot.create_scheduler(
+        scorer or get_scorer(), exclude_applications=[application_id])
+    scheduler.calculate_scores()
+    current_scores = dict(scheduler.scores)
+    current = [backend_id for __, app_id, backend_id, __, __ in
+               snapshot.allocations if app_id == application_id]
+    plan_min, plan_max = scheduler.plan_workers(
+        workers_min, workers_max, memory_per_worker, current=current,
+        spread_by=spread_by)
+
+    backends = []
+    for backend in scheduler.backends:
+        bid = backend.safe_id
+        backends.append({
+            'id': bid,
+            'name': backend.name,
+            'workers_min': plan_min.get(bid, 0),
+            'workers_max': plan_max.get(bid, 0),
+            'cpu_load': scheduler.cpu_load[bid],
+            'memory_load': scheduler.mem_load[bid],
+            'ports_load': scheduler.port_load[bid],
+            'current_score': current_scores[bid],
+            'projected_score': scheduler.scores[bid],
+            'overloaded': scheduler.is_overloaded(bid),
+        })
+    return {
+        'scorer': scheduler.scorer.name,
+        'workers_min': sum(plan_min.values()),
+        'workers_max': sum(plan_max.values()),
+        'placed': bool(plan_max),
+        'backends': sorted(backends, key=lambda b: (-b['workers_max'],
+                                                    b['name'])),
+    }
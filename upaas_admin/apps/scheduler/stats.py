@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import logging
+from datetime import datetime
+from time import sleep
+from threading import Thread
+
+from django.utils.translation import ugettext as _
+
+from upaas_admin.common.uwsgi import fetch_json_stats
+from upaas_admin.apps.scheduler.models import (ApplicationRunPlan,
+                                               BackendLoadStats, LoadSample)
+
+
+log = logging.getLogger(__name__)
+
+
+class StatsCollector(object):
+    """
+    Periodically samples uWSGI stats of all application instances running on
+    backend and stores totals as BackendLoadStats.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.exiting = False
+        self.interval = 60
+        # application id -> (timestamp, total requests counter)
+        self.counters = {}
+
+    def stats_ports(self):
+        """
+        Returns list of (application id, stats port) tuples for every
+        application scheduled on this backend.
+        """
+        return [(str(row['application']), row['stats']) for row in
+                ApplicationRunPlan.objects(
+                    backends__backend=self.backend).aggregate(
+                    {'$unwind': '$backends'},
+                    {'$match': {'backends.backend': self.backend.id}},
+                    {'$project': {'application': '$application',
+                                  'stats': '$backends.stats'}})]
+
+    def request_rate(self, app_id, timestamp, requests):
+        """
+        Returns requests per second since last sample of given application.
+        """
+        previous = self.counters.get(app_id)
+        self.counters[app_id] = (timestamp, requests)
+        if previous is None:
+            return 0
+        elapsed = (timestamp - previous[0]).total_seconds()
+        if elapsed <= 0 or requests < previous[1]:
+            # counters are reset after application restart
+            return 0
+        return (requests - previous[1]) / elapsed
+
+    def sample(self):
+        """
+        Collect single sample, returns LoadSample instance.
+        """
+        timestamp = datetime.now()
+        ip = str(self.backend.ip)
+        rss = 0
+        requests = 0
+        busy = 0
+        seen = set()
+        for app_id, port in self.stats_ports():
+            seen.add(app_id)
+            stats = fetch_json_stats(ip, port)
+            if not stats:
+                continue
+            workers = stats.get('workers', [])
+            rss += sum([w.get('rss', 0) for w in workers])
+            busy += len([w for w in workers if w.get('status') == 'busy'])
+            requests += self.request_rate(
+                app_id, timestamp, sum([w.get('requests', 0)
+                                        for w in workers]))
+        for app_id in list(self.counters.keys()):
+            if app_id not in seen:
+                del self.counters[app_id]
+        return LoadSample(timestamp=timestamp, rss=rss // 1024 // 1024,
+                          requests=requests, busy=busy)
+
+    def collect(self):
+        try:
+            BackendLoadStats.add_sample(self.backend, self.sample())
+        except Exception as e:
+            log.error(_("Failed to collect load stats on {name}: "
+                        "{e}").format(name=self.backend.name, e=e))
+
+    def collector(self):
+        while not self.exiting:
+            self.collect()
+            sleep(self.interval)
+
+    def start(self, interval=60):
+        self.interval = interval
+        t1 = Thread(target=self.collector)
+        t1.daemon = True
+        t1.start()
+
+    def stop(self):
+        self.exiting = True
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
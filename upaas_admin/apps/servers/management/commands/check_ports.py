@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import logging
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from upaas_admin.apps.servers.models import BackendServer
+
+
+log = logging.getLogger("check_ports")
+
+
+class Command(BaseCommand):
+
+    help = 'Check used ports summary stored on backends against run plans'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--fix', action='store_true', dest='fix', default=False,
+                    help='Rebuild summary for backends with mismatched '
+                         'ports'),
+    )
+
+    def handle(self, *args, **options):
+        errors = 0
+        for backend in BackendServer.objects():
+            missing, unexpected = backend.rebuild_used_ports(
+                check_only=not options['fix'])
+            if missing or unexpected:
+                errors += 1
+                self.stdout.write(
+                    '%s: missing ports: %s, unexpected ports: %s\n' % (
+                        backend.name,
+                        ', '.join([str(p) for p in missing]) or '-',
+                        ', '.join([str(p) for p in unexpected]) or '-'))
+        if errors and options['fix']:
+            self.stdout.write('Used ports rebuilt on %d backend(s)\n' % errors)
+        elif errors:
+            self.stdout.write('%d backend(s) with invalid used ports\n' %
+                              errors)
+        else:
+            self.stdout.write('All backends are consistent\n')
@@ -38,15 +38,29 @@ class BackendServer(Document):
                          verbose_name=_('Physical memory (MB)'))
     cpu_cores = IntField(required=True, min_value=1,
                          verbose_name=_('CPU cores'))
+    rack = StringField(max_length=64, verbose_name=_('rack'))
+    zone = StringField(max_length=64, verbose_name=_('zone'))
     worker_ping = DictField()
+    last_ping = DateTimeField()
+    used_ports = ListField(IntField())
 
     _default_manager = QuerySetManager()
 
     meta = {
-        'indexes': ['name', 'ip', 'is_enabled'],
+        'indexes': ['name', 'ip', 'is_enabled', 'last_ping'],
         'ordering': ['name'],
     }
 
+    @classmethod
+    def ensure_worker_ping_index(cls, name):
+        """
+        Index ping timestamps of given mule, mule names are not known upfront
+        so this can't be declared in meta. pymongo caches created indexes,
+        repeated calls don't hit the database.
+        """
+        cls._get_collection().ensure_index('worker_ping.%s' % name,
+                                           sparse=True, background=True)
+
     @property
     def safe_id(self):
         return str(self.id)
@@ -70,21 +84,41 @@ class BackendServer(Document):
     @property
     def allocated_ports(self):
         """
-        Returns all port number allocated to apps.
+        Returns all port number allocated to apps. Ports are read from
+        summary stored on backend document, which is updated every time run
+        plan backend settings are modified.
         """
+        return self.used_ports
 
+    def calculate_allocated_ports(self):
+        """
+        Returns all port number allocated to apps using run plans.
+        """
         ports = []
-        for run_plan in self.run_plans:
-            backend_conf = run_plan.backend_settings(self)
-            if backend_conf:
-                ports.append(backend_conf.socket)
-                ports.append(backend_conf.stats)
-            else:
-                log.warning(_("Backend {backend} not found in run plan for "
-                              "{name}").format(
-                            backend=self.name, name=run_plan.application.name))
+        for row in ApplicationRunPlan.objects(
+                backends__backend=self).aggregate(
+                {'$unwind': '$backends'},
+                {'$match': {'backends.backend': self.id}},
+                {'$project': {'socket': '$backends.socket',
+                              'stats': '$backends.stats'}}):
+            ports.append(row['socket'])
+            ports.append(row['stats'])
         return ports
 
+    def rebuild_used_ports(self, check_only=False):
+        """
+        Compare used ports summary with ports allocated in run plans and
+        replace it with calculated list unless check_only is set.
+        Returns tuple with (missing, unexpected) port lists.
+        """
+        ports = self.calculate_allocated_ports()
+        missing = sorted(set(ports) - set(self.used_ports))
+        unexpected = sorted(set(self.used_ports) - set(ports))
+        if not check_only and (missing or unexpected):
+            self.update(set__used_ports=sorted(set(ports)))
+            self.reload()
+        return missing, unexpected
+
     @property
     def maximum_ports(self):
         return self.port_max - self.port_min
@@ -95,36 +129,201 @@ class BackendServer(Document):
 
     @property
     def is_healthy(self):
-        if not self.worker_ping:
+        if not self.last_ping or not self.worker_ping:
             return False
         limit = datetime.datetime.now() - datetime.timedelta(seconds=300)
-        for timestamp in list(self.worker_ping.values()):
-            if timestamp < limit:
-                return False
-        return True
+        if self.last_ping < limit:
+            return False
+        return min(self.worker_ping.values()) >= limit
+
+    @classmethod
+    def stale(cls, age=300):
+        """
+        Returns enabled backends that didn't send any heartbeat for given
+        number of seconds.
+        """
+        return cls.objects(is_enabled__ne=False, last_ping__lte=(
+            datetime.datetime.now() - datetime.timedelta(seconds=age)))
 
     def application_settings(self, application):
         return self.run_plans.filter(application=application).first()
 
-    def find_free_ports(self, count):
+    def find_free_ports(self, count, exclude=None):
         """
-        Find and return random port number not allocated to any application.
-        Return None if no such port can be found.
+        Find, reserve and return list of port numbers not allocated to any
+        application. Ports from exclude list will also be skipped.
+        Return None if no such ports can be found.
+        """
+        allocator = PortAllocator(self)
+        allocator.load()
+        allocator.mark_used(exclude or [])
+        return allocator.allocate(count)
+
+
+class PortLease(EmbeddedDocument):
+    """
+    Single reserved port.
+    """
+    port = IntField(required=True)
+    expires = DateTimeField(required=True)
+
+
+class PortReservation(Document):
+    """
+    Ports reserved on backend that might not be saved in any run plan yet.
+    Reservation is made with single atomic update that only succeeds if none
+    of requested ports is already reserved.
+    """
+    backend = ReferenceField(BackendServer, dbref=False, required=True,
+                             unique=True, reverse_delete_rule=CASCADE)
+    leases = ListField(EmbeddedDocumentField(PortLease))
+
+    _default_manager = QuerySetManager()
+
+    @classmethod
+    def reserve(cls, backend, ports, ttl=300):
+        """
+        Try to reserve all ports, returns True on success or False if any of
+        the ports is already reserved.
+        """
+        now = datetime.datetime.now()
+        cls._get_collection().update(
+            {'backend': backend.id},
+            {'$pull': {'leases': {'expires': {'$lt': now}}}})
+        expires = now + datetime.timedelta(seconds=ttl)
+        try:
+            return bool(cls.objects(
+                backend=backend, leases__port__nin=ports).update_one(
+                    push_all__leases=[PortLease(port=port, expires=expires)
+                                      for port in ports], upsert=True))
+        except NotUniqueError:
+            # reservation document exists and it already contains at least
+            # one of requested ports
+            return False
+
+    @classmethod
+    def release(cls, backend, ports):
+        cls._get_collection().update(
+            {'backend': backend.id},
+            {'$pull': {'leases': {'port': {'$in': ports}}}})
+
+    @classmethod
+    def reserved_ports(cls, backend):
+        now = datetime.datetime.now()
+        reservation = cls.objects(backend=backend).first()
+        if reservation:
+            return [lease.port for lease in reservation.leases
+                    if lease.expires >= now]
+        return []
+
+
+class PortAllocator(object):
+    """
+    Tracks ports allocated on backend using a bitmap covering whole
+    port_min..port_max range.
+    """
+
+    def __init__(self, backend, ttl=300, attempts=5):
+        """
+        :param ttl: number of seconds allocated ports are reserved for, ports
+                    must be saved in run plan before reservation expires
+        :param attempts: how many times to retry reservation if some other
+                         process reserved selected ports
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.attempts = attempts
+        self.port_min = backend.port_min
+        self.port_max = backend.port_max
+        self.size = self.port_max - self.port_min + 1
+        self.bitmap = bytearray((self.size + 7) // 8)
+        self.used = 0
+
+    @property
+    def available(self):
+        return self.size - self.used
+
+    def is_used(self, port):
+        idx = port - self.port_min
+        return bool(self.bitmap[idx >> 3] & (1 << (idx & 7)))
+
+    def mark_used(self, ports):
+        for port in ports:
+            if self.port_min <= port <= self.port_max and \
+                    not self.is_used(port):
+                idx = port - self.port_min
+                self.bitmap[idx >> 3] |= 1 << (idx & 7)
+                self.used += 1
+
+    def mark_free(self, ports):
+        for port in ports:
+            if self.port_min <= port <= self.port_max and self.is_used(port):
+                idx = port - self.port_min
+                self.bitmap[idx >> 3] &= ~(1 << (idx & 7)) & 0xff
+                self.used -= 1
+
+    def load(self):
+        """
+        Load all ports allocated on backend and ports reserved by other
+        allocators that are not saved in run plans yet.
+        """
+        self.bitmap = bytearray((self.size + 7) // 8)
+        self.used = 0
+        self.mark_used(self.backend.calculate_allocated_ports())
+        self.mark_used(PortReservation.reserved_ports(self.backend))
+
+    def find(self, count):
+        """
+        Find given number of free ports without reserving them. Search starts
+        at random offset to lower the chance of collision with other
+        allocators.
         """
         ports = []
-        if self.ports_available <= 0:
-            log.error("No more free port available, used all %d "
-                      "ports" % self.maximum_ports)
-            return
-        while True:
-            # TODO random can take very long to find free port if port usage is
-            # TODO high, maybe linear search would be better?
-            port = randrange(self.port_min, self.port_max+1)
-            if port not in self.allocated_ports and port not in ports:
-                ports.append(port)
-            if len(ports) == count:
+        idx = randrange(0, self.size)
+        scanned = 0
+        while scanned < self.size and len(ports) < count:
+            byte = self.bitmap[idx >> 3]
+            if byte == 0xff and idx & 7 == 0 and idx + 8 <= self.size:
+                # whole byte is used, skip it
+                step = 8
+            else:
+                if not byte & (1 << (idx & 7)):
+                    ports.append(self.port_min + idx)
+                step = 1
+            idx = (idx + step) % self.size
+            scanned += step
+        return ports
+
+    def allocate(self, count):
+        """
+        Find and reserve given number of ports. Return None if no free ports
+        can be found.
+        """
+        for __ in range(0, self.attempts):
+            if self.available < count:
+                log.error(_("No more free port available on {name}, used "
+                            "{used} out of {size} ports").format(
+                    name=self.backend.name, used=self.used, size=self.size))
+                return
+            ports = self.find(count)
+            if len(ports) < count:
+                break
+            if PortReservation.reserve(self.backend, ports, ttl=self.ttl):
+                self.mark_used(ports)
                 return ports
-        return []
+            log.debug(_("Ports {ports} already reserved on {name}, "
+                        "retrying").format(ports=ports,
+                                           name=self.backend.name))
+            self.mark_used(PortReservation.reserved_ports(self.backend))
+        log.error(_("Couldn't reserve {count} port(s) on {name}").format(
+            count=count, name=self.backend.name))
+
+    def release(self, ports):
+        """
+        Release ports that were allocated but won't be used.
+        """
+        PortReservation.release(self.backend, ports)
+        self.mark_free(ports)
 
 
 class RouterServer(Document):
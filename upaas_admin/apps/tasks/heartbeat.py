@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import logging
+import socket
+from datetime import datetime
+from random import uniform
+from select import select
+from threading import Thread
+from time import time, sleep
+
+from django.utils.translation import ugettext as _
+
+from upaas_admin.apps.servers.models import BackendServer
+
+
+log = logging.getLogger(__name__)
+
+
+class Heartbeat(object):
+    """
+    Health check pings shared by all mules running on the same host. First
+    mule binds local (abstract unix) socket and becomes heartbeat writer,
+    other mules connect to it and register their names. Writer sends single
+    update with pings for all registered mules every interval and notifies
+    connected mules about every successful write. If writer exits one of the
+    connected mules takes over.
+    """
+
+    def __init__(self, backend, interval=60, jitter=0.1, clock=time):
+        """
+        :param interval: number of seconds between writes
+        :param jitter: interval is randomized by this fraction, so that
+                       backends are not writing at the same moment
+        :param clock: function returning current time in seconds, used to
+                      schedule writes
+        """
+        self.backend = backend
+        self.interval = interval
+        self.jitter = jitter
+        self.names = set()
+        self.address = str('\0upaas-heartbeat-%s' % backend.safe_id)
+        self.exiting = False
+        self.is_writer = False
+        self.last_write = None
+        self.failures = 0
+        self.clock = clock
+        self.server = None
+        self.clients = {}
+        self.next_write = None
+        self.client = None
+        self.buf = b''
+        self.thread = None
+
+    def add(self, name):
+        self.names.add(name)
+
+    def next_interval(self):
+        return self.interval * uniform(1 - self.jitter, 1 + self.jitter)
+
+    def write(self, names):
+        """
+        Store ping timestamp for all given mule names using single update,
+        returns True on success.
+        """
+        now = datetime.now()
+        update = {'last_ping': now}
+        for name in names:
+            update['worker_ping.%s' % name] = now
+        try:
+            BackendServer._get_collection().update({'_id': self.backend.id},
+                                                   {'$set': update})
+        except Exception as e:
+            self.failures += 1
+            log.error(_("Heartbeat write failed ({count} in a row): "
+                        "{e}").format(count=self.failures, e=e))
+            return False
+        self.failures = 0
+        self.last_write = now
+        return True
+
+    def listen(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.address)
+            sock.listen(16)
+        except socket.error:
+            sock.close()
+            return
+        return sock
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.address)
+            sock.sendall(''.join(['%s\n' % name for name in
+                                  self.names]).encode('utf-8'))
+        except socket.error:
+            sock.close()
+            return
+        return sock
+
+    def open(self):
+        """
+        Become heartbeat writer or connect to the current one, returns False
+        if neither is possible right now.
+        """
+        server = self.listen()
+        if server:
+            self.server = server
+            # socket -> [registered names, unparsed data]
+            self.clients = {}
+            self.next_write = self.clock()
+            self.is_writer = True
+            return True
+        self.client = self.connect()
+        self.buf = b''
+        return self.client is not None
+
+    def close(self):
+        if self.server:
+            for sock in self.clients:
+                sock.close()
+            self.clients = {}
+            self.server.close()
+            self.server = None
+            self.is_writer = False
+        if self.client:
+            self.client.close()
+            self.client = None
+
+    def tick(self, timeout=0):
+        """
+        Handle socket events and write pings if it's time to do so, waits
+        up to timeout seconds for events. Returns False if connection to
+        the writer was lost.
+        """
+        if self.server:
+            self.serve(timeout)
+            return True
+        return self.follow(timeout)
+
+    def serve(self, timeout):
+        """
+        Accept registrations from other mules and write pings.
+        """
+        timeout = min(max(self.next_write - self.clock(), 0), timeout)
+        readable = select([self.server] + list(self.clients.keys()), [], [],
+                          timeout)[0]
+        for sock in readable:
+            if sock is self.server:
+                conn = self.server.accept()[0]
+                self.clients[conn] = [set(), b'']
+                continue
+            try:
+                data = sock.recv(4096)
+            except socket.error:
+                data = b''
+            if not data:
+                sock.close()
+                del self.clients[sock]
+                continue
+            lines = (self.clients[sock][1] + data).split(b'\n')
+            self.clients[sock][1] = lines.pop()
+            for line in lines:
+                if line:
+                    self.clients[sock][0].add(line.decode('utf-8'))
+                    # write ping for new mule right away
+                    self.next_write = self.clock()
+        if self.clock() >= self.next_write:
+            names = set(self.names)
+            for registered, __ in self.clients.values():
+                names.update(registered)
+            if self.write(names):
+                ack = ('%f\n' % time()).encode('utf-8')
+                for sock in list(self.clients.keys()):
+                    try:
+                        sock.sendall(ack)
+                    except socket.error:
+                        sock.close()
+                        del self.clients[sock]
+            self.next_write = self.clock() + self.next_interval()
+
+    def follow(self, timeout):
+        """
+        Wait for write notifications from the writer.
+        """
+        if not select([self.client], [], [], timeout)[0]:
+            return True
+        try:
+            data = self.client.recv(4096)
+        except socket.error:
+            data = b''
+        if not data:
+            return False
+        lines = (self.buf + data).split(b'\n')
+        self.buf = lines.pop()
+        if lines:
+            self.last_write = datetime.fromtimestamp(
+                float(lines[-1].decode('utf-8')))
+        return True
+
+    def run(self):
+        try:
+            while not self.exiting:
+                if not self.server and not self.client:
+                    if not self.open():
+                        # writer socket is being closed or was just bound
+                        sleep(uniform(0.1, 1))
+                        continue
+                if not self.tick(timeout=1):
+                    log.info(_("Heartbeat writer is gone, taking over"))
+                    self.close()
+        finally:
+            self.close()
+
+    def start(self):
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.exiting = True
+        if self.thread:
+            self.thread.join(5)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import logging
+from socket import gethostname
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from upaas_admin.apps.servers.models import BackendServer
+from upaas_admin.apps.tasks.mule import MuleTaskHelper
+
+
+log = logging.getLogger("cleanup")
+
+
+class Command(NoArgsCommand):
+
+    help = 'Clean tasks and flag locks left by crashed mules'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--backend', dest='backend', default=gethostname(),
+                    help='Name of local backend (default is hostname)'),
+        make_option('--mule-name', dest='mule_name', default='Backend',
+                    help='Name of mule whose health check pings are used to '
+                         'find non responsive backends (default is '
+                         'Backend)'),
+    )
+
+    def handle_noargs(self, **options):
+        backend = BackendServer.objects(name=options['backend']).first()
+        if not backend:
+            raise CommandError('Backend %s not found' % options['backend'])
+        cleaned = MuleTaskHelper(options['mule_name']).clean(backend,
+                                                             force=True)
+        for name in sorted(cleaned.keys()):
+            self.stdout.write('%s: %d\n' % (name.replace('_', ' '),
+                                            cleaned[name]))
@@ -12,17 +12,22 @@ from datetime import datetime, timedelta
 import os
 import logging
 
-from django.utils.translation import ugettext as _
+from optparse import make_option
 
-from upaas.checksum import calculate_file_sha256, calculate_string_sha256
+from django.utils.translation import ugettext as _
+from django.conf import settings
 
-from upaas_admin.apps.applications.models import ApplicationFlag
-from upaas_admin.apps.scheduler.models import ApplicationRunPlan
+from upaas_admin.apps.scheduler.stats import StatsCollector
+from upaas_admin.apps.scheduler.rebalance import Rebalancer
 from upaas_admin.apps.applications.constants import (
     NeedsRestartFlag, NeedsStoppingFlag, IsStartingFlag, NeedsUpgradeFlag,
-    NeedsReschedulingFlag)
+    NeedsReschedulingFlag, NeedsStagingFlag)
+from upaas_admin.apps.applications.models import ApplicationFlag, Package
 from upaas_admin.apps.tasks.mule import MuleCommand
-from upaas_admin.common.uwsgi import fetch_json_stats
+from upaas_admin.apps.tasks.reconcile import BackendReconciler
+from upaas_admin.apps.tasks.watcher import VassalWatcher
+from upaas_admin.common.uwsgi import (fetch_json_stats, stats_generation,
+                                      generation_changed, stats_ready)
 from upaas_admin.apps.applications.exceptions import UnpackError
 
 
@@ -34,45 +39,92 @@ class Command(MuleCommand):
     mule_name = _('Backend')
     mule_flags = [NeedsStoppingFlag.name, NeedsRestartFlag.name,
                   IsStartingFlag.name, NeedsUpgradeFlag.name,
-                  NeedsReschedulingFlag.name]
+                  NeedsReschedulingFlag.name, NeedsStagingFlag.name]
+
+    option_list = MuleCommand.option_list + (
+        make_option('--stats-interval', dest='stats_interval', type=int,
+                    default=60, help=_('Application load stats sampling '
+                                       'interval, 0 disables sampling '
+                                       '(default is 60 seconds)')),
+        make_option('--rebalance-interval', dest='rebalance_interval',
+                    type=int, default=0,
+                    help=_('Move instances away from overloaded backends '
+                           'every given number of seconds (default is 0, '
+                           'disabled)')),
+        make_option('--scan-interval', dest='scan_interval', type=int,
+                    default=60, help=_('Check all local applications every '
+                                       'given number of seconds (default is '
+                                       '60 seconds)')),
+        make_option('--watch', action='store_true', dest='watch',
+                    default=False,
+                    help=_('Watch vassal and package directories and check '
+                           'affected applications right away, full scan '
+                           'can be run less often then')),
+    )
 
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
         self.last_app_check = None
+        self.last_rebalance = None
+        self.rebalance_interval = 0
+        self.scan_interval = 60
+        self.stats_collector = StatsCollector(self.backend)
+        self.watcher = None
+
+    def handle_noargs(self, **options):
+        self.rebalance_interval = options['rebalance_interval']
+        self.scan_interval = options['scan_interval']
+        if options['stats_interval'] > 0:
+            self.stats_collector.start(interval=options['stats_interval'])
+        if options['watch']:
+            self.watcher = VassalWatcher(settings.UPAAS_CONFIG.paths.vassals,
+                                         settings.UPAAS_CONFIG.paths.apps)
+            self.watcher.start()
+        try:
+            super(Command, self).handle_noargs(**options)
+        finally:
+            self.stats_collector.stop()
+            if self.watcher:
+                self.watcher.stop()
+
+    def has_pending_work(self):
+        return self.watcher is not None and self.watcher.pending
 
     def handle_task(self):
         task_handled = super(Command, self).handle_task()
         if task_handled:
             return task_handled
-        if self.last_app_check and self.last_app_check >= (
-                datetime.now() - timedelta(seconds=60)):
+        self.rebalance()
+        reconciler = BackendReconciler(self.backend,
+                                       is_running=self.is_application_running)
+        rescan = False
+        if self.watcher and self.watcher.pending:
+            applications, packages, rescan = self.watcher.changes()
+            applications = set(applications)
+            applications.update(reconciler.package_applications(packages))
+            if applications and not rescan:
+                reconciler.reconcile(application_ids=applications)
+        if not rescan and self.last_app_check and self.last_app_check >= (
+                datetime.now() - timedelta(seconds=self.scan_interval)):
             return False
         self.last_app_check = datetime.now()
-        for app in ApplicationRunPlan.objects(
-                backends__backend=self.backend).distinct('application'):
-            if app.flags:
-                continue
-            if not self.is_application_running(app):
-                log.info(_("Application {name} is not running, "
-                           "starting").format(name=app.name))
-                ApplicationFlag.objects(
-                    application=app, name=IsStartingFlag.name).update_one(
-                        add_to_set__pending_backends=self.backend, upsert=True)
-            elif not self.is_vassal_config_valid(app):
-                log.info(_("Application {name} vassal config is invalid, "
-                           "restarting").format(name=app.name))
-                ApplicationFlag.objects(
-                    application=app, name=NeedsRestartFlag.name).update_one(
-                        add_to_set__pending_backends=self.backend, upsert=True)
-            else:
-                run_plan = app.run_plan
-                if run_plan and not run_plan.is_valid():
-                    log.info(_("Application {name} run plan is invalid, "
-                               "rescheduling").format(name=app.name))
-                    ApplicationFlag.objects(
-                        application=app,
-                        name=NeedsReschedulingFlag.name).update_one(
-                            unset__pending=True, upsert=True)
+        reconciler.reconcile()
+
+    def rebalance(self):
+        if not self.rebalance_interval:
+            return
+        if not self.leader_election.is_leader():
+            # moves are planned from cluster wide stats, only one mule
+            # should start them
+            return
+        if self.last_rebalance and self.last_rebalance >= (
+                datetime.now() - timedelta(seconds=self.rebalance_interval)):
+            return
+        self.last_rebalance = datetime.now()
+        moves = Rebalancer().rebalance()
+        if moves:
+            log.info(_("Started {count} move(s) from overloaded "
+                       "backends").format(count=len(moves)))
 
     def handle_flag(self, flag):
         if flag.name == NeedsStoppingFlag.name:
@@ -98,11 +150,18 @@ class Command(MuleCommand):
                 task = self.create_task(flag.application, flag.title,
                                         flag=flag.name)
                 self.start_app(task, flag.application,
-                               flag.application.run_plan)
+                               flag.application.run_plan,
+                               moved=flag.name == IsStartingFlag.name)
         elif flag.name == NeedsReschedulingFlag.name:
             log.info(_("Application {name} needs rescheduling").format(
                 name=flag.application.name))
             flag.application.update_application()
+        elif flag.name == NeedsStagingFlag.name:
+            log.info(_("Application {name} needs package staging").format(
+                name=flag.application.name))
+            task = self.create_task(flag.application, flag.title,
+                                    flag=flag.name)
+            self.stage_package(task, flag.application, flag)
 
     def is_application_running(self, application):
         if not os.path.exists(application.vassal_path):
@@ -111,19 +170,11 @@ class Command(MuleCommand):
             return False
         return True
 
-    def is_vassal_config_valid(self, application):
-        if os.path.exists(application.vassal_path):
-            backend_conf = application.run_plan.backend_settings(self.backend)
-            options = "\n".join(
-                application.current_package.generate_uwsgi_config(
-                    backend_conf))
-            return calculate_string_sha256(options) == calculate_file_sha256(
-                application.vassal_path)
-        else:
-            # ignore missing vassals, is_application_running() will handle it
-            return True
-
-    def start_app(self, task, application, run_plan):
+    def start_app(self, task, application, run_plan, moved=False):
+        """
+        :param moved: instance was started on new backend, instances on
+                      draining backends will be stopped once it's running
+        """
         if not application.current_package:
             log.error(_("Application {name} has no current package, can't "
                         "start").format(name=application.name))
@@ -160,15 +211,23 @@ class Command(MuleCommand):
                     self.fail_task(task)
             task.update(set__progress=50)
 
-            backend_conf.package.save_vassal_config(backend_conf)
+            generation = self.instance_generation(backend_conf)
+            if not backend_conf.package.save_vassal_config(backend_conf):
+                # config didn't change, running instance won't be reloaded
+                generation = None
             # TODO handle backend start task failure with rescue code
 
-            self.wait_until(application, running=True)
+            self.wait_until(application, running=True, generation=generation)
             log.info(_("Application '{name}' started").format(
                 name=application.name))
-            application.remove_unpacked_packages(
-                exclude=[application.current_package.id])
+            exclude = [application.current_package.id]
+            if application.staged_package_id:
+                exclude.append(application.staged_package_id)
+            application.remove_unpacked_packages(exclude=exclude)
             self.mark_task_successful(task)
+            if moved and not backend_conf.draining:
+                application.run_plan.reload()
+                application.stop_draining_backends()
         else:
             log.error(_("Backend {backend} missing in run plan for "
                         "{name}").format(backend=self.backend.name,
@@ -178,15 +237,56 @@ class Command(MuleCommand):
     def restart_app(self, task, application, flag):
         backend_conf = application.run_plan.backend_settings(self.backend)
         if backend_conf:
-            backend_conf.package.save_vassal_config(backend_conf)
+            generation = self.instance_generation(backend_conf)
+            if not backend_conf.package.save_vassal_config(backend_conf):
+                generation = None
             task.update(set__progress=30)
-            self.wait_until_reloaded(application)
+            self.wait_until_reloaded(application, generation=generation)
             log.info(_("Application '{name}' restarted").format(
                 name=application.name))
             self.mark_task_successful(task)
         else:
             self.fail_flag(flag, task)
 
+    def stage_package(self, task, application, flag):
+        package = Package.objects(id=flag.options.get('package')).first()
+        if not package:
+            log.error(_("Package to stage not found for {name}").format(
+                name=application.name))
+            self.fail_flag(flag, task)
+
+        if not os.path.exists(package.package_path):
+            log.info(_("Unpacking package {id}").format(id=package.safe_id))
+            try:
+                package.unpack()
+            except UnpackError as e:
+                log.error(_("Unpacking failed: {e}").format(e=e))
+                self.fail_task(task)
+        task.update(set__progress=90)
+
+        # backend that stages package as the last one activates it, flag
+        # might have been replaced with staging of newer package meanwhile
+        flag_doc = ApplicationFlag._get_collection().find_and_modify(
+            {'_id': flag.id, 'options.package': package.safe_id,
+             'pending_backends': self.backend.id},
+            {'$pull': {'pending_backends': self.backend.id}}, new=True)
+        if flag_doc and not flag_doc.get('pending_backends'):
+            log.info(_("Package {id} staged on all backends, upgrading "
+                       "{name}").format(id=package.safe_id,
+                                        name=application.name))
+            application.activate_package(package)
+        self.mark_task_successful(task)
+
+    def complete_flag(self, flag):
+        if flag.name != NeedsStagingFlag.name:
+            return super(Command, self).complete_flag(flag)
+        # stage_package() already removed this backend from pending list,
+        # if flag was replaced with staging of newer package this backend
+        # must stay pending there
+        ApplicationFlag.objects(
+            id=flag.id, options__package=flag.options.get('package'),
+            pending_backends__size=0).delete()
+
     def stop_app(self, task, application):
         if os.path.isfile(application.vassal_path):
             log.info(_("Removing vassal config file {path}").format(
@@ -221,13 +321,29 @@ class Command(MuleCommand):
             name=application.name))
         self.mark_task_successful(task)
 
-    def wait_until_reloaded(self, application, timelimit=120):
-        # FIXME track pid change
-        sleep(5)
-        return self.wait_until(application, running=True, timelimit=timelimit)
-
-    def wait_until(self, application, running=True, timelimit=120):
-
+    def instance_generation(self, backend_conf):
+        """
+        Returns generation of application instance running on this backend,
+        None if it's not running.
+        """
+        return stats_generation(fetch_json_stats(str(self.backend.ip),
+                                                 backend_conf.stats))
+
+    def wait_until_reloaded(self, application, timelimit=120,
+                            generation=None):
+        return self.wait_until(application, running=True, timelimit=timelimit,
+                               generation=generation)
+
+    def wait_until(self, application, running=True, timelimit=120,
+                   generation=None):
+        """
+        Poll application stats with exponential backoff until it's running
+        (or stopped).
+
+        :param generation: generation of instance recorded before it was
+                           reloaded, if set we wait until instance with
+                           different generation is ready
+        """
         run_plan = self.backend.application_settings(application)
         if not run_plan:
             return False
@@ -241,24 +357,26 @@ class Command(MuleCommand):
         if backend_conf:
             ip = str(self.backend.ip)
             name = application.name
-            # FIXME track pid change instead of initial sleep (?)
-            sleep(3)
             timeout = datetime.now() + timedelta(seconds=timelimit)
+            delay = 0.02
             logged = False
             while datetime.now() <= timeout:
                 s = fetch_json_stats(ip, backend_conf.stats)
-                if running and s:
+                if running and stats_ready(s) and (
+                        generation is None or
+                        generation_changed(generation, stats_generation(s))):
                     return True
                 if not running and not s:
                     return True
                 if logged:
                     log.debug(_("Waiting for {name} to {action}").format(
                         name=name, action=action))
-                else:
+                elif delay >= 1:
                     log.info(_("Waiting for {name} to {action}").format(
                         name=name, action=action))
                     logged = True
-                sleep(2)
+                sleep(delay)
+                delay = min(delay * 2, 2)
             else:
                 log.error(_("Timeout reached for {name}").format(name=name))
 
@@ -129,7 +129,7 @@ class Command(MuleCommand):
         pkg.save()
         log.info(_("Package saved with id {id}").format(id=pkg.safe_id))
 
-        app.update(add_to_set__packages=pkg, set__current_package=pkg)
+        app.update(add_to_set__packages=pkg)
         app.reload()
-        app.upgrade_application()
+        app.stage_package(pkg)
         app.trim_package_files()
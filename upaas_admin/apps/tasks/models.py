@@ -10,6 +10,7 @@ from __future__ import unicode_literals
 import sys
 import datetime
 import logging
+import threading
 
 from mongoengine import (StringField, DateTimeField, IntField, ListField,
                          ReferenceField, Document, EmbeddedDocument,
@@ -61,6 +62,73 @@ class MongoLogHandler(logging.StreamHandler):
             self.flush()
 
 
+class TaskLogFilter(logging.Filter):
+    """
+    Only passes errors logged by threads that are handling a task, other
+    messages are stored by the task log handler.
+    """
+
+    def __init__(self, router):
+        logging.Filter.__init__(self)
+        self.router = router
+
+    def filter(self, record):
+        return record.levelno >= logging.ERROR or \
+            record.thread not in self.router.handlers
+
+
+class TaskLogRouter(logging.Handler):
+    """
+    Routes log records to MongoLogHandler of the task that is being handled
+    by the thread that emitted the record, so that many tasks can run in
+    parallel threads. Router is attached to the logger only while there are
+    tasks running.
+    """
+
+    def __init__(self, logger=None, *args, **kwargs):
+        if sys.version_info[:2] > (2, 6):
+            super(TaskLogRouter, self).__init__(*args, **kwargs)
+        else:
+            logging.Handler.__init__(self, *args, **kwargs)
+        self.logger = logger or logging.getLogger()
+        # thread id -> MongoLogHandler
+        self.handlers = {}
+        self.task_filter = TaskLogFilter(self)
+        self.handlers_lock = threading.Lock()
+
+    def add_task(self, task):
+        handler = MongoLogHandler(task)
+        with self.handlers_lock:
+            if not self.handlers:
+                self.install()
+            self.handlers[threading.current_thread().ident] = handler
+        return handler
+
+    def remove_task(self):
+        with self.handlers_lock:
+            handler = self.handlers.pop(threading.current_thread().ident,
+                                        None)
+            if handler and not self.handlers:
+                self.uninstall()
+        if handler:
+            handler.flush()
+
+    def emit(self, record):
+        handler = self.handlers.get(record.thread)
+        if handler:
+            handler.emit(record)
+
+    def install(self):
+        for handler in self.logger.handlers:
+            handler.addFilter(self.task_filter)
+        self.logger.addHandler(self)
+
+    def uninstall(self):
+        self.logger.removeHandler(self)
+        for handler in self.logger.handlers:
+            handler.removeFilter(self.task_filter)
+
+
 class TaskMessage(EmbeddedDocument):
 
     timestamp = DateTimeField(required=True, default=datetime.datetime.now)
@@ -122,3 +190,16 @@ class Task(Document):
         elif self.is_successful:
             return ICON_SUCCESSFUL
         return ICON_UNKNOWN
+
+
+class MuleLeader(Document):
+    """
+    Lease held by mule elected to run cluster wide cleanups, there is one
+    leader for every mule name.
+    """
+    name = StringField(required=True, unique=True)
+    backend = ReferenceField(BackendServer, reverse_delete_rule=NULLIFY)
+    pid = IntField(required=True)
+    date_acquired = DateTimeField(required=True,
+                                  default=datetime.datetime.now)
+    expires = DateTimeField(required=True)
@@ -13,15 +13,21 @@ from os import getpid
 from datetime import datetime, timedelta
 from time import sleep
 from socket import gethostname
-from threading import Thread
+from threading import Thread, Lock, Event
 from multiprocessing import cpu_count
 
 from IPy import IP
 
 from optparse import make_option
 
-from mongoengine import Q
-from mongoengine.errors import NotUniqueError
+try:
+    from pymongo import CursorType
+    TAILABLE_CURSOR = {'cursor_type': CursorType.TAILABLE_AWAIT}
+except ImportError:
+    # pymongo 2.x
+    TAILABLE_CURSOR = {'tailable': True, 'await_data': True}
+
+from pymongo.errors import DuplicateKeyError
 
 from django.core.management.base import NoArgsCommand
 from django.utils.translation import ugettext as _
@@ -31,10 +37,14 @@ from upaas.processes import is_pid_running
 from upaas.utils import backend_total_memory
 
 from upaas_admin.apps.servers.models import BackendServer
-from upaas_admin.apps.tasks.models import MongoLogHandler, Task
+from upaas_admin.apps.tasks.models import TaskLogRouter, Task, MuleLeader
 from upaas_admin.apps.tasks.constants import TaskStatus
-from upaas_admin.apps.applications.constants import SINGLE_SHOT_FLAGS
-from upaas_admin.apps.applications.models import ApplicationFlag, FlagLock
+from upaas_admin.apps.tasks.heartbeat import Heartbeat
+from upaas_admin.apps.scheduler.models import ApplicationRunPlan
+from upaas_admin.apps.applications.constants import (SINGLE_SHOT_FLAGS,
+                                                     NeedsStagingFlag)
+from upaas_admin.apps.applications.models import (
+    Application, ApplicationFlag, FlagNotification, Package)
 
 
 log = logging.getLogger(__name__)
@@ -54,20 +64,39 @@ class MuleBackendHelper(object):
         self.name = name
         self.interval = 0
         self.backend = self.register_backend()
+        self.election = None
+        self.heartbeat = None
+        self.thread = None
+        self.stopped = Event()
 
     def pinger(self):
-        key = 'set__worker_ping__%s' % self.name
         while not self.exiting:
-            self.backend.update(**{key: datetime.now()})
-            sleep(self.interval)
+            if self.election:
+                # leader lease is renewed at ping interval, it can also be
+                # taken over if leader backend stops sending heartbeats
+                self.election.acquire()
+            self.stopped.wait(self.interval)
 
     def start_pinger(self, interval=60):
+        """
+        Start sending health check pings, pings for all mules running on
+        this host are sent by single shared heartbeat writer.
+        """
         self.interval = interval
-        t1 = Thread(target=self.pinger)
-        t1.start()
+        self.heartbeat = Heartbeat(self.backend, interval=interval)
+        self.heartbeat.add(self.name)
+        self.heartbeat.start()
+        self.thread = Thread(target=self.pinger)
+        self.thread.daemon = True
+        self.thread.start()
 
     def stop_pinger(self):
         self.exiting = True
+        self.stopped.set()
+        if self.heartbeat:
+            self.heartbeat.stop()
+        if self.thread:
+            self.thread.join(5)
 
     def register_backend(self):
         name = gethostname()
@@ -141,18 +170,243 @@ class MuleBackendHelper(object):
             backend.reload()
 
 
+class MuleFlagListener(object):
+    """
+    Waits for FlagNotification documents using tailable cursor on capped
+    collection, so mules can sleep until flag they handle is set.
+    """
+
+    def __init__(self, flags):
+        self.flags = flags
+        self.last_id = None
+        self.cursor = None
+
+    def open(self):
+        collection = FlagNotification._get_collection()
+        if self.last_id is None:
+            last = collection.find_one(sort=[('$natural', -1)])
+            if last is None:
+                # tailable cursor on empty collection is dead right away
+                FlagNotification(name='').save()
+                last = collection.find_one(sort=[('$natural', -1)])
+            self.last_id = last['_id']
+        # query must always match last seen document, otherwise cursor is
+        # closed by the server when there are no new notifications
+        self.cursor = collection.find({'_id': {'$gte': self.last_id}},
+                                      **TAILABLE_CURSOR)
+
+    def is_watched(self, notification):
+        name = notification.get('name')
+        return name is None or name in self.flags
+
+    def wait(self, timeout, stop=None):
+        """
+        Block until notification for one of the flags is received or timeout
+        is reached. Returns True if notification was received.
+
+        :param stop: callable, waiting is interrupted if it returns True
+        """
+        deadline = datetime.now() + timedelta(seconds=timeout)
+        while datetime.now() < deadline:
+            if stop and stop():
+                return False
+            try:
+                if self.cursor is None or not self.cursor.alive:
+                    self.open()
+                notification = next(self.cursor)
+            except StopIteration:
+                if self.cursor is not None and not self.cursor.alive:
+                    # last seen document was removed from capped collection
+                    self.last_id = None
+                    sleep(1)
+                continue
+            except Exception as e:
+                log.error(_("Can't read flag notifications: {e}").format(
+                    e=e))
+                self.cursor = None
+                sleep(1)
+                continue
+            if notification['_id'] == self.last_id:
+                continue
+            self.last_id = notification['_id']
+            if self.is_watched(notification):
+                return True
+        return False
+
+
+class MuleLockHelper(object):
+    """
+    Takes flag locks as leases and keeps renewing leases of flags that are
+    being handled, lease of crashed mule expires and flag can be claimed
+    again.
+    """
+
+    def __init__(self, backend, pid, timeout=120):
+        self.exiting = False
+        self.backend = backend
+        self.pid = pid
+        self.timeout = timeout
+        self.held = set()
+
+    def new_lock(self, now):
+        return {'date_created': now, 'backend': self.backend.id,
+                'pid': self.pid,
+                'expires': now + timedelta(seconds=self.timeout)}
+
+    def claim(self, query, update):
+        """
+        Atomically find flag matching query and take lease on it, returns
+        flag or None if there's nothing to claim.
+        """
+        doc = ApplicationFlag._get_collection().find_and_modify(
+            query, update, sort=[('date_created', -1)], new=True)
+        if doc:
+            self.held.add(doc['_id'])
+            return ApplicationFlag._from_son(doc)
+
+    def release(self, flag):
+        self.held.discard(flag.id)
+        lock = {'backend': self.backend.id, 'pid': self.pid}
+        collection = ApplicationFlag._get_collection()
+        # flags with limited number of slots get their slot back
+        ret = collection.update(
+            {'_id': flag.id, 'free_slots': {'$exists': True},
+             'locks': {'$elemMatch': lock}},
+            {'$pull': {'locks': lock}, '$inc': {'free_slots': 1}})
+        if not ret.get('n'):
+            ret = collection.update({'_id': flag.id},
+                                    {'$pull': {'locks': lock}})
+        if ret.get('n'):
+            # released slot or application can be claimed by other mules,
+            # they might be waiting for any flag of this application
+            FlagNotification.notify(None)
+
+    def renew(self):
+        expires = datetime.now() + timedelta(seconds=self.timeout)
+        for flag_id in list(self.held):
+            ApplicationFlag._get_collection().update(
+                {'_id': flag_id,
+                 'locks': {'$elemMatch': {'backend': self.backend.id,
+                                          'pid': self.pid}}},
+                {'$set': {'locks.$.expires': expires}})
+
+    def renewer(self):
+        while not self.exiting:
+            sleep(max(self.timeout // 4, 1))
+            try:
+                self.renew()
+            except Exception as e:
+                log.error(_("Can't renew flag locks: {e}").format(e=e))
+
+    def start_renewer(self):
+        t1 = Thread(target=self.renewer)
+        t1.daemon = True
+        t1.start()
+
+    def stop_renewer(self):
+        self.exiting = True
+
+
+class MuleLeaderElection(object):
+    """
+    Elects single mule (for every mule name) that runs cluster wide
+    cleanups. Leader holds lease stored in MuleLeader collection, it must be
+    renewed before it expires, otherwise any other mule can take over.
+    """
+
+    def __init__(self, name, backend, pid, timeout=180):
+        self.name = name
+        self.backend = backend
+        self.pid = pid
+        self.timeout = timeout
+        self.leader = False
+        self.last_check = None
+
+    def acquire(self):
+        """
+        Take or renew leader lease, returns True if this mule is the leader.
+        """
+        now = datetime.now()
+        update = {'backend': self.backend.id, 'pid': self.pid,
+                  'expires': now + timedelta(seconds=self.timeout)}
+        if not self.leader:
+            update['date_acquired'] = now
+        was_leader = self.leader
+        try:
+            # lease held by backend that stopped sending heartbeats can be
+            # taken over before it expires
+            stale = [b['_id'] for b in BackendServer.stale(
+                self.timeout).filter(id__ne=self.backend.id).only(
+                'id').as_pymongo()]
+            # if lease is held by other mule upsert will fail on unique name
+            MuleLeader._get_collection().update(
+                {'name': self.name,
+                 '$or': [{'expires': {'$lte': now}},
+                         {'backend': {'$in': stale}},
+                         {'backend': self.backend.id, 'pid': self.pid}]},
+                {'$set': update}, upsert=True)
+        except DuplicateKeyError:
+            self.leader = False
+        except Exception as e:
+            log.error(_("Can't acquire leader lease: {e}").format(e=e))
+            self.leader = False
+        else:
+            self.leader = True
+        self.last_check = now
+        if self.leader and not was_leader:
+            log.info(_("Elected as {name} leader").format(name=self.name))
+        elif was_leader and not self.leader:
+            log.warning(_("Lost {name} leader lease").format(name=self.name))
+        return self.leader
+
+    def is_leader(self):
+        if self.last_check is None or self.last_check < (
+                datetime.now() - timedelta(seconds=self.timeout // 3)):
+            return self.acquire()
+        return self.leader
+
+    def release(self):
+        if self.leader:
+            MuleLeader.objects(name=self.name, backend=self.backend,
+                               pid=self.pid).delete()
+        self.leader = False
+
+
 class MuleTaskHelper(object):
+    """
+    Cleans tasks and flag locks left by crashed mules. Every cleanup is done
+    using single projection query and bulk updates, so it stays fast even
+    after many tasks were interrupted.
+    """
 
-    def __init__(self, name):
+    def __init__(self, name, election=None):
+        """
+        :param election: MuleLeaderElection instance, cluster wide cleanups
+                         are only run if this mule is the leader, they are
+                         always run if election is not passed
+        """
         self.name = name
+        self.election = election
         self.last_clean = {}
 
-    def clean(self, backend):
-        self.clean_failed_locks(backend)
-        self.clean_failed_tasks(backend)
-        self.clean_failed_remote_tasks(backend)
-        self.clean_failed_remote_locks(backend)
-        self.clean_orphaned_locks()
+    def clean(self, backend, force=False):
+        """
+        Run all cleanups, returns dict with number of cleaned tasks and locks
+        in each category.
+
+        :param force: ignore minimal interval between cleanups
+        """
+        if force:
+            self.last_clean = {}
+        ret = {
+            'local_locks': self.clean_failed_locks(backend),
+            'local_tasks': self.clean_failed_tasks(backend),
+        }
+        if self.election is None or self.election.is_leader():
+            ret['remote_tasks'] = self.clean_failed_remote_tasks(backend)
+            ret['expired_locks'] = self.clean_expired_locks()
+            ret['stale_staging'] = self.clean_stale_staging()
+        return ret
 
     def can_clean(self, name):
         if self.last_clean.get(name) is None:
@@ -162,115 +416,206 @@ class MuleTaskHelper(object):
             return True
         return False
 
-    def reset_pending_state(self, lock):
-        if lock.flag in SINGLE_SHOT_FLAGS:
-            ApplicationFlag.objects(
-                application=lock.application, name=lock.flag,
-                pending=False).update_one(set__pending=True)
-        else:
-            ApplicationFlag.objects(
-                application=lock.application, name=lock.flag,
-                pending_backends__ne=lock.backend).update_one(
-                    add_to_set__pending_backends=lock.backend)
+    def dead_pids(self, pids):
+        return sorted([pid for pid in set(pids) if not is_pid_running(pid)])
 
     def clean_failed_tasks(self, backend):
         name = 'local_tasks'
         if not self.can_clean(name):
-            return
-        for task in Task.objects(backend=backend,
-                                 status=TaskStatus.running):
-            if not is_pid_running(task.pid):
-                log.warning(_(
-                    "Found failed task, marking as failed (id: {id}, app: "
-                    "{name})").format(id=task.safe_id,
-                                      name=task.application.name))
-                task.update(set__status=TaskStatus.failed,
-                            set__date_finished=datetime.now())
+            return 0
+        tasks = list(Task._get_collection().find(
+            {'backend': backend.id, 'status': TaskStatus.running}, ['pid']))
+        dead = self.dead_pids([task['pid'] for task in tasks])
+        count = 0
+        if dead:
+            count = Task.objects(
+                id__in=[task['_id'] for task in tasks if task['pid'] in dead]
+            ).update(set__status=TaskStatus.failed,
+                     set__date_finished=datetime.now())
+            log.warning(_("Marked {count} task(s) of crashed processes as "
+                          "failed (pids: {pids})").format(
+                count=count, pids=', '.join([str(pid) for pid in dead])))
         self.last_clean[name] = datetime.now()
+        return count
 
     def clean_failed_locks(self, backend):
         name = 'local_locks'
         if not self.can_clean(name):
-            return
-        for lock in FlagLock.objects(backend=backend):
-            if not is_pid_running(lock.pid):
-                log.warning(_("Found stale lock, removing (app: {name}, pid: "
-                              "{pid})").format(name=lock.application.name,
-                                               pid=lock.pid))
-                self.reset_pending_state(lock)
-                lock.delete()
+            return 0
+        # locks of crashed local mules are released right away, so that flags
+        # can be claimed again without waiting for lease timeout
+        now = datetime.now()
+        collection = ApplicationFlag._get_collection()
+        pids = []
+        for flag in collection.find({'locks': {'$elemMatch': {
+                'backend': backend.id, 'expires': {'$gt': now}}}},
+                ['locks.backend', 'locks.pid']):
+            pids.extend([lock['pid'] for lock in flag['locks']
+                         if lock['backend'] == backend.id])
+        dead = self.dead_pids(pids)
+        count = 0
+        if dead:
+            stale = {'backend': backend.id, 'pid': {'$in': dead}}
+            # single shot flags are marked as pending again
+            ret = collection.update(
+                {'name': {'$in': SINGLE_SHOT_FLAGS},
+                 'locks': {'$elemMatch': stale}},
+                {'$set': {'pending': True, 'locks': []}}, multi=True)
+            count += ret.get('n', 0)
+            ret = collection.update(
+                {'name': {'$nin': SINGLE_SHOT_FLAGS},
+                 'free_slots': {'$exists': False},
+                 'locks': {'$elemMatch': stale}},
+                {'$pull': {'locks': stale}}, multi=True)
+            count += ret.get('n', 0)
+            count += self.pull_slot_locks(
+                stale, lambda lock: lock['backend'] == backend.id and
+                lock['pid'] in dead)
+            log.warning(_("Released {count} stale flag lock(s) of crashed "
+                          "processes (pids: {pids})").format(
+                count=count, pids=', '.join([str(pid) for pid in dead])))
+            if count:
+                # released flags can be claimed again
+                FlagNotification.notify(None)
         self.last_clean[name] = datetime.now()
+        return count
 
     def clean_failed_remote_tasks(self, local_backend):
         name = 'remote_tasks'
         if not self.can_clean(name):
-            return
+            return 0
         # look for tasks locked at backends that did not ack itself to the
         # database for at least 600 seconds
         timestamp = datetime.now() - timedelta(seconds=600)
-        backends = BackendServer.objects(**{
-            'id__ne': local_backend.id,
-            'is_enabled__ne': False,
-            'worker_ping__%s__lte' % self.name: timestamp
-        })
+        # pings are checked per mule, mule could have crashed on a backend
+        # that is still sending pings for other mules, so last_ping can't be
+        # used here
+        BackendServer.ensure_worker_ping_index(self.name)
+        backends = list(BackendServer._get_collection().find({
+            '_id': {'$ne': local_backend.id},
+            'is_enabled': {'$ne': False},
+            'worker_ping.%s' % self.name: {'$lte': timestamp}
+        }, ['name']))
+        count = 0
         if backends:
             log.debug(_("{len} non responsive backends: {names}").format(
-                len=len(backends), names=[b.name for b in backends]))
-            for task in Task.objects(backend__in=backends,
-                                     status=TaskStatus.running,
-                                     date_created__lte=timestamp):
-                log.warning(_("Task '{name}' with id {tid} is locked on "
-                              "backend {backend}, but it didn't send any "
-                              "pings for 10 minutes, marking as "
-                              "failed").format(
-                    name=task.title, tid=task.safe_id,
-                    backend=task.backend.name))
-                task.update(set__status=TaskStatus.failed,
-                            set__date_finished=datetime.now())
+                len=len(backends), names=[b['name'] for b in backends]))
+            count = Task.objects(backend__in=[b['_id'] for b in backends],
+                                 status=TaskStatus.running,
+                                 date_created__lte=timestamp).update(
+                set__status=TaskStatus.failed,
+                set__date_finished=datetime.now())
+            if count:
+                log.warning(_("Marked {count} task(s) locked on backends that "
+                              "didn't send any pings for 10 minutes as "
+                              "failed (backends: {names})").format(
+                    count=count, names=', '.join([b['name'] for b in
+                                                  backends])))
         self.last_clean[name] = datetime.now()
+        return count
 
-    def clean_failed_remote_locks(self, local_backend):
-        name = 'remote_tasks'
+    def clean_expired_locks(self):
+        name = 'expired_locks'
         if not self.can_clean(name):
-            return
-        # look for tasks locked at backends that did not ack itself to the
-        # database for at least 600 seconds
-        timestamp = datetime.now() - timedelta(seconds=600)
-        backends = BackendServer.objects(**{
-            'id__ne': local_backend.id,
-            'is_enabled__ne': False,
-            'worker_ping__%s__lte' % self.name: timestamp
-        })
-        if backends:
-            log.debug(_("{len} non responsive backends: {names}").format(
-                len=len(backends), names=[b.name for b in backends]))
-            for lock in FlagLock.objects(backend__in=backends,
-                                         date_created__lte=timestamp):
-                log.warning(_("Found old lock on  backend {backend}, but it "
-                              "didn't send any pings for 10 minutes, "
-                              "removing").format(backend=lock.backend))
-                self.reset_pending_state(lock)
-                lock.delete()
+            return 0
+        # expired locks of single shot flags are replaced when flag is
+        # claimed again, multi backend flags are cleaned here
+        now = datetime.now()
+        stale = {'expires': {'$lte': now}}
+        ret = ApplicationFlag._get_collection().update(
+            {'name': {'$nin': SINGLE_SHOT_FLAGS},
+             'free_slots': {'$exists': False},
+             'locks.expires': {'$lte': now}},
+            {'$pull': {'locks': stale}}, multi=True)
+        count = ret.get('n', 0) + self.pull_slot_locks(
+            stale, lambda lock: lock['expires'] <= now)
+        if count:
+            FlagNotification.notify(None)
         self.last_clean[name] = datetime.now()
+        return count
 
-    def clean_orphaned_locks(self):
-        name = 'orphaned_locks'
+    def clean_stale_staging(self):
+        name = 'stale_staging'
         if not self.can_clean(name):
-            return
-        timestamp = datetime.now() - timedelta(seconds=60)
-        for lock in FlagLock.objects(
-                backend__exists=False, flag__in=SINGLE_SHOT_FLAGS,
-                date_created__lte=timestamp):
-            if len(Task.objects(
-                Q(application=lock.application, flag=lock.flag) & (
-                    Q(status=TaskStatus.running) |
-                    Q(date_finished__gte=(
-                        datetime.now() - timedelta(seconds=30)))))) == 0:
-                log.warning(_("Found stale lock, removing (app: "
-                              "{name})").format(name=lock.application.name))
-                self.reset_pending_state(lock)
-                lock.delete()
+            return 0
+        # packages are only activated once staged on every backend, so
+        # backends that are dead, disabled or no longer in run plan must be
+        # dropped from pending list, otherwise upgrade would never happen
+        collection = ApplicationFlag._get_collection()
+        flags = list(collection.find({'name': NeedsStagingFlag.name},
+                                     ['application', 'pending_backends',
+                                      'options']))
+        if not flags:
+            self.last_clean[name] = datetime.now()
+            return 0
+        dead = set([b['_id'] for b in BackendServer.stale(600).only(
+            'id').as_pymongo()])
+        dead.update([b['_id'] for b in BackendServer.objects(
+            is_enabled=False).only('id').as_pymongo()])
+        scheduled = {}
+        for run_plan in ApplicationRunPlan._get_collection().find(
+                {'application': {'$in': [f['application'] for f in flags]}},
+                ['application', 'backends.backend']):
+            scheduled[run_plan['application']] = set(
+                [b['backend'] for b in run_plan.get('backends', [])])
+        count = 0
+        for flag in flags:
+            backends = scheduled.get(flag['application'], set())
+            drop = [bid for bid in flag.get('pending_backends', [])
+                    if bid in dead or bid not in backends]
+            if not drop:
+                continue
+            package_id = flag.get('options', {}).get('package')
+            doc = collection.find_and_modify(
+                {'_id': flag['_id'], 'options.package': package_id,
+                 'pending_backends': {'$in': drop}},
+                {'$pullAll': {'pending_backends': drop}}, new=True)
+            if not doc:
+                continue
+            count += 1
+            log.warning(_("Removed {count} dead or unscheduled backend(s) "
+                          "from package staging").format(count=len(drop)))
+            if not doc.get('pending_backends'):
+                collection.remove({'_id': doc['_id'],
+                                   'pending_backends': {'$size': 0}})
+                application = Application.objects(
+                    id=flag['application']).first()
+                package = Package.objects(id=package_id).first()
+                if application and package:
+                    log.info(_("Package {id} staged on all remaining "
+                               "backends, upgrading {name}").format(
+                        id=package.safe_id, name=application.name))
+                    application.activate_package(package)
         self.last_clean[name] = datetime.now()
+        return count
+
+    def pull_slot_locks(self, stale, is_stale):
+        """
+        Remove stale locks from multi backend flags with limited number of
+        slots, every removed lock frees one slot. Returns number of updated
+        flags.
+
+        :param stale: query matching stale locks
+        :param is_stale: callable returning True for stale lock
+        """
+        collection = ApplicationFlag._get_collection()
+        bulk = collection.initialize_unordered_bulk_op()
+        count = 0
+        for flag in collection.find(
+                {'name': {'$nin': SINGLE_SHOT_FLAGS},
+                 'free_slots': {'$exists': True},
+                 'locks': {'$elemMatch': stale}},
+                ['locks.backend', 'locks.pid', 'locks.expires']):
+            pulled = len([lock for lock in flag['locks'] if is_stale(lock)])
+            if pulled:
+                bulk.find({'_id': flag['_id'],
+                           'locks': {'$elemMatch': stale}}).update_one(
+                    {'$pull': {'locks': stale},
+                     '$inc': {'free_slots': pulled}})
+                count += 1
+        if count:
+            bulk.execute()
+        return count
 
 
 class MuleCommand(NoArgsCommand):
@@ -288,6 +633,23 @@ class MuleCommand(NoArgsCommand):
         make_option('--ping-interval', dest='ping_interval', type=int,
                     default=60, help=_('Health check ping interval (default is'
                                        ' 60 seconds)')),
+        make_option('--poll-interval', dest='poll_interval', type=int,
+                    default=30, help=_('Check for flags at least every given '
+                                       'number of seconds even if no '
+                                       'notification was received (default '
+                                       'is 30 seconds)')),
+        make_option('--notifications-disabled', action="store_true",
+                    dest='notifications_disabled', default=False,
+                    help=_('Disable flag notifications, check for flags '
+                           'every second')),
+        make_option('--lock-timeout', dest='lock_timeout', type=int,
+                    default=120, help=_('Flag lock expires if it is not '
+                                        'renewed for given number of seconds '
+                                        '(default is 120 seconds)')),
+        make_option('--concurrency', dest='concurrency', type=int, default=1,
+                    help=_('Number of tasks handled in parallel, tasks for '
+                           'the same application are never run in parallel '
+                           '(default is 1)')),
     )
 
     def __init__(self, *args, **kwargs):
@@ -297,38 +659,34 @@ class MuleCommand(NoArgsCommand):
             self.mule_name.replace(' ', ''))
         self.backend = self.backend_helper.backend
 
-        self.task_helper = MuleTaskHelper(self.mule_name.replace(' ', ''))
+        self.flag_listener = MuleFlagListener(self.mule_flags)
 
         self.is_exiting = False
         self.tasks_done = 0
+        self.tasks_lock = Lock()
         self.task_limit = 0
+        self.concurrency = 1
+        # application id -> worker thread
+        self.workers = {}
         self.cleanup()
         self.pid = getpid()
-        self.log_handler = None
-        self.log_handlers_level = {}
+        self.lock_helper = MuleLockHelper(self.backend, self.pid)
+        self.leader_election = MuleLeaderElection(
+            self.mule_name.replace(' ', ''), self.backend, self.pid)
+        self.backend_helper.election = self.leader_election
+        self.task_helper = MuleTaskHelper(self.mule_name.replace(' ', ''),
+                                          election=self.leader_election)
+        self.log_router = TaskLogRouter()
         # FIXME capture all logs and prefix with self.logger
 
     def cleanup(self):
         self.app_name = _('N/A')
 
     def add_logger(self, task):
-        self.log_handler = MongoLogHandler(task)
-        root_logger = logging.getLogger()
-        for handler in root_logger.handlers:
-            self.log_handlers_level[handler] = handler.level
-            handler.level = logging.ERROR
-        root_logger.addHandler(self.log_handler)
+        self.log_router.add_task(task)
 
     def remove_logger(self):
-        if self.log_handler:
-            self.log_handler.flush()
-        root_logger = logging.getLogger()
-        for handler in root_logger.handlers:
-            level = self.log_handlers_level.get(handler)
-            if level is not None:
-                handler.level = level
-        if self.log_handler:
-            root_logger.removeHandler(self.log_handler)
+        self.log_router.remove_task()
 
     def mark_exiting(self, *args):
         log.info(_("Shutting down, waiting for current task to finish"))
@@ -357,7 +715,8 @@ class MuleCommand(NoArgsCommand):
                     set__date_finished=datetime.now())
 
     def task_completed(self):
-        self.tasks_done += 1
+        with self.tasks_lock:
+            self.tasks_done += 1
         log.info(_("Task completed, [done: {tasks_done}, limit: "
                    "{task_limit}]").format(tasks_done=self.tasks_done,
                                            task_limit=self.task_limit))
@@ -368,9 +727,24 @@ class MuleCommand(NoArgsCommand):
             signal.signal(sig, self.mark_exiting)
 
         if not options['ping_disabled']:
+            self.leader_election.timeout = max(options['ping_interval'] * 3,
+                                               60)
             self.backend_helper.start_pinger(interval=options['ping_interval'])
 
+        self.lock_helper.timeout = options['lock_timeout']
+        self.lock_helper.start_renewer()
+
+        if not options['notifications_disabled']:
+            # start listening before first flag check, so that no
+            # notification sent in the meantime is missed
+            try:
+                self.flag_listener.open()
+            except Exception as e:
+                log.error(_("Can't read flag notifications: {e}").format(
+                    e=e))
+
         self.task_limit = options['task_limit']
+        self.concurrency = max(options['concurrency'], 1)
         log.info(_("{name} ready, waiting for tasks (limit: "
                    "{task_limit})").format(name=self.mule_name,
                                            task_limit=self.task_limit))
@@ -381,50 +755,120 @@ class MuleCommand(NoArgsCommand):
                 self.is_exiting = True
 
             if self.is_exiting:
+                self.join_workers()
                 self.backend_helper.stop_pinger()
+                self.lock_helper.stop_renewer()
+                self.leader_election.release()
                 return
 
             self.task_helper.clean(self.backend)
-            self.handle_task()
-            sleep(1)
+            if not self.can_start_task():
+                sleep(1)
+                continue
+            if self.handle_task():
+                continue
+            if options['notifications_disabled']:
+                sleep(1)
+            else:
+                self.flag_listener.wait(
+                    options['poll_interval'],
+                    stop=lambda: self.is_exiting or self.has_pending_work())
+
+    def can_start_task(self):
+        """
+        Returns True if there is free worker and task limit would not be
+        exceeded by starting new task.
+        """
+        self.reap_workers()
+        if self.task_limit and (
+                self.tasks_done + len(self.workers) >= self.task_limit):
+            return False
+        return len(self.workers) < self.concurrency
+
+    def reap_workers(self):
+        for app_id, worker in list(self.workers.items()):
+            if not worker.is_alive():
+                del self.workers[app_id]
+
+    def join_workers(self):
+        for worker in list(self.workers.values()):
+            worker.join()
+        self.reap_workers()
 
     def handle_task(self):
         flag = self.find_flag()
         if flag:
-            failed = False
+            if self.concurrency > 1:
+                worker = Thread(target=self.process_flag, args=(flag,))
+                worker.daemon = True
+                self.workers[flag.application.id] = worker
+                worker.start()
+            else:
+                self.process_flag(flag)
+            return True
+
+        return False
+
+    def process_flag(self, flag):
+        failed = False
+        try:
             try:
                 self.handle_flag(flag)
             except MuleTaskFailed:
                 failed = True
-            finally:
-                self.unlock_flag(flag)
-                self.remove_logger()
-                self.task_completed()
-            if failed:
-                return True
-
-            if flag.name in SINGLE_SHOT_FLAGS:
-                ApplicationFlag.objects(application=flag.application,
-                                        name=flag.name,
-                                        pending=False).delete()
             else:
-                flag.update(pull__pending_backends=self.backend)
-                ApplicationFlag.objects(application=flag.application,
-                                        name=flag.name,
-                                        pending_backends__size=0).delete()
-            self.cleanup()
-            return True
+                # flag must be completed while we still hold the lock,
+                # otherwise other mule could claim it again
+                self.complete_flag(flag)
+        finally:
+            self.unlock_flag(flag)
+            self.remove_logger()
+            self.task_completed()
+        if failed:
+            return
 
-        return False
+        self.cleanup()
+
+    def complete_flag(self, flag):
+        """
+        Called after flag was successfully handled, removes flag if there
+        is nothing more to do.
+        """
+        if flag.name in SINGLE_SHOT_FLAGS:
+            ApplicationFlag.objects(application=flag.application,
+                                    name=flag.name,
+                                    pending=False).delete()
+        else:
+            flag.update(pull__pending_backends=self.backend)
+            ApplicationFlag.objects(application=flag.application,
+                                    name=flag.name,
+                                    pending_backends__size=0).delete()
 
     def handle_flag(self, flag):
         raise NotImplementedError
 
+    def has_pending_work(self):
+        """
+        Mules can override this to stop waiting for flag notifications when
+        they have other work to do.
+        """
+        return False
+
     def fail_flag(self, flag, task):
         flag.delete()
         self.fail_task(task)
 
     def flag_filter(self):
+        """
+        Returns list of (query, update) tuples, query matches flags that can
+        be claimed by this mule and update takes lock on matched flag.
+        Single shot flags can be claimed if they are pending or their lock
+        has expired, multi backend flags can be claimed if they are pending
+        for this backend, it doesn't hold valid lock on them and there is
+        free slot left (if number of backends handling flag at once is
+        limited). Only one flag per application is handled on a backend at
+        a time.
+        """
         single_shot_flags = []
         multi_show_flags = []
         for flag in self.mule_flags:
@@ -432,49 +876,55 @@ class MuleCommand(NoArgsCommand):
                 single_shot_flags.append(flag)
             else:
                 multi_show_flags.append(flag)
-        return ApplicationFlag.objects(
-            (
-                Q(pending__ne=False) &
-                Q(name__in=single_shot_flags) &
-                Q(application__nin=FlagLock.objects(
-                    flag__in=single_shot_flags).distinct('application'))
-            ) | (
-                Q(pending_backends=self.backend) &
-                Q(name__in=multi_show_flags) &
-                Q(application__nin=FlagLock.objects(
-                    flag__in=multi_show_flags,
-                    backend=self.backend).distinct('application'))
-            )
-        )
+        now = datetime.now()
+        lock = self.lock_helper.new_lock(now)
+        # tasks for single application must be serialized, applications
+        # with any flag locked on this backend (by this or any other mule
+        # process) are skipped, same for applications with locked single
+        # shot flag on any backend
+        collection = ApplicationFlag._get_collection()
+        busy = set(self.workers.keys())
+        busy.update(collection.find(
+            {'locks': {'$elemMatch': {'backend': self.backend.id,
+                                      'expires': {'$gt': now}}}}
+        ).distinct('application'))
+        busy = list(busy)
+        ret = []
+        if single_shot_flags:
+            busy_single_shot = set(busy)
+            busy_single_shot.update(collection.find(
+                {'name': {'$in': list(SINGLE_SHOT_FLAGS)},
+                 'locks': {'$elemMatch': {'expires': {'$gt': now}}}}
+            ).distinct('application'))
+            ret.append((
+                {'name': {'$in': single_shot_flags},
+                 'application': {'$nin': list(busy_single_shot)},
+                 'locks': {'$not': {'$elemMatch': {'expires': {'$gt': now}}}},
+                 '$or': [{'pending': {'$ne': False}},
+                         {'locks.0': {'$exists': True}}]},
+                {'$set': {'pending': False, 'locks': [lock]}}))
+        if multi_show_flags:
+            query = {'name': {'$in': multi_show_flags},
+                     'application': {'$nin': busy},
+                     'pending_backends': self.backend.id,
+                     'locks': {'$not': {'$elemMatch': {
+                         'backend': self.backend.id,
+                         'expires': {'$gt': now}}}}}
+            ret.append((dict(query, free_slots={'$exists': False}),
+                        {'$push': {'locks': lock}}))
+            # rolling restarts, every backend handling flag takes one slot
+            ret.append((dict(query, free_slots={'$gt': 0}),
+                        {'$push': {'locks': lock},
+                         '$inc': {'free_slots': -1}}))
+        return ret
 
     def find_flag(self):
         if not self.mule_flags:
             raise RuntimeError(_('No flags set for mule'))
-        flag = self.flag_filter().first()
-        if flag:
-            kwargs = {}
-            if flag.name in SINGLE_SHOT_FLAGS:
-                flag.update(set__pending=False)
-            else:
-                kwargs['backend'] = self.backend
-
-            lock = FlagLock(application=flag.application, flag=flag.name,
-                            pid=self.pid, **kwargs)
-            try:
-                lock.save()
-            except NotUniqueError:
-                return
-
-            return flag
+        for query, update in self.flag_filter():
+            flag = self.lock_helper.claim(query, update)
+            if flag:
+                return flag
 
     def unlock_flag(self, flag):
-        if flag.name in SINGLE_SHOT_FLAGS:
-            lock = FlagLock.objects(application=flag.application,
-                                    flag=flag.name,
-                                    backend__exists=False).first()
-        else:
-            lock = FlagLock.objects(application=flag.application,
-                                    flag=flag.name,
-                                    backend=self.backend).first()
-        if lock:
-            lock.delete()
+        self.lock_helper.release(flag)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import logging
+from datetime import datetime
+
+from bson import ObjectId
+
+from django.utils.translation import ugettext as _
+
+from upaas.checksum import calculate_file_sha256, calculate_string_sha256
+
+from upaas_admin.apps.servers.models import BackendServer, RouterServer
+from upaas_admin.apps.scheduler.models import ApplicationRunPlan
+from upaas_admin.apps.scheduler.ledger import reference_id
+from upaas_admin.apps.applications.models import (
+    Application, ApplicationDomain, ApplicationFlag, FlagNotification,
+    Package)
+from upaas_admin.apps.applications.constants import (
+    NeedsRestartFlag, IsStartingFlag, NeedsReschedulingFlag)
+
+
+log = logging.getLogger(__name__)
+
+
+class BackendReconciler(object):
+    """
+    Checks all applications scheduled on backend and sets flags for those
+    that are not running, have outdated vassal config or invalid run plan.
+    All documents needed are fetched with a few queries up front, so the
+    number of queries doesn't depend on the number of applications.
+    """
+
+    def __init__(self, backend, is_running=None):
+        """
+        :param is_running: callable used to check if application is running,
+                           default checks if vassal config and package exist
+        """
+        self.backend = backend
+        self.is_running = is_running or self.is_application_running
+        self.run_plans = []
+        self.flagged = set()
+        self.routers = []
+        self.domains = {}
+
+    def prefetch(self, application_ids=None):
+        """
+        Load run plans of all applications on backend together with
+        everything they reference and link documents in memory.
+
+        :param application_ids: only load given applications
+        """
+        query = {'backends__backend': self.backend}
+        if application_ids is not None:
+            query['application__in'] = application_ids
+        self.run_plans = list(ApplicationRunPlan.objects(**query))
+        app_ids = [ObjectId(reference_id(rp, 'application'))
+                   for rp in self.run_plans]
+
+        applications = dict((app.id, app) for app in Application.objects(
+            id__in=app_ids))
+        package_ids = set()
+        backend_ids = set()
+        for app in applications.values():
+            if app._data.get('current_package'):
+                package_ids.add(
+                    ObjectId(reference_id(app, 'current_package')))
+        for run_plan in self.run_plans:
+            for backend_conf in run_plan.backends:
+                package_ids.add(ObjectId(reference_id(backend_conf,
+                                                      'package')))
+                backend_ids.add(ObjectId(reference_id(backend_conf,
+                                                      'backend')))
+        packages = dict((pkg.id, pkg) for pkg in Package.objects(
+            id__in=list(package_ids)))
+        backends = dict((b.id, b) for b in BackendServer.objects(
+            id__in=list(backend_ids)))
+        backends[self.backend.id] = self.backend
+        for pkg in packages.values():
+            app = applications.get(ObjectId(reference_id(pkg, 'application')))
+            if app:
+                pkg.application = app
+
+        self.flagged = set(ApplicationFlag._get_collection().distinct(
+            'application', {'application': {'$in': app_ids}}))
+        self.routers = list(RouterServer.objects(is_enabled=True))
+        self.domains = {}
+        for domain in ApplicationDomain.objects(application__in=app_ids):
+            self.domains.setdefault(
+                ObjectId(reference_id(domain, 'application')),
+                []).append(domain)
+
+        run_plans = []
+        for run_plan in self.run_plans:
+            app = applications.get(ObjectId(reference_id(run_plan,
+                                                         'application')))
+            if not app:
+                continue
+            run_plan.application = app
+            app.run_plan = run_plan
+            if app._data.get('current_package'):
+                app.current_package = packages.get(
+                    ObjectId(reference_id(app, 'current_package')))
+            for backend_conf in run_plan.backends:
+                backend_conf.backend = backends.get(
+                    ObjectId(reference_id(backend_conf, 'backend')))
+                backend_conf.package = packages.get(
+                    ObjectId(reference_id(backend_conf, 'package')))
+            run_plans.append(run_plan)
+        self.run_plans = run_plans
+
+    def is_application_running(self, application):
+        if not os.path.exists(application.vassal_path):
+            return False
+        if not os.path.exists(application.current_package.ack_path):
+            return False
+        return True
+
+    def is_vassal_config_valid(self, application):
+        if not os.path.exists(application.vassal_path):
+            # ignore missing vassals, is_running() will handle it
+            return True
+        backend_conf = application.run_plan.backend_settings(self.backend)
+        options = "\n".join(
+            application.current_package.generate_uwsgi_config(
+                backend_conf, routers=self.routers,
+                custom_domains=self.domains.get(application.id, [])))
+        return calculate_string_sha256(options) == calculate_file_sha256(
+            application.vassal_path)
+
+    def check(self):
+        """
+        Evaluate all prefetched applications, returns dict with list of
+        applications for every flag that needs to be set.
+        """
+        ret = {IsStartingFlag.name: [], NeedsRestartFlag.name: [],
+               NeedsReschedulingFlag.name: []}
+        for run_plan in self.run_plans:
+            app = run_plan.application
+            if app.id in self.flagged:
+                continue
+            if not self.is_running(app):
+                log.info(_("Application {name} is not running, "
+                           "starting").format(name=app.name))
+                ret[IsStartingFlag.name].append(app)
+            elif not self.is_vassal_config_valid(app):
+                log.info(_("Application {name} vassal config is invalid, "
+                           "restarting").format(name=app.name))
+                ret[NeedsRestartFlag.name].append(app)
+            elif not run_plan.is_valid():
+                log.info(_("Application {name} run plan is invalid, "
+                           "rescheduling").format(name=app.name))
+                ret[NeedsReschedulingFlag.name].append(app)
+        return ret
+
+    def set_flags(self, flags):
+        """
+        Set all flags using single bulk operation.
+        """
+        bulk = ApplicationFlag._get_collection().initialize_unordered_bulk_op()
+        count = 0
+        for name, applications in flags.items():
+            for app in applications:
+                query = {'application': app.id, 'name': name}
+                update = {'$setOnInsert': {'date_created': datetime.now()}}
+                if name == NeedsReschedulingFlag.name:
+                    update['$unset'] = {'pending': True}
+                else:
+                    update['$addToSet'] = {'pending_backends':
+                                           self.backend.id}
+                bulk.find(query).upsert().update_one(update)
+                count += 1
+        if not count:
+            return 0
+        bulk.execute()
+        for name, applications in flags.items():
+            if applications:
+                FlagNotification.notify(name)
+        return count
+
+    def package_applications(self, package_ids):
+        """
+        Returns ids of applications owning given packages.
+        """
+        ids = [ObjectId(pid) for pid in package_ids if ObjectId.is_valid(pid)]
+        if not ids:
+            return set()
+        return set([pkg['application'] for pkg in
+                    Package._get_collection().find({'_id': {'$in': ids}},
+                                                   ['application'])])
+
+    def reconcile(self, application_ids=None):
+        """
+        Check applications and set flags, returns number of flags set.
+
+        :param application_ids: only check given applications, all
+                                applications on backend are checked if not
+                                passed
+        """
+        if application_ids is not None:
+            application_ids = [ObjectId(aid) for aid in application_ids
+                               if ObjectId.is_valid(aid)]
+            if not application_ids:
+                return 0
+        self.prefetch(application_ids=application_ids)
+        return self.set_flags(self.check())
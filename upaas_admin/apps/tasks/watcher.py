@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import ctypes
+import ctypes.util
+import errno
+import logging
+import struct
+from select import select
+from threading import Thread, Lock
+from time import sleep
+
+from django.utils.translation import ugettext as _
+
+
+log = logging.getLogger(__name__)
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+VASSAL_EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+PACKAGE_EVENTS = IN_MOVED_FROM | IN_DELETE
+
+EVENT_HEADER = struct.Struct(str('iIII'))
+
+
+class Inotify(object):
+    """
+    Minimal inotify wrapper using ctypes.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        # watch descriptor -> path
+        self.watches = {}
+
+    def watch(self, path, mask):
+        wd = self.add_watch(self.fd, path.encode('utf-8'), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        self.watches[wd] = path
+
+    def read(self, timeout):
+        """
+        Returns list of (path, mask, name) tuples, waits up to timeout
+        seconds for events.
+        """
+        if not select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, __, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(
+                'utf-8', 'replace')
+            offset += length
+            events.append((self.watches.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class VassalWatcher(object):
+    """
+    Watches vassal and package directories, modified or removed vassal files
+    and removed package directories are collected so that only affected
+    applications need to be checked. Inotify is used if available, otherwise
+    directories are polled.
+    """
+
+    def __init__(self, vassals_path, apps_path, poll_interval=2):
+        self.vassals_path = vassals_path
+        self.apps_path = apps_path
+        self.poll_interval = poll_interval
+        self.exiting = False
+        self.lock = Lock()
+        self.applications = set()
+        self.packages = set()
+        self.rescan = False
+        self.inotify = None
+
+    @property
+    def pending(self):
+        return bool(self.applications or self.packages or self.rescan)
+
+    def changes(self):
+        """
+        Returns tuple with (application ids, package ids, rescan needed)
+        collected since last call.
+        """
+        with self.lock:
+            ret = (self.applications, self.packages, self.rescan)
+            self.applications = set()
+            self.packages = set()
+            self.rescan = False
+        return ret
+
+    def add_vassal(self, name):
+        if name.endswith('.ini'):
+            with self.lock:
+                self.applications.add(name[:-len('.ini')])
+
+    def add_package(self, name):
+        with self.lock:
+            self.packages.add(name)
+
+    def handle_event(self, path, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log.warning(_("Watcher event queue overflow, full scan needed"))
+            with self.lock:
+                self.rescan = True
+        elif path == self.vassals_path:
+            self.add_vassal(name)
+        elif path == self.apps_path:
+            self.add_package(name)
+
+    def snapshot(self):
+        vassals = {}
+        for name in os.listdir(self.vassals_path):
+            try:
+                vassals[name] = os.stat(
+                    os.path.join(self.vassals_path, name)).st_mtime
+            except OSError:
+                continue
+        return vassals, set(os.listdir(self.apps_path))
+
+    def poll(self):
+        vassals, packages = self.snapshot()
+        while not self.exiting:
+            sleep(self.poll_interval)
+            try:
+                current_vassals, current_packages = self.snapshot()
+            except OSError as e:
+                log.error(_("Can't list watched directories: {e}").format(
+                    e=e))
+                continue
+            for name, mtime in vassals.items():
+                if current_vassals.get(name) != mtime:
+                    self.add_vassal(name)
+            for name in packages - current_packages:
+                self.add_package(name)
+            vassals, packages = current_vassals, current_packages
+
+    def watch(self):
+        try:
+            while not self.exiting:
+                for path, mask, name in self.inotify.read(1):
+                    self.handle_event(path, mask, name)
+        finally:
+            self.inotify.close()
+
+    def start(self):
+        try:
+            self.inotify = Inotify()
+            self.inotify.watch(self.vassals_path, VASSAL_EVENTS)
+            self.inotify.watch(self.apps_path, PACKAGE_EVENTS)
+        except (OSError, AttributeError) as e:
+            log.warning(_("Inotify not available, polling directories every "
+                          "{interval} seconds: {e}").format(
+                interval=self.poll_interval, e=e))
+            if self.inotify:
+                self.inotify.close()
+            self.inotify = None
+        t1 = Thread(target=self.watch if self.inotify else self.poll)
+        t1.daemon = True
+        t1.start()
+
+    def stop(self):
+        self.exiting = True
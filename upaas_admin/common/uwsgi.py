@@ -36,3 +36,45 @@ def fetch_json_stats(addr, port, timeout=5):
             except Exception as e:
                 log.error("Couldn't decode stats JSON data from %s:%s: %s" % (
                     addr, port, e))
+
+
+def stats_generation(stats):
+    """
+    Returns (master pid, set of worker pids) tuple describing running
+    instance, use generation_changed() to check if it was reloaded. None is
+    returned if stats are missing or incomplete.
+    """
+    if not isinstance(stats, dict) or not stats.get('pid'):
+        return None
+    return (stats['pid'], frozenset([w['pid'] for w in
+                                     stats.get('workers', [])
+                                     if w.get('pid')]))
+
+
+def generation_changed(old, new):
+    """
+    Returns True if instance was reloaded between given generations, that
+    is master was restarted or none of the old workers is still running.
+    Workers spawned or stopped by the cheaper subsystem don't count as
+    reload as long as some of the old workers keep running. False is
+    returned if new generation is unknown.
+    """
+    if new is None:
+        return False
+    if old is None:
+        return True
+    if old[0] != new[0]:
+        return True
+    return not old[1].intersection(new[1])
+
+
+def stats_ready(stats):
+    """
+    Returns True if stats show that instance is accepting requests.
+    """
+    if not stats:
+        return False
+    if not isinstance(stats, dict) or 'workers' not in stats:
+        return True
+    return bool([w for w in stats['workers']
+                 if w.get('status') in ('idle', 'busy')])
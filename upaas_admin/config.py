@@ -59,6 +59,10 @@ class UPaaSConfig(base.Config):
         "storage": {
             "handler": base.StringEntry(required=True),
             "settings": base.WildcardEntry(),
+            "cache": {
+                "path": base.StringEntry(),
+                "max_size": base.IntegerEntry(default=0, min_value=0),
+            },
         },
         "bootstrap": {
             "timelimit": base.IntegerEntry(required=True),
@@ -104,6 +108,7 @@ class UPaaSConfig(base.Config):
                 "root": base.StringEntry(default="uwsgi"),
             },
             "features": base.ConfigDictEntry(FeatureConfig),
+            "metadata_cache": base.IntegerEntry(default=256, min_value=0),
         },
         "defaults": {
             "limits": {
@@ -116,6 +121,23 @@ class UPaaSConfig(base.Config):
                 "max_log_size": base.IntegerEntry(required=True, min_value=1),
             }
         },
+        "scheduler": {
+            "scorer": base.StringEntry(default="weighted"),
+            "weights": {
+                "cpu": base.IntegerEntry(default=1, min_value=0),
+                "memory": base.IntegerEntry(default=1, min_value=0),
+                "ports": base.IntegerEntry(default=1, min_value=0),
+            },
+            "live_load": {
+                "enabled": base.BooleanEntry(default=False),
+                "window": base.IntegerEntry(default=300, min_value=1),
+                "requests_per_core": base.IntegerEntry(default=100,
+                                                       min_value=1),
+            },
+            "rebalance": {
+                "max_moves": base.IntegerEntry(default=2, min_value=1),
+            },
+        },
         "admin": {
             "secretkey": base.StringEntry(required=True),
             "loglevel": base.StringEntry(default='info'),